@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'parking_api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,7 +54,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'corsheaders.middleware.CorsMiddleware'
+    'corsheaders.middleware.CorsMiddleware',
+    'parking_api.databases.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'RubberDuckyParking.urls'
@@ -84,9 +86,35 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # a file rather than sqlite's shared cache in memory, where a connection that finds a table locked
+        # fails at once instead of waiting, so the concurrency tests see the locking a server sees
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# SQLITE_PROFILE=tuned: WAL, synchronous=NORMAL, mmap and connections kept across requests, see
+# parking_api/databases.py. Off by default, WAL needs the database on a local disk
+SQLITE_TUNED = os.environ.get('SQLITE_PROFILE') == 'tuned'
+if SQLITE_TUNED:
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+    DATABASES['default']['OPTIONS'] = {'timeout': 20}
+
+# list and retrieve requests read from one of these, the others from default (parking_api.databases).
+# DATABASE_REPLICAS is a comma separated list of sqlite files, naming db.sqlite3 itself gives read-only
+# connections to it, which read next to the writer with the tuned profile
+DATABASE_READ_REPLICAS = []
+for number, name in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), 1):
+    alias = f'replica{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': f'file:{Path(name).resolve()}?mode=ro',
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_READ_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['parking_api.databases.ReplicaRouter']
+# seconds a client reads from default after a write, so it sees what it wrote
+REPLICA_STICKY_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -139,22 +167,48 @@ LOGOUT_REDIRECT_URL = '/'
 
 STATIC_URL = '/static/'
 STATICFILES_DIRS = (str(BASE_DIR.joinpath('static')),)
+STATIC_ROOT = os.path.join(BASE_DIR, 'static_cdn', 'static_root')
+# collectstatic puts content hashes in the names and gzips, see parking_api/assets.py
+STATICFILES_STORAGE = 'parking_api.assets.CompressedManifestStorage'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'static_cdn', 'media_root')
 
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'parking_api.pagination.CursorPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'parking_api.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ]
 }
 
+# token -> user lookups kept in memory by parking_api.authentication, 0 turns the cache off
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60    # seconds, how long a change made by another process can go unseen
+
+# rendered bodies of parking-sizes, locations and parking spot detail responses are kept in this
+# django cache, keyed on the versions of the models they show. None turns it off
+CATALOG_BODY_CACHE = 'default'
+
+# background threads making the sized variants of uploaded images (parking_api.images),
+# 0 makes them in the request that uploads
+IMAGE_WORKERS = 2
+
+# password hashing for logins and signups runs in this many processes (parking_api.passwords), per server
+# process, 0 hashes in the request. Past PASSWORD_QUEUE waiting logins, or after PASSWORD_TIMEOUT seconds,
+# they get 503 with Retry-After
+PASSWORD_WORKERS = 2
+PASSWORD_QUEUE = 32
+PASSWORD_TIMEOUT = 10
+
+# /api/_metrics (prometheus) answers only requests with "Authorization: Bearer <METRICS_TOKEN>" when this is set,
+# otherwise staff users and unproxied requests from this host
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 # cors
 CORS_ORIGIN_ALLOW_ALL = True
\ No newline at end of file
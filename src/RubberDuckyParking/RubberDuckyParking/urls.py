@@ -13,12 +13,20 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
 from django.conf import settings
 from django.conf.urls.static import static
+from parking_api import assets, images
 
 urlpatterns = [
+    # runserver serves /static/ itself with DEBUG on, this is for everything else
+    re_path(r'^%s(?P<path>.*)$' % re.escape(settings.STATIC_URL.lstrip('/')), assets.serve_asset),
+    # before static(), which serves the rest of the media without cache headers and only when DEBUG is on
+    re_path(r'^%s%s/(?P<path>.*)$' % (re.escape(settings.MEDIA_URL.lstrip('/')), images.VARIANT_DIR),
+            images.serve_variant),
     path('admin/', admin.site.urls),
     path('api/', include('parking_api.urls')),
     path('accounts/', include('django.contrib.auth.urls')),
@@ -0,0 +1,74 @@
+'''
+    Past reservations moved out of the reservation table, so it stays the size of the current bookings.
+
+    needsconfirmation, myreservations, bossreservations, check-ins and the overlap checks of new bookings
+    only care about reservations that are upcoming, running or just over, but their index ranges and the
+    pages they read grow with every booking ever made. move() (the archive_reservations command, run e.g.
+    nightly) moves reservations that ended more than ARCHIVE_AFTER ago, and canceled ones nobody touched
+    for as long, to ArchivedReservation. Each chunk of CHUNK_SIZE rows is one INSERT ... SELECT and one
+    DELETE in a transaction of its own, so a reservation is always in exactly one table and bookings
+    wait for the write lock at most one chunk.
+
+    Archived rows keep their pk. sqlite's AUTOINCREMENT never hands out a pk twice, so pks are unique
+    across both tables. Moving is not deleting and sends no signals: the occupancy heatmaps keep
+    counting archived reservations and read both tables when they count a lot again, and the
+    availability index keeps nothing that old.
+
+    A user's reservations (ReservationViewSet list and retrieve) and the host's export read both tables,
+    pages and export rows merged in order. The lists of hosts and attendants show the current ones.
+'''
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from . import checkout
+from .models import ArchivedReservation, Reservation
+
+ARCHIVE_AFTER = timedelta(days=30)
+CHUNK_SIZE = 500        # pks per statement, below the 999 parameters older sqlite builds allow
+
+
+def due(now, after=ARCHIVE_AFTER):
+    # reservations to archive at now
+    cutoff = now - after
+    return Reservation.objects.filter(Q(end_date__lt=cutoff) | Q(canceled=True, updated_at__lt=cutoff))
+
+
+def move_sql(count):
+    quote = connection.ops.quote_name
+    hot, cold = quote(Reservation._meta.db_table), quote(ArchivedReservation._meta.db_table)
+    columns = ', '.join(quote(field.column) for field in Reservation._meta.concrete_fields)
+    pk = quote(Reservation._meta.pk.column)
+    pks = ', '.join(['%s'] * count)
+    return (
+        f'INSERT INTO {cold} ({columns}, {quote("archived_at")}) SELECT {columns}, %s FROM {hot} WHERE {pk} IN ({pks})',
+        f'DELETE FROM {hot} WHERE {pk} IN ({pks})',
+    )
+
+
+def move_chunk(now, after, chunk_size):
+    pks = list(due(now, after).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+    if pks:
+        insert, delete = move_sql(len(pks))
+        with connection.cursor() as cursor:
+            cursor.execute(insert, [connection.ops.adapt_datetimefield_value(now), *pks])
+            cursor.execute(delete, pks)
+    return len(pks)
+
+
+def move(after=ARCHIVE_AFTER, chunk_size=CHUNK_SIZE):
+    '''
+        Moves the reservations that ended, or were canceled, more than after ago to the archive,
+        returns how many
+    '''
+    now = timezone.now()
+    moved = 0
+    while True:
+        # the read of the pks takes a read lock that is upgraded at the insert, which fails when
+        # another write got in between, retrying() starts the chunk over
+        count = checkout.retrying(lambda: move_chunk(now, after, chunk_size))
+        moved += count
+        if count < chunk_size:
+            return moved
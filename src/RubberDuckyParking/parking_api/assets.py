@@ -0,0 +1,116 @@
+'''
+    Static assets with content hashes in their names, gzipped ahead of time.
+
+    collectstatic with CompressedManifestStorage (settings.STATICFILES_STORAGE) copies the assets to
+    STATIC_ROOT under names carrying a hash of their content (css/styles.3f2a9c1b7e4d.css), rewrites the
+    url()s in css files to match and records the names in staticfiles.json, so {% static %} links to them.
+    Next to every compressible file it writes a .gz copy, compressed once at level 9 rather than on every
+    request.
+
+    serve_asset() sends the .gz copy to clients accepting gzip. Hashed names never show different bytes,
+    so their responses may be kept for a year. Other names (what is linked without {% static %}) are
+    revalidated with If-Modified-Since. The body is a FileResponse, which WSGI servers with
+    wsgi.file_wrapper (gunicorn, uWSGI) send with sendfile() straight from the page cache.
+
+    Without a manifest, as in development before any collectstatic, {% static %} links to the plain names
+    and serve_asset() reads them from STATICFILES_DIRS when DEBUG is on.
+'''
+import gzip
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.functional import cached_property
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+COMPRESSIBLE = ('.css', '.js', '.mjs', '.svg', '.ico', '.json', '.map', '.txt', '.html', '.xml')
+MIN_SAVING = 0.9        # a .gz copy is only kept when at most this share of the original
+MAX_AGE = 365 * 24 * 60 * 60
+accepts_gzip = re.compile(r'\bgzip\b').search
+
+
+class CompressedManifestStorage(ManifestStaticFilesStorage):
+
+    def stored_name(self, name):
+        # the plain name for assets missing from the manifest, instead of failing the page
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in {*paths, *self.hashed_files.values()}:
+            if name.endswith(COMPRESSIBLE) and self.exists(name):
+                self.compress(name)
+
+    def compress(self, name):
+        path = self.path(name)
+        with open(path, 'rb') as source:
+            data = source.read()
+        # mtime=0, so the same file always gives the same bytes
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) <= len(data) * MIN_SAVING:
+            with open(path + '.gz', 'wb') as target:
+                target.write(compressed)
+        elif os.path.exists(path + '.gz'):
+            os.remove(path + '.gz')
+
+    @cached_property
+    def immutable_names(self):
+        return frozenset(self.hashed_files.values())
+
+
+def find(path):
+    '''
+        (file path, whether its name is hashed), the file is None when there is no such asset
+    '''
+    path = posixpath.normpath(path).lstrip('/')
+    if path == '..' or path.startswith('../'):
+        return None, False
+    if settings.STATIC_ROOT:
+        file_path = safe_join(settings.STATIC_ROOT, path)
+        if os.path.isfile(file_path):
+            return file_path, path in getattr(staticfiles_storage, 'immutable_names', ())
+    if settings.DEBUG:
+        return finders.find(path), False
+    return None, False
+
+
+def serve_asset(request, path):
+    file_path, hashed = find(path)
+    if not file_path:
+        raise Http404(f'no asset {path}')
+    content_type, encoding = mimetypes.guess_type(file_path)
+    content_encoding = None
+    if encoding is None and accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', '')) \
+            and os.path.isfile(file_path + '.gz'):
+        file_path += '.gz'
+        content_encoding = 'gzip'
+    stat = os.stat(file_path)
+    if hashed:
+        cache_control = f'public, max-age={MAX_AGE}, immutable'
+    else:
+        cache_control = 'public, no-cache'
+
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(file_path, 'rb'), content_type=content_type or 'application/octet-stream')
+        del response['Content-Disposition']     # FileResponse names the file, assets are shown inline
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if content_encoding:
+            response['Content-Encoding'] = content_encoding
+    response['Cache-Control'] = cache_control
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
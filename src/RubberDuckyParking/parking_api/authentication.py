@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import BaseUser, Host, Attendant
+from .roles import Roles
+
+
+def freeze(instance):
+    # the column values of a model instance, so the cache never hands the same object to two requests
+    if instance is None:
+        return None
+    return tuple(getattr(instance, field.attname) for field in instance._meta.concrete_fields)
+
+
+def thaw(model, values):
+    if values is None:
+        return None
+    names = [field.attname for field in model._meta.concrete_fields]
+    return model.from_db(DEFAULT_DB_ALIAS, names, values)
+
+
+class TokenCache:
+    '''
+        LRU cache of token key -> (token, user, host, attendant, boss) with a time to live.
+        signals.py drops entries when a Token, BaseUser, Host or Attendant changes in this process,
+        the TTL bounds how long a change made by another process can go unseen
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, token, roles):
+        if self.max_size <= 0:
+            return
+        attendant = roles.attendant
+        value = (
+            freeze(token),
+            freeze(roles.user),
+            freeze(roles.host),
+            freeze(attendant),
+            freeze(attendant.boss if attendant is not None else None),
+        )
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def build(self, value):
+        token_values, user_values, host_values, attendant_values, boss_values = value
+        user = thaw(BaseUser, user_values)
+        token = thaw(Token, token_values)
+        token.user = user
+        roles = Roles(user)
+        roles.host = thaw(Host, host_values)
+        roles.attendant = thaw(Attendant, attendant_values)
+        if roles.host is not None:
+            roles.host.user = user
+        if roles.attendant is not None:
+            roles.attendant.user = user
+            roles.attendant.boss = thaw(Host, boss_values)
+        return token, roles
+
+    def invalidate(self, match):
+        with self.lock:
+            stale = [key for key, (expires, value) in self.entries.items() if match(value)]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def invalidate_token(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_user(self, user_pk):
+        self.invalidate(lambda value: value[1][0] == user_pk)
+
+    def invalidate_boss(self, host_pk):
+        # attendants of a deleted host lose their boss through an UPDATE that sends no signals
+        self.invalidate(lambda value: value[4] is not None and value[4][0] == host_pk)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+token_cache = TokenCache(
+    max_size=getattr(settings, 'TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'TOKEN_CACHE_TTL', 60),
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''
+        TokenAuthentication that remembers who a token belongs to, and their roles,
+        so most requests skip the token/user query and the roles query
+    '''
+
+    def authenticate(self, request):
+        result = super().authenticate(request)
+        if result is not None:
+            request._parking_roles = self._roles
+        return result
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            token, self._roles = token_cache.build(cached)
+            if not token.user.is_active:
+                raise exceptions.AuthenticationFailed('User inactive or deleted.')
+            return (token.user, token)
+        user, token = super().authenticate_credentials(key)
+        self._roles = Roles.load(user)
+        token_cache.set(key, token, self._roles)
+        return (user, token)
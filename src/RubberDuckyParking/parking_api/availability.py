@@ -0,0 +1,213 @@
+'''
+    Which parking spots are free for a time window.
+
+    AvailabilityIndex keeps the non-canceled reservations of every spot in memory, sorted by start time,
+    with a running max of the end times. A window [start, end) overlaps a reservation of the spot exactly
+    when the latest end among reservations starting before `end` is after `start`, which is one bisect.
+    Spots without reservations are never in the index, so they are free without being looked at.
+    free_spots() only looks up the spots its queryset holds, one bisect each, and hands the busy ones
+    back to the database as one parameter.
+
+    The index picks up writes, from this process or others, by reading reservations whose updated_at
+    moved since the last sync (an indexed range scan). Searches sync at most every SYNC_INTERVAL, or right
+    away when this process saved a reservation since (signals.py), so writes of other processes show up
+    to SYNC_INTERVAL late. updated_at is set when the row is saved, not when it commits, so a booking
+    that waited for the write lock commits a row older than the last sync; each sync re-reads
+    SYNC_OVERLAP behind it to catch those, applying a row twice changes nothing. Deletes
+    come from signals.py in this process; deletes in other processes, and rows that took longer than
+    SYNC_OVERLAP to commit, are only seen at the next full reload. Until then a spot can show as taken
+    when it is free or, for such a slow commit, free when it is taken; bookings are checked against the
+    database either way (is_spot_free).
+'''
+import bisect
+import json
+import threading
+import time
+from datetime import timedelta
+
+from django.db import connections
+from django.db.models import FloatField, Func, Max
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Reservation
+
+RELOAD_SECONDS = 300            # full reload, to drop reservations deleted by other processes
+SYNC_INTERVAL = 0.5             # seconds between syncs, unless this process saved a reservation since
+HISTORY = timedelta(days=1)     # reservations that ended before now - HISTORY are not kept in memory
+SYNC_OVERLAP = timedelta(seconds=30)    # longer than the 20 second sqlite lock timeout a save can wait
+
+
+def to_ms(seconds):
+    # whole milliseconds, so back to back reservations compare equal despite float noise
+    return round(seconds * 1000)
+
+
+class EpochSeconds(Func):
+    '''
+        A datetime column as unix seconds. Converting sqlite's datetime strings in python costs
+        more than everything else in a reload
+    '''
+    output_field = FloatField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='((julianday(%(expressions)s) - 2440587.5) * 86400.0)')
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='EXTRACT(EPOCH FROM %(expressions)s)')
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='UNIX_TIMESTAMP(%(expressions)s)')
+
+
+class SpotSchedule:
+
+    def __init__(self):
+        self.reservations = {}      # reservation pk -> (start, end) in ms
+        self.starts = None
+
+    def set(self, pk, start, end):
+        self.reservations[pk] = (start, end)
+        self.starts = None
+
+    def remove(self, pk):
+        self.reservations.pop(pk, None)
+        self.starts = None
+
+    def build(self):
+        intervals = sorted(self.reservations.values())
+        self.starts = [start for start, end in intervals]
+        self.max_ends = []
+        latest = float('-inf')
+        for start, end in intervals:
+            latest = max(latest, end)
+            self.max_ends.append(latest)
+
+    def is_free(self, start, end):
+        if self.starts is None:
+            self.build()
+        i = bisect.bisect_left(self.starts, end)
+        return i == 0 or self.max_ends[i - 1] <= start
+
+
+class AvailabilityIndex:
+    fields = ('pk', 'parking_spot_id', 'start', 'end', 'canceled')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spots = {}         # spot pk -> SpotSchedule
+            self.spot_of = {}       # reservation pk -> spot pk
+            self.synced_to = None   # newest updated_at seen
+            self.synced_at = None   # time.monotonic() of the last sync
+            self.saved = False      # this process saved a reservation since the last sync
+            self.loaded_at = None
+            self.horizon = None     # windows starting before this are answered from the database
+
+    def apply(self, pk, spot_pk, start, end, canceled):
+        # start and end are unix seconds
+        old_spot = self.spot_of.pop(pk, None)
+        if old_spot is not None:
+            self.spots[old_spot].remove(pk)
+        if canceled or end < self.horizon.timestamp():
+            return
+        self.spots.setdefault(spot_pk, SpotSchedule()).set(pk, to_ms(start), to_ms(end))
+        self.spot_of[pk] = spot_pk
+
+    def remove(self, pk):
+        with self.lock:
+            spot_pk = self.spot_of.pop(pk, None)
+            if spot_pk is not None:
+                self.spots[spot_pk].remove(pk)
+
+    def note_save(self):
+        self.saved = True
+
+    def sync(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.loaded_at is None or now - self.loaded_at > RELOAD_SECONDS:
+                self.reload()
+                return
+            if not self.saved and now - self.synced_at < SYNC_INTERVAL:
+                return
+            self.saved = False
+            self.synced_at = now
+            if self.synced_to is None:
+                rows = Reservation.objects.all()
+            else:
+                # rows saved before the last sync but committed after it are not lost
+                rows = Reservation.objects.filter(updated_at__gte=self.synced_to - SYNC_OVERLAP)
+            for row in self._rows(rows).values_list(*self.fields, 'updated_at'):
+                self.apply(*row[:-1])
+                self.synced_to = max(self.synced_to or row[-1], row[-1])
+
+    def reload(self):
+        with self.lock:
+            self.reset()
+            self.loaded_at = self.synced_at = time.monotonic()
+            self.saved = False
+            self.horizon = timezone.now() - HISTORY
+            # read before loading so anything written during the load is picked up by the next sync
+            self.synced_to = Reservation.objects.aggregate(newest=Max('updated_at'))['newest']
+            rows = Reservation.objects.filter(canceled=False, end_date__gte=self.horizon)
+            for row in self._rows(rows).values_list(*self.fields).iterator():
+                self.apply(*row)
+
+    def _rows(self, queryset):
+        return queryset.annotate(start=EpochSeconds('start_date'), end=EpochSeconds('end_date'))
+
+    def busy_spots(self, start, end, candidates):
+        '''
+            The pks among candidates (a set of spot pks) with a reservation overlapping [start, end),
+            None when the window starts before the horizon and only the database knows
+        '''
+        with self.lock:
+            self.sync()
+            if start < self.horizon:
+                return None
+            start, end = to_ms(start.timestamp()), to_ms(end.timestamp())
+            spots = self.spots
+            smaller, larger = (candidates, spots) if len(candidates) < len(spots) else (spots, candidates)
+            return {pk for pk in smaller if pk in larger and not spots[pk].is_free(start, end)}
+
+
+def free_spots(queryset, start, end):
+    '''
+        The spots of queryset without a reservation overlapping [start, end)
+    '''
+    busy = None
+    if index.horizon is None or start >= index.horizon:
+        # the candidates are read before the index is locked
+        busy = index.busy_spots(start, end, set(queryset.values_list('pk', flat=True)))
+    if busy is None:
+        # before the horizon only the database knows
+        return queryset.exclude(pk__in=conflicting_reservations(start, end).values('parking_spot_id'))
+    if not busy:
+        return queryset
+    if connections[queryset.db].vendor == 'sqlite':
+        # one parameter however many spots are busy
+        return queryset.exclude(pk__in=RawSQL('SELECT value FROM json_each(%s)', [json.dumps(sorted(busy))]))
+    return queryset.exclude(pk__in=busy)
+
+
+def conflicting_reservations(start, end, spot=None, exclude_pk=None):
+    queryset = Reservation.objects.filter(canceled=False, start_date__lt=end, end_date__gt=start)
+    if spot is not None:
+        queryset = queryset.filter(parking_spot=spot)
+    if exclude_pk is not None:
+        queryset = queryset.exclude(pk=exclude_pk)
+    return queryset
+
+
+def is_spot_free(spot, start, end, exclude_pk=None):
+    '''
+        Checked against the database, not the index, because this guards writes
+    '''
+    return not conflicting_reservations(start, end, spot, exclude_pk).exists()
+
+
+index = AvailabilityIndex()
@@ -0,0 +1,122 @@
+'''
+    Conditional GET for read-mostly endpoints.
+
+    Every save or delete of a versioned model bumps its row in ModelVersion (signals.py) once the write
+    has committed, so a write that rolls back leaves cached responses valid. Until the bump a request can
+    still get the old ETag, for as long as one UPDATE takes. A response's ETag is a hash of the URL, the
+    response format and the versions of the models it shows, so checking whether a client's copy is current
+    is one primary key lookup.
+    Rendered bodies can also be kept in a django cache (settings.CATALOG_BODY_CACHE) under that ETag.
+
+    bulk_create() and queryset.update() send no signals, code using them calls bump() itself.
+'''
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags
+
+from .models import ModelVersion, BaseUser, Host, Location, ParkingSize, ParkingSpot
+
+VERSIONED_MODELS = [BaseUser, Host, Location, ParkingSize, ParkingSpot]
+BODY_CACHE_TIMEOUT = 60 * 60    # a new version means a new key, so old bodies only need to age out
+
+
+def label(model):
+    return model._meta.label_lower
+
+
+def bump(model):
+    '''
+        Marks the responses built from model stale when the current transaction commits, right away
+        outside of one
+    '''
+    transaction.on_commit(lambda: bump_now(model))
+
+
+def bump_now(model):
+    name = label(model)
+    updated = ModelVersion.objects.filter(name=name).update(version=F('version') + 1, updated_at=timezone.now())
+    if not updated:
+        try:
+            with transaction.atomic():
+                ModelVersion.objects.create(name=name, version=1)
+        except IntegrityError:
+            # another request created the row first
+            ModelVersion.objects.filter(name=name).update(version=F('version') + 1, updated_at=timezone.now())
+
+
+def current_versions(models):
+    '''
+        ({label: version}, last modified datetime or None)
+    '''
+    rows = ModelVersion.objects.filter(name__in=[label(model) for model in models])
+    versions = {}
+    last_modified = None
+    for name, version, updated_at in rows.values_list('name', 'version', 'updated_at'):
+        versions[name] = version
+        last_modified = max(last_modified or updated_at, updated_at)
+    return {label(model): versions.get(label(model), 0) for model in models}, last_modified
+
+
+def body_cache():
+    alias = getattr(settings, 'CATALOG_BODY_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def not_modified(request, etag):
+    # If-Modified-Since is not answered: HTTP dates are whole seconds, so a second write within the
+    # second of the client's Last-Modified would still get a 304. The ETag changes with every write
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag in etags
+
+
+def conditional(*models, skip_params=()):
+    '''
+        Decorates a ViewSet method whose response only depends on the URL and these models.
+        Requests with any of skip_params depend on more than that and are served as usual
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            if any(param in request.query_params for param in skip_params):
+                return method(self, request, *args, **kwargs)
+
+            versions, last_modified = current_versions(models)
+            key = f'{request.get_full_path()}|{request.accepted_renderer.format}|{sorted(versions.items())}'
+            etag = '"{}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+            if not_modified(request, etag):
+                response = HttpResponseNotModified()
+            else:
+                cache = body_cache()
+                cached = cache.get(etag) if cache else None
+                if cached is not None:
+                    content, content_type = cached
+                    response = HttpResponse(content, content_type=content_type)
+                else:
+                    response = method(self, request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    if cache:
+                        # render now instead of after the view returns, so the bytes can be kept
+                        response.accepted_renderer = request.accepted_renderer
+                        response.accepted_media_type = request.accepted_media_type
+                        response.renderer_context = self.get_renderer_context()
+                        response.render()
+                        cache.set(etag, (response.content, response['Content-Type']), BODY_CACHE_TIMEOUT)
+
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified.timestamp())
+            return response
+        return wrapper
+    return decorator
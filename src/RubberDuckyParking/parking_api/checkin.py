@@ -0,0 +1,95 @@
+'''
+    Signed check-in tokens for the QR code of a reservation.
+
+    A token is a few packed integers (host, reservation, spot, start, end, expiry) followed by a truncated
+    HMAC-SHA256 of them, base64url encoded, about 70 characters. Every host has its own key, derived from
+    the secret key, and attendants get their boss's key (checkin_key()), so an attendant device can check
+    a token with no network at all, and a leaked device key only forges tokens for one host's lots.
+
+    Online, the signature part of the token is also stored on the reservation (checkin_code, unique),
+    so the server finds the reservation with one index lookup. A token is only good for the spot and
+    window it shows: once the reservation moved, its old tokens stop working (matches()), whether or not
+    the user fetched a new one since, which replaces the stored code.
+'''
+import base64
+import hashlib
+import hmac
+import struct
+import time
+
+from django.conf import settings
+
+VERSION = 2
+# version, host, reservation, spot, start, end, expires. The times are signed 64 bit unix seconds, which
+# hold every date a datetime can, before 1970 too
+PAYLOAD = struct.Struct('>BIIIqqq')
+MAC_SIZE = 16
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def host_key(host_pk):
+    secret = getattr(settings, 'CHECKIN_SECRET', None) or settings.SECRET_KEY
+    return hmac.new(secret.encode('utf-8'), b'parking_api.checkin:%d' % host_pk, hashlib.sha256).digest()
+
+
+def checkin_key(host_pk):
+    # what an attendant device needs to check tokens of its boss's lots
+    return base64.urlsafe_b64encode(host_key(host_pk)).decode('ascii')
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def sign(payload, key):
+    return hmac.new(key, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+def make_token(reservation):
+    '''
+        (token, checkin code) for a reservation, with its spot loaded.
+        The same reservation always gives the same token
+    '''
+    spot = reservation.parking_spot
+    start = int(reservation.start_date.timestamp())
+    end = int(reservation.end_date.timestamp())
+    payload = PAYLOAD.pack(VERSION, spot.owner_id, reservation.pk, spot.pk, start, end, end)
+    mac = sign(payload, host_key(spot.owner_id))
+    return b64encode(payload + mac), b64encode(mac)
+
+
+def read_token(token, key=None, now=None):
+    '''
+        The token's fields as a dict, after checking its signature and expiry. Needs no database.
+        key is the host's key, by default the one of the host named in the token
+    '''
+    try:
+        raw = b64decode(token.strip())
+    except (ValueError, AttributeError):
+        raise InvalidToken('not a check-in token')
+    if len(raw) != PAYLOAD.size + MAC_SIZE:
+        raise InvalidToken('not a check-in token')
+    payload, mac = raw[:PAYLOAD.size], raw[PAYLOAD.size:]
+    version, host, reservation, spot, start, end, expires = PAYLOAD.unpack(payload)
+    if version != VERSION:
+        raise InvalidToken('unknown token version')
+    if not hmac.compare_digest(sign(payload, key or host_key(host)), mac):
+        raise InvalidToken('bad signature')
+    if (now if now is not None else time.time()) > expires:
+        raise InvalidToken('expired')
+    return {
+        'host': host, 'reservation': reservation, 'spot': spot,
+        'start': start, 'end': end, 'expires': expires, 'code': b64encode(mac),
+    }
+
+
+def matches(fields, spot, start, end):
+    # whether the token read into fields was issued for the reservation as it is now
+    return (fields['spot'], fields['start'], fields['end']) == (spot, int(start.timestamp()), int(end.timestamp()))
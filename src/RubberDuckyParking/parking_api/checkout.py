@@ -0,0 +1,90 @@
+'''
+    Booking a spot: the reservation and the transaction that pays for it, written together and never
+    overlapping another reservation of the spot.
+
+    Two requests for overlapping windows of one spot can both find it free and both insert. Every booking
+    therefore starts its transaction with lock_spot(), an UPDATE of the spot's row, and checks for overlaps
+    and writes after it. On databases with row locks the next booking of the same spot waits at that UPDATE
+    until the first commits, a few milliseconds, while bookings of other spots go ahead. SQLite only has one
+    writer at a time, and the UPDATE makes a booking take the write lock before it reads: a read lock
+    upgraded at the insert instead fails with "database is locked" when another booking got there first.
+
+    The price is quoted before the lock is taken, so the locked part is a handful of small statements.
+    Lock timeouts and deadlocks (OperationalError) are retried a few times with backoff when the booking
+    is a transaction of its own.
+'''
+import random
+import time
+from decimal import Decimal
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from . import availability, checkin, pricing
+from .models import ParkingSpot, Reservation, Transactions
+
+FEE_RATE = Decimal('0.10')      # the share of a booking kept as the fee, the host gets the rest
+CENT = Decimal('0.01')
+MAX_ATTEMPTS = 5
+BACKOFF = 0.02                  # seconds, doubled on every retry, with jitter
+
+
+def lock_spot(spot_pk):
+    '''
+        Locks the spot's row until the current transaction ends, returns False if there is no such spot
+    '''
+    return ParkingSpot.objects.filter(pk=spot_pk).update(bookings=F('bookings') + 1) > 0
+
+
+def retrying(function):
+    '''
+        function() in a transaction, run again when it fails to get a lock, unless it is part of an
+        outer transaction that can't be started over from here
+    '''
+    outer = connection.in_atomic_block
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return function()
+        except OperationalError:
+            if outer or attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def amounts(charge):
+    # (user charge, fee, host income)
+    charge = Decimal(str(charge)).quantize(CENT)
+    fee = (charge * FEE_RATE).quantize(CENT)
+    return charge, fee, charge - fee
+
+
+def checkout(user, spot, start, end, vehicle, expected_total=None):
+    '''
+        Reserves [start, end) at spot for user and charges the quoted price.
+        Returns (reservation, transaction, check-in token). Raises ValidationError when the spot is
+        taken or the price is not expected_total (what the user was shown) anymore
+    '''
+    if start >= end:
+        raise ValidationError({'end_date': 'must be after the start date'})
+    charge, fee, income = amounts(pricing.quote_spot(spot, start, end))
+    if expected_total is not None and charge != expected_total:
+        raise ValidationError({'expected_total': f'the price of this window is {charge} now'})
+
+    def book():
+        lock_spot(spot.pk)
+        if not availability.is_spot_free(spot, start, end):
+            raise ValidationError({'parking_spot': 'this spot is already reserved for that time'})
+        reservation = Reservation.objects.create(parking_spot=spot, start_date=start, end_date=end, user=user)
+        token, code = checkin.make_token(reservation)
+        Reservation.objects.filter(pk=reservation.pk).update(checkin_code=code)
+        reservation.checkin_code = code
+        record = Transactions.objects.create(
+            date=timezone.now(), user_charge=charge, fee_amount=fee, host_income=income, user=user,
+            location_id=spot.location_id, spot=spot, vehicle=vehicle, hash_str=code,
+        )
+        return reservation, record, token
+
+    return retrying(book)
@@ -0,0 +1,95 @@
+'''
+    Read replicas for list and retrieve requests, and a tuned SQLite profile.
+
+    ReplicaMiddleware picks one of DATABASE_READ_REPLICAS for each request whose viewset action is list or
+    retrieve (permissions.SAFE_METHODS), and ReplicaRouter sends that request's reads there. Everything
+    else, and every write, goes to default. A replica can lag behind, so a response to a POST (or PUT,
+    PATCH, DELETE) sets a cookie that keeps the client reading from default for REPLICA_STICKY_SECONDS,
+    and it sees what it just wrote. Clients without cookies still get read-your-writes from every non list
+    or retrieve endpoint.
+
+    With sqlite a replica is a read-only connection to the same file (settings.py builds them from
+    DATABASE_REPLICAS). With SQLITE_TUNED the database is in WAL mode, where readers read the last commit
+    while a writer writes, instead of the rollback journal's one lock for readers and writers alike, and
+    commits wait for one fsync of the log rather than of the database. synchronous=NORMAL can lose the
+    last commits in a power cut, never corrupt the file. mmap reads the pages without copying them.
+'''
+import contextvars
+import random
+import time
+
+from django.conf import settings
+
+from .permissions import SAFE_METHODS
+
+STICKY_COOKIE = 'primary_until'
+SQLITE_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size=268435456',     # 256 MB
+    'PRAGMA cache_size=-16000',       # 16 MB of page cache per connection
+    'PRAGMA temp_store=MEMORY',
+)
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# the replica the current request reads from, None for default
+replica = contextvars.ContextVar('replica', default=None)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        return replica.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows, a spot read from one can go into a reservation saved to default
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their tables from default
+        return False if db in settings.DATABASE_READ_REPLICAS else None
+
+
+class ReplicaMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = replica.set(None)
+        try:
+            response = self.get_response(request)
+        finally:
+            replica.reset(token)
+        if request.method not in READ_ONLY_METHODS and settings.DATABASE_READ_REPLICAS:
+            sticky = settings.REPLICA_STICKY_SECONDS
+            response.set_cookie(STICKY_COOKIE, str(int(time.time()) + sticky), max_age=sticky,
+                                httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not settings.DATABASE_READ_REPLICAS:
+            return None
+        # router.register()ed viewsets carry their {method: action} map
+        action = (getattr(view_func, 'actions', None) or {}).get(request.method.lower())
+        if action in SAFE_METHODS and not self.sticky(request):
+            replica.set(random.choice(settings.DATABASE_READ_REPLICAS))
+        return None
+
+    def sticky(self, request):
+        try:
+            return int(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+
+def tune(connection):
+    # applied to every new connection, see SQLITE_PRAGMAS
+    if connection.vendor == 'sqlite' and settings.SQLITE_TUNED:
+        # the journal mode is kept in the file, where read-only connections can't change it
+        if connection.alias not in settings.DATABASE_READ_REPLICAS:
+            connection.connection.execute('PRAGMA journal_mode=WAL')
+        for pragma in SQLITE_PRAGMAS:
+            connection.connection.execute(pragma)
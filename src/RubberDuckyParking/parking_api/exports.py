@@ -0,0 +1,252 @@
+'''
+    Streaming CSV and NDJSON exports for host accounting.
+
+    Rows are read with .iterator(chunk_size=CHUNK_SIZE) as plain values, and every chunk is encoded
+    and sent before the next one is read, so an export holds one chunk in memory however long the
+    history is. The format comes from DRF content negotiation: ?format=csv|ndjson or the Accept header.
+
+    Under WSGI the response reads its rows while the server iterates it. Under ASGI, Django 3.1 iterates
+    a StreamingHttpResponse inside the event loop, where the ORM refuses to run, so there a worker thread
+    reads and encodes the chunks and hands them over through a short queue.
+
+    Reservations come from two querysets, the current and the archived ones (archive.py), read side by
+    side and merged in order.
+'''
+import asyncio
+import csv
+import datetime
+import decimal
+import heapq
+import io
+import json
+import operator
+import queue
+import threading
+
+from django.db import connections
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BaseRenderer
+
+CHUNK_SIZE = 2000
+QUEUE_CHUNKS = 4    # chunks the worker thread may read ahead of a slow client
+
+# (column name, values() lookup)
+RESERVATION_COLUMNS = [
+    ('reservation', 'pk'),
+    ('location', 'parking_spot__location'),
+    ('location_name', 'parking_spot__location__name'),
+    ('spot', 'parking_spot'),
+    ('spot_uid', 'parking_spot__uid'),
+    ('user', 'user__username'),
+    ('start_date', 'start_date'),
+    ('end_date', 'end_date'),
+    ('price', 'parking_spot__price'),
+    ('confirmed', 'confirmed'),
+    ('canceled', 'canceled'),
+    ('created_at', 'created_at'),
+]
+TRANSACTION_COLUMNS = [
+    ('transaction', 'pk'),
+    ('date', 'date'),
+    ('location', 'location'),
+    ('location_name', 'location__name'),
+    ('spot', 'spot'),
+    ('spot_uid', 'spot__uid'),
+    ('user', 'user__username'),
+    ('user_charge', 'user_charge'),
+    ('fee_amount', 'fee_amount'),
+    ('host_income', 'host_income'),
+]
+
+
+class ExportRenderer(BaseRenderer):
+    '''
+        Lets content negotiation pick the export format. Exports stream their own body,
+        so this only renders error responses, as one line of JSON
+    '''
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class CSVRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+RENDERERS = [CSVRenderer, NDJSONRenderer]
+
+
+def parse_bound(value, name, end=False):
+    # a datetime, or a date meaning the start of that day (for to: the end of it)
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is not None:
+                moment = datetime.datetime.combine(day + datetime.timedelta(days=1) if end else day, datetime.time.min)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ValidationError({name: 'expected YYYY-MM-DD or a datetime'})
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def filter_queryset(request, queryset, date_field, location_field):
+    '''
+        possible query parameters:
+        - from, to (YYYY-MM-DD or datetimes -> rows with date_field in that range, both days included)
+        - location (int -> pk)
+    '''
+    params = request.query_params
+    if params.get('from'):
+        queryset = queryset.filter(**{date_field + '__gte': parse_bound(params['from'], 'from')})
+    if params.get('to'):
+        queryset = queryset.filter(**{date_field + '__lt': parse_bound(params['to'], 'to', end=True)})
+    location = params.get('location')
+    if location:
+        if not location.isdigit():
+            raise ValidationError({'location': 'expected a location pk'})
+        queryset = queryset.filter(**{location_field: location})
+    return queryset
+
+
+def converter(tz):
+    def convert(value):
+        if isinstance(value, datetime.datetime):
+            return timezone.localtime(value, tz).isoformat()
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        return value
+    return convert
+
+
+def csv_chunks(names, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for chunk in rows:
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')     # the header of an empty export
+
+
+def ndjson_chunks(names, rows):
+    for chunk in rows:
+        lines = [json.dumps(dict(zip(names, row)), separators=(',', ':')) for row in chunk]
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+ENCODERS = {'csv': csv_chunks, 'ndjson': ndjson_chunks}
+
+
+def read_rows(queryset, lookups):
+    '''
+        queryset can be a list of querysets ordered the same way, by exported columns in ascending
+        order, their rows are merged in that order
+    '''
+    querysets = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+    rows = [queryset.values_list(*lookups).iterator(chunk_size=CHUNK_SIZE) for queryset in querysets]
+    if len(rows) == 1:
+        return rows[0]
+    positions = [lookups.index(field) for field in querysets[0].query.order_by]
+    return heapq.merge(*rows, key=operator.itemgetter(*positions))
+
+
+def read_chunks(queryset, lookups, convert):
+    chunk = []
+    for row in read_rows(queryset, lookups):
+        chunk.append([convert(value) for value in row])
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def from_thread(produce):
+    '''
+        Runs the generator produce() in a worker thread and yields what it yields
+    '''
+    chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            for chunk in produce():
+                put(chunk)
+                if stop.is_set():
+                    break
+        except BaseException as error:
+            put(error)
+        finally:
+            connections.close_all()     # the connections of this thread only
+            put(done)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # also when the client went away and the response was closed early
+        stop.set()
+
+
+def stream(request, filename, columns, queryset):
+    '''
+        StreamingHttpResponse with the rows of queryset in the negotiated format
+    '''
+    export_format = request.accepted_renderer.format
+    names = [name for name, lookup in columns]
+    lookups = [lookup for name, lookup in columns]
+    encode = ENCODERS[export_format]
+    convert = converter(timezone.get_current_timezone())
+
+    def produce():
+        return encode(names, read_chunks(queryset, lookups, convert))
+
+    def content():
+        if in_event_loop():
+            yield from from_thread(produce)
+        else:
+            yield from produce()
+
+    response = StreamingHttpResponse(content(), content_type=f'{request.accepted_renderer.media_type}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
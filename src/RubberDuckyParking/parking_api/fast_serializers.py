@@ -0,0 +1,115 @@
+'''
+    A faster read path for list responses of nested serializers.
+
+    A ModelSerializer builds a model instance for every row and every nested relation, then asks each
+    field for its representation, one at a time. A page of reservations runs six nested serializers per row.
+    ValuesSerializer walks the fields of a serializer once and compiles a function that turns one
+    queryset.values() row (relations as columns like "parking_spot__location__name") straight into the
+    same dicts, so the rendered JSON is byte for byte what the serializer gives.
+
+    Only the field types the read serializers use are supported, and custom fields whose to_representation
+    takes the column value as read and that say so with column_representation = True. Anything else fails
+    when the function is compiled, never with different output. A SerializerMethodField needs an entry in
+    its serializer's values_method_fields, {field name: (column, function of the column value or None)};
+    columns missing from the row (an annotation the queryset doesn't have) read as None.
+'''
+import functools
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import fields, relations, serializers
+
+# field class -> function giving the representation of a value that is not None,
+# None where the value read from the database already is the representation
+CONVERTERS = {
+    fields.ReadOnlyField: None,
+    fields.IntegerField: None,
+    fields.CharField: None,
+    fields.BooleanField: None,
+    fields.FloatField: float,
+    relations.PrimaryKeyRelatedField: None,
+}
+
+
+class ValuesSerializer:
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self.columns = []
+        self.namespace = {}
+        body = self.build(serializer_class(), '')
+        source = f'def to_representation(row):\n    return {body}\n'
+        code = compile(source, f'<values {serializer_class.__name__}>', 'exec')
+        exec(code, self.namespace)
+        self.to_representation = self.namespace['to_representation']
+        self.source = source
+
+    def constant(self, value):
+        name = f'_c{len(self.namespace)}'
+        self.namespace[name] = value
+        return name
+
+    def column(self, field, prefix):
+        if field.source == '*':
+            raise ImproperlyConfigured(f'{self.serializer_class.__name__}: source="*" is not supported')
+        column = prefix + field.source.replace('.', '__')
+        if column not in self.columns:
+            self.columns.append(column)
+        return column
+
+    def converter(self, field):
+        if isinstance(field, fields.DateTimeField) or getattr(field, 'column_representation', False):
+            # timezone and format depend on the settings and the active timezone, so let the field do it,
+            # as with fields saying their to_representation takes the column value
+            return field.to_representation
+        if isinstance(field, relations.PrimaryKeyRelatedField) and field.pk_field is not None:
+            raise ImproperlyConfigured(f'{self.serializer_class.__name__}: pk_field is not supported')
+        for cls in type(field).__mro__:
+            if cls in CONVERTERS:
+                return CONVERTERS[cls]
+        raise ImproperlyConfigured(
+            f'{self.serializer_class.__name__}: no values representation for {type(field).__name__}'
+        )
+
+    def build(self, serializer, prefix):
+        # a dict display with one entry per readable field
+        method_fields = getattr(serializer, 'values_method_fields', {})
+        items = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                if name not in method_fields:
+                    raise ImproperlyConfigured(
+                        f'{type(serializer).__name__}.{name} has no values_method_fields entry'
+                    )
+                column, function = method_fields[name]
+                value = f'{self.constant(function)}(row.get({prefix + column!r}))'
+            elif isinstance(field, serializers.ListSerializer):
+                raise ImproperlyConfigured(f'{type(serializer).__name__}.{name}: many=True is not supported')
+            elif isinstance(field, serializers.BaseSerializer):
+                column = self.column(field, prefix)
+                value = f'(None if row[{column!r}] is None else {self.build(field, column + "__")})'
+            else:
+                column = self.column(field, prefix)
+                convert = self.converter(field)
+                if convert is None:
+                    value = f'row[{column!r}]'
+                else:
+                    value = f'(None if row[{column!r}] is None else {self.constant(convert)}(row[{column!r}]))'
+            items.append(f'{name!r}: {value}')
+        return '{' + ', '.join(items) + '}'
+
+    def values(self, queryset, *extra):
+        '''
+            The queryset as rows with every column the representation needs, its annotations and extra
+        '''
+        names = dict.fromkeys([*self.columns, *queryset.query.annotations, *extra])
+        return queryset.values(*names)
+
+    def many(self, rows):
+        return list(map(self.to_representation, rows))
+
+
+@functools.lru_cache(maxsize=None)
+def for_serializer(serializer_class):
+    return ValuesSerializer(serializer_class)
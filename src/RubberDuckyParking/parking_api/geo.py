@@ -0,0 +1,189 @@
+'''
+    Coordinates and proximity search for Locations.
+    Locations get a latitude/longitude (from the bundled zip code centroids if the host doesn't give one)
+    and a geohash. A geohash is a string where nearby points share a prefix, so an area can be covered by
+    a handful of prefixes, and each prefix is one range scan on the indexed geohash column.
+'''
+import csv
+import gzip
+import math
+import re
+from functools import lru_cache
+from pathlib import Path
+
+from django.db.models import Q, F, FloatField, ExpressionWrapper
+
+ZIP_CENTROIDS = Path(__file__).resolve().parent / 'data' / 'zip_centroids.csv.gz'
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9       # about 5m x 5m
+MAX_CELLS = 16              # most prefixes a search will OR together
+KM_PER_DEGREE = 111.195     # length of one degree of latitude
+MAX_RADIUS_KM = 500
+
+POINT_RE = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+ZIP_RE = re.compile(r'^\s*(\d{5})(?:-\d{4})?\s*$')
+
+
+@lru_cache(maxsize=None)
+def zip_centroids():
+    with gzip.open(ZIP_CENTROIDS, 'rt', newline='') as f:
+        return {
+            row['zip_code']: (float(row['latitude']), float(row['longitude']))
+            for row in csv.DictReader(f)
+        }
+
+
+@lru_cache(maxsize=None)
+def city_centroids():
+    # the middle of all the zip codes in a city, keyed by ('logan', 'UT')
+    points = {}
+    with gzip.open(ZIP_CENTROIDS, 'rt', newline='') as f:
+        for row in csv.DictReader(f):
+            key = (row['city'].lower(), row['state'].upper())
+            points.setdefault(key, []).append((float(row['latitude']), float(row['longitude'])))
+    return {
+        key: (sum(p[0] for p in values) / len(values), sum(p[1] for p in values) / len(values))
+        for key, values in points.items()
+    }
+
+
+def locate(zip_code='', city='', state=''):
+    '''
+        Best guess at a (lat, lng) for an address, or None
+    '''
+    match = ZIP_RE.match(zip_code or '')
+    if match and match.group(1) in zip_centroids():
+        return zip_centroids()[match.group(1)]
+    return city_centroids().get(((city or '').strip().lower(), (state or '').strip().upper()))
+
+
+def parse_point(text):
+    '''
+        Accepts "41.73,-111.83", a zip code, or "City, ST". Returns (lat, lng) or None
+    '''
+    match = POINT_RE.match(text or '')
+    if match:
+        lat, lng = float(match.group(1)), float(match.group(2))
+        if -90 <= lat <= 90 and -180 <= lng <= 180:
+            return lat, lng
+        return None
+    if ZIP_RE.match(text or ''):
+        return locate(zip_code=text)
+    if ',' in (text or ''):
+        city, state = text.rsplit(',', 1)
+        return locate(city=city, state=state)
+    return None
+
+
+def encode_geohash(lat, lng, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True     # geohash bits alternate longitude, latitude, longitude...
+    while len(geohash) < precision:
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            value_range[0] = mid
+        else:
+            bits = bits * 2
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def cell_size(precision):
+    # (height, width) in degrees of one geohash cell
+    lat_bits = 5 * precision // 2
+    lng_bits = 5 * precision - lat_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def bounding_box(lat, lng, radius_km):
+    # (south, west, north, east) around a circle
+    lat_delta = radius_km / KM_PER_DEGREE
+    lng_delta = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return (max(lat - lat_delta, -90.0), max(lng - lng_delta, -180.0),
+            min(lat + lat_delta, 90.0), min(lng + lng_delta, 180.0))
+
+
+def parse_box(text):
+    '''
+        Accepts "south,west,north,east" in degrees. Returns the four floats or None
+    '''
+    try:
+        south, west, north, east = [float(value) for value in (text or '').split(',')]
+    except ValueError:
+        return None
+    # comparisons with nan are false, so it fails these too
+    if not (-90 <= south < north <= 90 and -180 <= west < east <= 180):
+        return None
+    return south, west, north, east
+
+
+def covering_cells(south, west, north, east, max_cells=MAX_CELLS):
+    '''
+        The geohash prefixes of the finest precision where at most max_cells of them cover the box,
+        None when even the coarsest cells take more (then the box is too big for cells to narrow it down)
+    '''
+    south, north = max(south, -90.0), min(north, 90.0)
+    west, east = max(west, -180.0), min(east, 180.0)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_step, lng_step = cell_size(precision)
+        rows = int((north - south) / lat_step) + 2
+        cols = int((east - west) / lng_step) + 2
+        if rows * cols <= max_cells:
+            break
+    else:
+        return None
+    cells = set()
+    for i in range(rows):
+        lat = min(south + i * lat_step, north)
+        for j in range(cols):
+            lng = min(west + j * lng_step, east)
+            cells.add(encode_geohash(lat, lng, precision))
+    return sorted(cells)
+
+
+def cells_filter(cells, field='geohash'):
+    # geohash LIKE 'abc%' written as a range so sqlite can use the index
+    query = Q()
+    for cell in cells:
+        query |= Q(**{field + '__gte': cell, field + '__lt': cell + '{'})   # '{' sorts right after 'z'
+    return query
+
+
+def box_filter(south, west, north, east, prefix=''):
+    query = Q(**{prefix + 'latitude__gte': south, prefix + 'latitude__lte': north,
+                 prefix + 'longitude__gte': west, prefix + 'longitude__lte': east})
+    cells = covering_cells(south, west, north, east)
+    if cells is not None:
+        query &= cells_filter(cells, prefix + 'geohash')
+    return query
+
+
+def distance_expression(lat, lng, prefix=''):
+    '''
+        Squared distance in degrees of latitude (flat earth approximation, fine under a few hundred km).
+        Plain arithmetic so the database can sort by it without trig functions
+    '''
+    lng_scale = math.cos(math.radians(lat))
+    d_lat = F(prefix + 'latitude') - lat
+    d_lng = (F(prefix + 'longitude') - lng) * lng_scale
+    return ExpressionWrapper(d_lat * d_lat + d_lng * d_lng, output_field=FloatField())
+
+
+def distance_sq_to_km(distance_sq):
+    return math.sqrt(distance_sq) * KM_PER_DEGREE
+
+
+def km_to_distance_sq(km):
+    return (km / KM_PER_DEGREE) ** 2
@@ -0,0 +1,182 @@
+'''
+    Sized variants of uploaded images, so search results and profiles don't send camera originals.
+
+    Every LocationImage.image and BaseUser.avatar gets a few JPEGs of fixed widths (SOURCES), made by
+    IMAGE_WORKERS background threads once the upload is committed (signals.py). Pillow does its decoding,
+    resizing and encoding without holding the GIL, so the threads run them in parallel. JPEGs are decoded
+    at the smallest 1/2, 1/4 or 1/8 scale still larger than the biggest variant, turned upright by their
+    EXIF orientation, and saved without their metadata (phone cameras put GPS positions in there).
+
+    The variants of an image are stored under a hash of its content, which the model keeps in a field of
+    its own once they exist. Their URLs never show different bytes, so serve_variant() lets clients and
+    proxies keep them for a year. Until they exist the field is empty, the serializers give None and clients
+    show the original. Images uploaded before this, or whose variants failed, get them from the
+    make_variants command.
+'''
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.views import static
+from PIL import Image, ImageOps
+
+from .models import BaseUser, LocationImage
+
+# model -> (image field, field keeping the key of its variants, widths, whether variants are cropped square)
+SOURCES = {
+    LocationImage: ('image', 'variants', (320, 640, 1280), False),
+    BaseUser: ('avatar', 'avatar_variants', (64, 128, 256), True),
+}
+VARIANT_DIR = 'variants'
+QUALITY = 80
+KEY_LENGTH = 24
+MAX_AGE = 365 * 24 * 60 * 60    # seconds, variant URLs change with the content
+
+logger = logging.getLogger(__name__)
+pool_lock = threading.Lock()
+pool = None
+
+
+def variant_path(key, width):
+    return f'{VARIANT_DIR}/{key}/{width}.jpg'
+
+
+def variant_urls(model, key):
+    '''
+        [{width, url}] of the variants with that key, smallest first, None when there are none yet
+    '''
+    if not key:
+        return None
+    field, key_field, widths, square = SOURCES[model]
+    storage = model._meta.get_field(field).storage
+    return [{'width': width, 'url': storage.url(variant_path(key, width))} for width in widths]
+
+
+def flatten(image):
+    # RGB, transparent parts on white
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render(data, widths, square):
+    '''
+        {width: JPEG bytes} of the image data, fitted into width x width boxes (cropped to fill them when
+        square) and never enlarged
+    '''
+    largest = max(widths)
+    with Image.open(io.BytesIO(data)) as original:
+        original.draft('RGB', (largest, largest))
+        image = flatten(ImageOps.exif_transpose(original))
+    variants = {}
+    # each variant is resized from the next bigger one, which is much smaller than the original
+    for width in sorted(widths, reverse=True):
+        if square:
+            image = ImageOps.fit(image, (min(width, *image.size),) * 2, Image.LANCZOS)
+        else:
+            image = image.copy()
+            image.thumbnail((width, width), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+        variants[width] = buffer.getvalue()
+    return variants
+
+
+def make_variants(model, pk, name=None):
+    '''
+        Makes the variants of the image of row pk, name is the image they're made for (the row's current
+        one when None). Returns their key, or None when the row has moved on to another image
+    '''
+    field, key_field, widths, square = SOURCES[model]
+    if name is None:
+        name = model.objects.filter(pk=pk).values_list(field, flat=True).first()
+    if not name:
+        return None
+    storage = model._meta.get_field(field).storage
+    with storage.open(name) as source:
+        data = source.read()
+    key = hashlib.sha1(model._meta.label_lower.encode() + data).hexdigest()[:KEY_LENGTH]
+    # the same content has the same variants, which may be there from another upload already
+    if not all(storage.exists(variant_path(key, width)) for width in widths):
+        for width, variant in render(data, widths, square).items():
+            path = variant_path(key, width)
+            storage.delete(path)    # left over from an attempt that failed half way
+            storage.save(path, ContentFile(variant))
+    with transaction.atomic():
+        instance = model.objects.filter(pk=pk, **{field: name}).first()
+        if instance is None:
+            return None
+        setattr(instance, key_field, key)
+        # a save, so signals.py drops cached copies of the row
+        instance.save(update_fields=[key_field])
+    return key
+
+
+def run(model, pk, name):
+    try:
+        make_variants(model, pk, name)
+    except Exception:
+        logger.exception('making the variants of %s %s failed', model._meta.label, pk)
+    finally:
+        connections.close_all()     # the connections of this worker thread
+
+
+def schedule(model, pk, name):
+    '''
+        Has the variants of the image made in the background, or right away when IMAGE_WORKERS is 0
+    '''
+    global pool
+    if not settings.IMAGE_WORKERS:
+        make_variants(model, pk, name)
+        return
+    with pool_lock:
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix='images')
+    pool.submit(run, model, pk, name)
+
+
+def note_image(instance, update_fields=None):
+    '''
+        Before a save: whether it stores another image than the row has, whose variants are then still
+        to be made, see after_save()
+    '''
+    field, key_field, widths, square = SOURCES[type(instance)]
+    instance._new_image = False
+    if update_fields is not None and field not in update_fields:
+        return
+    image = getattr(instance, field)
+    # an upload still has the name it came with, which can be the stored one until the storage renames it
+    changed = bool(image) and not image._committed
+    if not changed:
+        stored = None
+        if not instance._state.adding:
+            stored = type(instance).objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+        changed = (image.name or '') != (stored or '')
+    if changed:
+        setattr(instance, key_field, '')
+        instance._new_image = True
+
+
+def after_save(instance):
+    if not getattr(instance, '_new_image', False):
+        return
+    instance._new_image = False
+    # the name the file was stored under, which the storage can have changed while saving
+    name = getattr(instance, SOURCES[type(instance)][0]).name
+    if name:
+        model, pk = type(instance), instance.pk
+        transaction.on_commit(lambda: schedule(model, pk, name))
+
+
+def serve_variant(request, path):
+    response = static.serve(request, f'{VARIANT_DIR}/{path}', document_root=settings.MEDIA_ROOT)
+    response['Cache-Control'] = f'public, max-age={MAX_AGE}, immutable'
+    return response
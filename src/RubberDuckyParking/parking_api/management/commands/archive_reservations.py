@@ -0,0 +1,20 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from ... import archive
+
+
+class Command(BaseCommand):
+    help = 'Moves reservations that ended, or were canceled, a while ago to the reservation archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=archive.ARCHIVE_AFTER.days,
+                            help='archive reservations that ended or were canceled more than this many days ago')
+        parser.add_argument('--chunk-size', type=int, default=archive.CHUNK_SIZE, help='reservations per transaction')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        moved = archive.move(timedelta(days=options['days']), options['chunk_size'])
+        self.stdout.write(f'archived {moved} reservations in {time.perf_counter() - start:.1f}s')
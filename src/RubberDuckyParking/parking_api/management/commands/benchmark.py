@@ -0,0 +1,751 @@
+import io
+import multiprocessing
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+from django.db.models import Q, Count, Sum
+from django.db.models.functions import TruncMonth
+from django.test.utils import override_settings
+from django.utils import timezone
+from PIL import Image, ImageFilter, ImageOps
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ...models import (
+    ArchivedReservation, BaseUser, Host, Attendant, Location, ParkingSize, ParkingSpot, PricingRule, Reservation,
+    Transactions, Vehicle,
+)
+from ... import (
+    archive, search, availability, checkin, checkout, databases, fast_serializers, images, occupancy, passwords, pricing,
+    rollups,
+)
+from ...serializers import ParkingSpotSerializer, ReservationSerializer
+from ...views import (
+    LocationViewSet, ObtainAuthToken, ParkingSizeViewSet, ParkingSpotViewSet, ReservationViewSet, TransactionViewSet,
+)
+
+WORDS = [
+    'stadium', 'church', 'bakery', 'driveway', 'garage', 'campus', 'arena', 'market', 'library', 'temple',
+    'museum', 'park', 'plaza', 'depot', 'harbor', 'canyon', 'summit', 'valley', 'meadow', 'ridge',
+]
+CITIES = [
+    ('Logan', 'UT'), ('Provo', 'UT'), ('Ogden', 'UT'), ('Boise', 'ID'), ('Denver', 'CO'),
+    ('Reno', 'NV'), ('Malibu', 'CA'), ('Phoenix', 'AZ'), ('Laramie', 'WY'), ('Missoula', 'MT'),
+]
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ten', 'bo', 'su', 'vel', 'dor', 'an', 'pi', 'gus', 'ne', 'tor', 'wil']
+
+
+def word():
+    # made up street and business names, so the vocabulary is large like real addresses
+    return ''.join(random.choice(SYLLABLES) for i in range(random.randint(2, 4)))
+
+
+def timed(fn, repeat):
+    # returns the median run time in milliseconds
+    runs = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append((time.perf_counter() - start) * 1000)
+    return statistics.median(runs)
+
+
+class Command(BaseCommand):
+    help = 'Times hot code paths against generated data. Everything it writes is rolled back or deleted'
+
+    scenarios = {
+        'search': 'bench_search',
+        'availability': 'bench_availability',
+        'bulk_spots': 'bench_bulk_spots',
+        'checkin': 'bench_checkin',
+        'serializers': 'bench_serializers',
+        'export': 'bench_export',
+        'earnings': 'bench_earnings',
+        'occupancy': 'bench_occupancy',
+        'pricing': 'bench_pricing',
+        'checkout': 'bench_checkout',
+        'images': 'bench_images',
+        'logins': 'bench_logins',
+        'mixed': 'bench_mixed',
+        'archive': 'bench_archive',
+    }
+    # scenarios whose rows other threads have to see, so they commit them and delete them afterwards
+    committing = {'checkout', 'logins', 'mixed'}
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(self.scenarios))
+        parser.add_argument('--size', type=int, default=None, help='number of rows to generate')
+        parser.add_argument('--repeat', type=int, default=20, help='runs per timing, the median is reported')
+        parser.add_argument('--seed', type=int, default=3450)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        scenario = getattr(self, self.scenarios[options['scenario']])
+        if options['scenario'] in self.committing:
+            scenario(options['size'], options['repeat'])
+            return
+        with transaction.atomic():
+            scenario(options['size'], options['repeat'])
+            transaction.set_rollback(True)
+
+    def report(self, label, ms):
+        self.stdout.write(f'{label:<45} {ms:10.2f} ms')
+
+    def make_host(self):
+        user = BaseUser.objects.create(username=f'benchmark-{time.time_ns()}')
+        return Host.objects.create(user=user)
+
+    def bench_search(self, size, repeat):
+        size = size or 100000
+        host = self.make_host()
+        locations = []
+        for i in range(size):
+            city, state = random.choice(CITIES)
+            locations.append(Location(
+                name=f'{word().title()} {random.choice(WORDS)} lot',
+                description=' '.join([word() for j in range(4)] + random.sample(WORDS, 2)),
+                address=f'{random.randint(1, 9999)} {word().title()} Way',
+                city=city, zip_code=f'{random.randint(10000, 99999)}', state=state, host=host,
+            ))
+        Location.objects.bulk_create(locations, batch_size=5000)
+        search.rebuild_index()
+        self.stdout.write(f'{size} locations')
+
+        def like_scan(query):
+            # the old ParkingSpotViewSet filter, which returned every match unranked
+            contains_query = Q()
+            for term in query.split(' '):
+                contains_query |= (Q(name__icontains=term) | Q(description__icontains=term) |
+                                   Q(address__icontains=term) | Q(state__icontains=term) | Q(city__icontains=term))
+            return list(Location.objects.filter(contains_query).values_list('pk', flat=True))
+
+        for query in ['kalomi', 'veldor stadium', 'Logan']:
+            matches = len(like_scan(query))
+            self.report(f'"{query}" icontains scan ({matches} rows)', timed(lambda: like_scan(query), repeat))
+            self.report(f'"{query}" fts5 ranked',
+                        timed(lambda: search.search_locations(query), repeat))
+
+    def make_spots(self, count, host=None):
+        host = host or self.make_host()
+        location = Location.objects.create(name='Benchmark lot', description='', address='1 Main St',
+                                           city='Logan', state='UT', zip_code='84321', host=host)
+        size = ParkingSize.objects.create(name='Benchmark', description='', min_width=9, min_length=18)
+        ParkingSpot.objects.bulk_create(
+            [ParkingSpot(parking_size=size, location=location, owner=host, uid=i) for i in range(count)],
+            batch_size=5000
+        )
+        return list(ParkingSpot.objects.filter(location=location))
+
+    def bench_availability(self, size, repeat):
+        size = size or 5000
+        spots = self.make_spots(size)
+        now = timezone.now()
+        reservations = []
+        for spot in spots:
+            start = now + timedelta(hours=random.randint(0, 24))
+            for i in range(20):     # back to back bookings with gaps over the next weeks
+                end = start + timedelta(hours=random.randint(1, 8))
+                reservations.append(Reservation(parking_spot=spot, start_date=start, end_date=end))
+                start = end + timedelta(hours=random.randint(0, 24))
+        Reservation.objects.bulk_create(reservations, batch_size=5000)
+        self.stdout.write(f'{size} spots, {len(reservations)} reservations')
+
+        start = now + timedelta(days=3)
+        end = start + timedelta(hours=3)
+        availability.index.reset()
+        self.report('index load', timed(availability.index.reload, 1))
+        candidates = ParkingSpot.objects.all()
+        in_sql = candidates.exclude(pk__in=availability.conflicting_reservations(start, end).values('parking_spot_id'))
+        free = len(availability.free_spots(candidates, start, end))
+        self.report(f'free spots in sql ({free} free)', timed(lambda: list(in_sql.values_list('pk', flat=True)), repeat))
+        self.report('free spots from the index', timed(
+            lambda: list(availability.free_spots(candidates, start, end).values_list('pk', flat=True)), repeat
+        ))
+
+    def bench_bulk_spots(self, size, repeat):
+        size = size or 400
+        host = self.make_host()
+        location = Location.objects.create(name='Benchmark lot', description='', address='1 Main St',
+                                           city='Logan', state='UT', zip_code='84321', host=host)
+        parking_size = ParkingSize.objects.create(name='Benchmark', description='', min_width=9, min_length=18)
+        items = [{'uid': i, 'parking_size': parking_size.pk, 'location': location.pk, 'price': 3.0}
+                 for i in range(size)]
+        factory = APIRequestFactory()
+
+        def call(action, data):
+            request = factory.post('/api/parking-spots/', data, format='json')
+            force_authenticate(request, user=host.user)
+            response = ParkingSpotViewSet.as_view({'post': action})(request)
+            assert response.status_code in (200, 201), response.data
+
+        self.stdout.write(f'{size} spots per lot')
+        self.report('one request per spot', timed(lambda: [call('post', dict(item)) for item in items], repeat))
+        self.report('one bulk request', timed(lambda: call('bulk', items), repeat))
+        pks = list(ParkingSpot.objects.filter(owner=host).values_list('pk', flat=True)[:size])
+        changes = [{'pk': pk, 'price': 4.0} for pk in pks]
+        self.report('bulk request editing every spot', timed(lambda: call('bulk', changes), repeat))
+
+    def bench_checkin(self, size, repeat):
+        size = size or 20000
+        host = self.make_host()
+        attendant = Attendant.objects.create(user=BaseUser.objects.create(username=f'benchmark-{time.time_ns()}'),
+                                             boss=host)
+        spots = self.make_spots(200, host=host)
+        now = timezone.now()
+        Reservation.objects.bulk_create([
+            Reservation(parking_spot=random.choice(spots), start_date=now + timedelta(hours=i % 48),
+                        end_date=now + timedelta(hours=i % 48 + 3))
+            for i in range(size)
+        ], batch_size=5000)
+        reservations = list(Reservation.objects.filter(parking_spot__owner=host).select_related('parking_spot'))
+        tokens = []
+        for reservation in reservations:
+            token, reservation.checkin_code = checkin.make_token(reservation)
+            tokens.append(token)
+        Reservation.objects.bulk_update(reservations, ['checkin_code'], batch_size=1000)
+        self.stdout.write(f'{size} reservations with check-in tokens')
+
+        key = checkin.host_key(host.pk)
+        factory = APIRequestFactory()
+        view = ReservationViewSet.as_view({'post': 'checkin'})
+        codes = [checkin.read_token(token)['code'] for token in tokens]
+
+        def scan():
+            request = factory.post('/api/reservations/checkin/', {'token': random.choice(tokens)}, format='json')
+            force_authenticate(request, user=attendant.user)
+            response = view(request)
+            assert response.status_code == 200, response.data
+
+        self.report('verify signature offline', timed(lambda: checkin.read_token(random.choice(tokens), key=key), repeat))
+        self.report('lookup by checkin_code (unique index)',
+                    timed(lambda: Reservation.objects.filter(checkin_code=random.choice(codes)).first(), repeat))
+        self.report('same lookup as a table scan',
+                    timed(lambda: Reservation.objects.filter(checkin_code__iexact=random.choice(codes)).first(), repeat))
+        ms = timed(scan, repeat)
+        self.report('check-in request', ms)
+        self.stdout.write(f'about {60000 / ms:,.0f} check-ins per minute on one worker')
+
+    def bench_serializers(self, size, repeat):
+        size = size or 500
+        host = self.make_host()
+        renter = BaseUser.objects.create(username=f'benchmark-{time.time_ns()}')
+        spots = self.make_spots(size, host=host)
+        now = timezone.now()
+        Reservation.objects.bulk_create([
+            Reservation(parking_spot=spot, user=renter, start_date=now + timedelta(hours=i),
+                        end_date=now + timedelta(hours=i + 2))
+            for i, spot in enumerate(spots)
+        ], batch_size=5000)
+        self.stdout.write(f'{size} spots, {size} reservations')
+
+        for serializer_class, queryset in [
+            (ParkingSpotSerializer, ParkingSpot.objects.filter(owner=host)),
+            (ReservationSerializer, Reservation.objects.filter(user=renter)),
+        ]:
+            queryset = serializer_class.setup_eager_loading(queryset)
+            fast = fast_serializers.for_serializer(serializer_class)
+            name = serializer_class.__name__
+            self.report(f'{name} on instances', timed(lambda: serializer_class(queryset.all(), many=True).data, repeat))
+            self.report(f'{name} on .values() rows', timed(lambda: fast.many(fast.values(queryset.all())), repeat))
+
+        factory = APIRequestFactory()
+
+        def call(viewset, action, user, fast_read):
+            request = factory.get('/', {'page_size': 100}, HTTP_HOST='localhost')
+            force_authenticate(request, user=user)
+            return viewset.as_view({'get': action}, fast_read=fast_read)(request).render().content
+
+        for viewset, action, user in [(ParkingSpotViewSet, 'myspots', host.user),
+                                      (ReservationViewSet, 'myreservations', host.user),
+                                      (ReservationViewSet, 'list', renter)]:
+            assert call(viewset, action, user, False) == call(viewset, action, user, True)
+            for fast_read in (False, True):
+                self.report(f'{viewset.__name__}.{action}{" fast_read" if fast_read else ""}',
+                            timed(lambda: call(viewset, action, user, fast_read), repeat))
+
+    def bench_export(self, size, repeat):
+        size = size or 20000
+        host = self.make_host()
+        spots = self.make_spots(100, host=host)
+        now = timezone.now()
+        Reservation.objects.bulk_create([
+            Reservation(parking_spot=spots[i % 100], start_date=now + timedelta(hours=i // 100),
+                        end_date=now + timedelta(hours=i // 100 + 1))
+            for i in range(size)
+        ], batch_size=5000)
+        self.stdout.write(f'{size} reservations')
+        factory = APIRequestFactory()
+
+        def export(export_format):
+            request = factory.get('/', {'format': export_format})
+            force_authenticate(request, user=host.user)
+            # the router applies the action's renderer_classes, as_view needs them passed
+            response = ReservationViewSet.as_view({'get': 'export'}, **ReservationViewSet.export.kwargs)(request)
+            assert response.streaming, response.data
+            return sum(len(chunk) for chunk in response)
+
+        def json_list():
+            request = factory.get('/')
+            force_authenticate(request, user=host.user)
+            return len(ReservationViewSet.as_view({'get': 'myreservations'})(request).render().content)
+
+        for label, fn in [('csv export', lambda: export('csv')), ('ndjson export', lambda: export('ndjson')),
+                          ('myreservations json list', json_list)]:
+            ms = timed(fn, repeat)
+            # tracing slows everything down, so memory is measured on a separate run
+            tracemalloc.start()
+            length = fn()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.report(f'{label} ({length / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB)', ms)
+
+    def bench_earnings(self, size, repeat):
+        size = size or 200000
+        host = self.make_host()
+        renter = BaseUser.objects.create(username=f'benchmark-{time.time_ns()}')
+        vehicle = Vehicle.objects.create(user=renter, make='Ford', model='T', color='black', license='DUCKY')
+        spots = self.make_spots(50, host=host)
+        now = timezone.now()
+        Transactions.objects.bulk_create([
+            Transactions(date=now - timedelta(minutes=10 * i), user_charge=8, fee_amount=0.8, host_income=7.2,
+                         user=renter, location=spots[0].location, spot=random.choice(spots), vehicle=vehicle,
+                         hash_str='')
+            for i in range(size)
+        ], batch_size=5000)
+        self.stdout.write(f'{size} transactions over {size // 144} days')
+        self.report('rebuild_rollups', timed(rollups.rebuild, 1))
+
+        def aggregate():
+            # what a dashboard without rollups runs: the last 12 months from the transactions table
+            return list(Transactions.objects.filter(spot__owner=host, date__gte=now - timedelta(days=366))
+                        .annotate(month=TruncMonth('date')).values('month')
+                        .annotate(count=Count('pk'), income=Sum('host_income')).order_by('month'))
+
+        factory = APIRequestFactory()
+
+        def earnings(period):
+            request = factory.get('/', {'period': period})
+            force_authenticate(request, user=host.user)
+            response = TransactionViewSet.as_view({'get': 'earnings'})(request)
+            assert response.status_code == 200, response.data
+
+        self.report('aggregate 12 months of transactions', timed(aggregate, repeat))
+        self.report('earnings endpoint, 12 months', timed(lambda: earnings('month'), repeat))
+        self.report('earnings endpoint, 30 days', timed(lambda: earnings('day'), repeat))
+        spot = spots[0]
+        self.report('one transaction saved with its rollups', timed(lambda: Transactions.objects.create(
+            date=now, user_charge=8, fee_amount=0.8, host_income=7.2, user=renter, location=spot.location,
+            spot=spot, vehicle=vehicle, hash_str=''), repeat))
+
+    def bench_occupancy(self, size, repeat):
+        size = size or 200000
+        host = self.make_host()
+        spots = self.make_spots(100, host=host)
+        start = timezone.now() - timedelta(days=365)
+
+        def reservations(count):
+            return [Reservation(parking_spot=random.choice(spots),
+                                start_date=start + timedelta(minutes=random.randrange(365 * 24 * 60)),
+                                end_date=start + timedelta(minutes=random.randrange(365 * 24 * 60)))
+                    for i in range(count)]
+
+        booked = reservations(size)
+        for reservation in booked:
+            reservation.end_date = reservation.start_date + timedelta(minutes=random.randint(30, 600))
+        Reservation.objects.bulk_create(booked, batch_size=5000)
+        self.stdout.write(f'{size} reservations on {len(spots)} spots over a year')
+
+        tz = timezone.get_default_timezone()
+        sample = list(Reservation.objects.values_list('parking_spot', 'start_date', 'end_date')[:10000])
+
+        def python_loop():
+            # what a straightforward version does: walk every reservation hour by hour
+            minutes = {}
+            for spot, begin, end in sample:
+                moment = timezone.localtime(begin, tz)
+                end = timezone.localtime(end, tz)
+                while moment < end:
+                    hour_end = min(moment.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1), end)
+                    key = (spot, moment.weekday() * 24 + moment.hour)
+                    minutes[key] = minutes.get(key, 0) + (hour_end - moment).total_seconds() / 60
+                    moment = hour_end
+
+        ms = timed(python_loop, 1)
+        self.report(f'python hour loop, {len(sample)} reservations', ms)
+        self.stdout.write(f'  about {ms * size / len(sample):,.0f} ms for all of them')
+        self.report('refresh_occupancy --full', timed(lambda: occupancy.refresh(full=True), 1))
+
+        def add_reservations():
+            new = reservations(100)
+            for reservation in new:
+                reservation.start_date = timezone.now() + timedelta(hours=random.randint(1, 100))
+                reservation.end_date = reservation.start_date + timedelta(hours=2)
+            Reservation.objects.bulk_create(new)
+            occupancy.refresh()
+
+        self.report('100 new reservations, incremental refresh', timed(add_reservations, repeat))
+
+        factory = APIRequestFactory()
+        view = LocationViewSet.as_view({'get': 'occupancy'})
+
+        def heatmap(params):
+            request = factory.get('/', params)
+            force_authenticate(request, user=host.user)
+            response = view(request, pk=spots[0].location_id)
+            assert response.status_code == 200, response.data
+
+        self.report('occupancy endpoint, location', timed(lambda: heatmap({}), repeat))
+        self.report('occupancy endpoint, one spot', timed(lambda: heatmap({'spot': spots[0].pk}), repeat))
+
+    def bench_pricing(self, size, repeat):
+        size = size or 50000
+        host = self.make_host()
+        parking_size = ParkingSize.objects.create(name='Benchmark', description='', min_width=9, min_length=18)
+        Location.objects.bulk_create([
+            Location(name=f'Benchmark lot {i}', description='', address='1 Main St', city='Logan', state='UT',
+                     zip_code='84321', host=host)
+            for i in range(size // 10)
+        ], batch_size=5000)
+        locations = list(Location.objects.filter(host=host).values_list('pk', flat=True))
+        ParkingSpot.objects.bulk_create([
+            ParkingSpot(parking_size=parking_size, location_id=locations[i // 10], owner=host, uid=i,
+                        price=random.choice([2.0, 3.5, 5.0, 8.0]))
+            for i in range(size)
+        ], batch_size=5000)
+        spots = list(ParkingSpot.objects.filter(owner=host).values_list('pk', 'location'))
+
+        # evening rates at most lots, day caps at some, a game at the stadium lots, a few spots of their own
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+        rules = []
+        for location in locations:
+            rules.append(PricingRule(location_id=location, kind='hours', start_hour=17, end_hour=23, multiplier=1.5))
+            if random.random() < 0.3:
+                rules.append(PricingRule(location_id=location, kind='day_cap', amount=random.choice([20, 30])))
+            if random.random() < 0.05:
+                rules.append(PricingRule(location_id=location, kind='event', multiplier=3.0, amount=10,
+                                         starts_at=start + timedelta(hours=30), ends_at=start + timedelta(hours=34)))
+        for pk, location in random.sample(spots, len(spots) // 20):
+            rules.append(PricingRule(location_id=location, spot_id=pk, kind='hours', days=0b1100000, multiplier=1.25))
+        PricingRule.objects.bulk_create(rules, batch_size=5000)
+        self.stdout.write(f'{size} spots at {len(locations)} locations, {len(rules)} pricing rules')
+
+        queryset = ParkingSpot.objects.filter(owner=host)
+        sample = list(queryset[:2000])
+        rules_of = {}
+        for rule in PricingRule.objects.filter(location__host=host):
+            rules_of.setdefault(rule.location_id, []).append(rule)
+
+        def python_loop(end):
+            # what pricing each spot on its own looks like: walk the window hour by hour per spot
+            tz = timezone.get_default_timezone()
+            for spot in sample:
+                rules = [rule for rule in rules_of.get(spot.location_id, []) if rule.spot_id in (None, spot.pk)]
+                caps = [rule.amount for rule in rules if rule.kind == 'day_cap']
+                per_day = {}
+                moment = start
+                while moment < end:
+                    local = timezone.localtime(moment, tz)
+                    factor = 1.0
+                    for rule in rules:
+                        if rule.kind == 'hours' and rule.start_hour <= local.hour < rule.end_hour \
+                                and rule.days >> local.weekday() & 1:
+                            factor *= rule.multiplier
+                        elif rule.kind == 'event' and rule.starts_at <= moment < rule.ends_at:
+                            factor *= rule.multiplier
+                    per_day[local.date()] = per_day.get(local.date(), 0) + spot.price * factor
+                    moment += timedelta(hours=1)
+                sum(min([charge, *caps]) for charge in per_day.values())
+
+        factory = APIRequestFactory()
+        view = ParkingSpotViewSet.as_view({'get': 'quote'})
+
+        def quote_endpoint(end):
+            request = factory.get('/', {'available_from': start.isoformat(), 'available_to': end.isoformat()})
+            response = view(request)
+            assert response.status_code == 200, response.data
+
+        for hours in (3, 48, 24 * 7):
+            end = start + timedelta(hours=hours)
+            ms = timed(lambda: python_loop(end), 1)
+            self.report(f'{hours}h window, python loop x{len(sample)} spots', ms)
+            self.stdout.write(f'  about {ms * size / len(sample):,.0f} ms for all of them')
+            self.report(f'{hours}h window, quote() for {size} spots', timed(lambda: pricing.quote(queryset, start, end), repeat))
+            self.report(f'{hours}h window, quote endpoint', timed(lambda: quote_endpoint(end), repeat))
+
+    def bench_checkout(self, size, repeat):
+        size = size or 2000
+        host = self.make_host()
+        try:
+            self.checkouts(host, size)
+        finally:
+            BaseUser.objects.filter(username__startswith='benchmark-').delete()
+
+    def checkouts(self, host, size):
+        # worker processes like a server's, each with its own connection, all booking the same 100 spots
+        spots = [spot.pk for spot in self.make_spots(100, host=host)]
+        renters = []
+        for i in range(16):
+            user = BaseUser.objects.create(username=f'benchmark-{time.time_ns()}')
+            renters.append((user, Vehicle.objects.create(user=user, make='Ford', model='T', color='black',
+                                                         license='DUCKY').pk))
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+        view = ReservationViewSet.as_view({'post': 'checkout'})
+
+        def work(i, count, day, results):
+            user, vehicle = renters[i]
+            generator = random.Random(i)
+            factory = APIRequestFactory()
+            counts = {201: 0, 400: 0}
+            for j in range(count):
+                # random 1-3 hour windows of one day, about half of them find the spot taken
+                begin = start + timedelta(days=day, hours=generator.randrange(24))
+                request = factory.post('/', {
+                    'parking_spot': generator.choice(spots), 'vehicle': vehicle, 'start_date': begin.isoformat(),
+                    'end_date': (begin + timedelta(hours=generator.randint(1, 3))).isoformat(),
+                }, format='json')
+                force_authenticate(request, user=user)
+                status_code = view(request).status_code
+                counts[status_code] = counts.get(status_code, 0) + 1
+            results.put(counts)
+
+        context = multiprocessing.get_context('fork')
+        for day, processes in enumerate([1, 2, 4, 8, 16]):
+            connections.close_all()     # not shared with the children
+            results = context.Queue()
+            workers = [context.Process(target=work, args=(i, size // processes, day, results))
+                       for i in range(processes)]
+            began = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            counts = {}
+            for worker in workers:
+                for status_code, count in results.get().items():
+                    counts[status_code] = counts.get(status_code, 0) + count
+            for worker in workers:
+                worker.join()
+            seconds = time.perf_counter() - began
+            assert set(counts) <= {201, 400}, counts
+            self.stdout.write(f'{processes:>2} processes: {counts[201]} booked, {counts[400]} refused, '
+                              f'{sum(counts.values()) / seconds:,.0f} checkouts/s, {counts[201] / seconds:,.0f} bookings/s')
+
+        overlaps = 0
+        for spot in spots:
+            windows = sorted(Reservation.objects.filter(parking_spot=spot).values_list('start_date', 'end_date'))
+            overlaps += sum(end > next_start for (begin, end), (next_start, next_end) in zip(windows, windows[1:]))
+        self.stdout.write(f'double bookings: {overlaps}')
+
+    def bench_images(self, size, repeat):
+        # a 12 megapixel phone picture: smooth shapes with sensor noise, which is what makes them big
+        width, height = 4032, 3024
+        shapes = Image.merge('RGB', [Image.radial_gradient('L'), Image.linear_gradient('L'),
+                                     Image.linear_gradient('L').rotate(90)]).resize((width, height))
+        noise = Image.merge('RGB', [Image.effect_noise((width, height), 60) for i in range(3)])
+        picture = Image.blend(shapes, noise, 0.3)
+        buffer = io.BytesIO()
+        picture.save(buffer, 'JPEG', quality=92)
+        data = buffer.getvalue()
+        self.stdout.write(f'original: {width}x{height} JPEG, {len(data) / 1e6:.1f} MB')
+
+        for model, (field, key_field, widths, square) in images.SOURCES.items():
+            variants = images.render(data, widths, square)
+            sizes = ', '.join(f'{w}: {len(variant) / 1e3:.0f} kB' for w, variant in variants.items())
+            self.stdout.write(f'{model.__name__} variants: {sizes}')
+
+        widths = images.SOURCES[images.LocationImage][2]
+
+        def naive():
+            # what a straightforward version does: full decode, every size from the original
+            with Image.open(io.BytesIO(data)) as original:
+                image = ImageOps.exif_transpose(original).convert('RGB')
+            for w in widths:
+                copy = image.copy()
+                copy.thumbnail((w, w), Image.LANCZOS)
+                copy.save(io.BytesIO(), 'JPEG', quality=images.QUALITY, optimize=True, progressive=True)
+
+        repeat = min(repeat, 5)
+        self.report('full decode, each size from the original', timed(naive, repeat))
+        self.report('images.render (draft decode, chained sizes)',
+                    timed(lambda: images.render(data, widths, False), repeat))
+
+    def bench_logins(self, size, repeat):
+        try:
+            self.logins(size or 16)
+        finally:
+            BaseUser.objects.filter(username__startswith='benchmark-').delete()
+
+    def logins(self, threads):
+        # a burst of logins on server threads, and how long a cheap read takes meanwhile
+        user = BaseUser.objects.create(username=f'benchmark-{time.time_ns()}')
+        user.set_password('benchmark password')
+        user.save()
+        ParkingSize.objects.get_or_create(name='standard', defaults={
+            'description': 'standard', 'min_width': 9, 'min_length': 18})
+        factory = APIRequestFactory()
+        login_view = ObtainAuthToken.as_view()
+        sizes_view = ParkingSizeViewSet.as_view({'get': 'list'})
+        seconds = 5
+
+        def burst():
+            stop = threading.Event()
+            statuses = []
+
+            def log_in():
+                while not stop.is_set():
+                    request = factory.post('/', {'username': user.username, 'password': 'benchmark password'})
+                    response = login_view(request)
+                    statuses.append(response.status_code)
+                    if response.status_code == 503:
+                        stop.wait(float(response['Retry-After']))   # as a client would
+                connections.close_all()
+
+            workers = [threading.Thread(target=log_in) for i in range(threads)]
+            for worker in workers:
+                worker.start()
+            reads = []
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                start = time.perf_counter()
+                sizes_view(factory.get('/'))
+                reads.append((time.perf_counter() - start) * 1000)
+                time.sleep(0.01)
+            stop.set()
+            for worker in workers:
+                worker.join()
+            reads.sort()
+            self.stdout.write(f'  {statuses.count(200) / seconds:5.1f} logins/s, {statuses.count(503)} turned away, '
+                              f'parking sizes read p50 {reads[len(reads) // 2]:.1f} ms, '
+                              f'p99 {reads[int(len(reads) * 0.99)]:.1f} ms')
+
+        passwords.hash_password('start the pool')
+        self.stdout.write(f'{threads} threads logging in for {seconds}s')
+        for workers in (0, 1, 2):
+            self.stdout.write('hashing in the request threads' if not workers else f'{workers} hashing processes')
+            with override_settings(PASSWORD_WORKERS=workers, PASSWORD_QUEUE=threads // 2):
+                passwords.pool.executor = None   # one with this many workers
+                burst()
+
+    def bench_mixed(self, size, repeat):
+        try:
+            self.mixed(size or 500)
+        finally:
+            BaseUser.objects.filter(username__startswith='benchmark-').delete()
+
+    def mixed(self, spot_count):
+        # reader and writer processes on the database file at once, with each sqlite profile
+        spots = [spot.pk for spot in self.make_spots(spot_count)]
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+        seconds, readers, writers = 5, 6, 2
+        with connections['default'].cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+        default = connections['default'].settings_dict
+        # read-only connections to the same file, as settings.py makes of DATABASE_REPLICAS
+        connections.databases['replica1'] = {**default, 'NAME': f'file:{default["NAME"]}?mode=ro'}
+
+        def work(i, write, replica, results):
+            generator = random.Random(i)
+            counts = {'ops': 0, 'locked': 0}
+            if replica:
+                databases.replica.set('replica1')
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                spot = generator.choice(spots)
+                begin = start + timedelta(hours=generator.randrange(24 * 30))
+                try:
+                    if write:
+                        with transaction.atomic():
+                            Reservation.objects.create(parking_spot_id=spot, start_date=begin,
+                                                       end_date=begin + timedelta(hours=2))
+                    else:
+                        # what an availability check reads
+                        list(Reservation.objects.filter(parking_spot=spot, canceled=False,
+                                                        start_date__lt=begin + timedelta(days=1),
+                                                        end_date__gt=begin).values_list('start_date', 'end_date'))
+                        ParkingSpot.objects.get(pk=spot)
+                    counts['ops'] += 1
+                except OperationalError:
+                    counts['locked'] += 1      # database is locked, after waiting the timeout
+            results.put((write, counts))
+            connections.close_all()
+
+        profiles = [('default (rollback journal, synchronous=FULL)', False, False),
+                    ('tuned (WAL, synchronous=NORMAL, mmap)', True, False),
+                    ('tuned, reads routed to a read-only replica', True, True)]
+        context = multiprocessing.get_context('fork')
+        self.stdout.write(f'{readers} reader and {writers} writer processes for {seconds}s each')
+        try:
+            for label, tuned, replica in profiles:
+                with override_settings(SQLITE_TUNED=tuned, DATABASE_READ_REPLICAS=['replica1'] if replica else []):
+                    connections.close_all()
+                    with connections['default'].cursor() as cursor:
+                        # WAL stays on in the file, the tuned profile only switches it on
+                        cursor.execute('PRAGMA journal_mode=WAL' if tuned else 'PRAGMA journal_mode=DELETE')
+                    connections.close_all()     # not shared with the children
+                    results = context.Queue()
+                    workers = [context.Process(target=work, args=(i, i < writers, replica, results))
+                               for i in range(readers + writers)]
+                    for worker in workers:
+                        worker.start()
+                    totals = {True: {'ops': 0, 'locked': 0}, False: {'ops': 0, 'locked': 0}}
+                    for worker in workers:
+                        write, counts = results.get()
+                        for key, count in counts.items():
+                            totals[write][key] += count
+                    for worker in workers:
+                        worker.join()
+                self.stdout.write(f'{label:<47} {totals[False]["ops"] / seconds:7,.0f} reads/s '
+                                  f'{totals[True]["ops"] / seconds:6,.0f} writes/s, '
+                                  f'{totals[False]["locked"] + totals[True]["locked"]} timed out on the lock')
+        finally:
+            connections['replica1'].close()
+            del connections['replica1']
+            del connections.databases['replica1']
+            connections.close_all()
+            with connections['default'].cursor() as cursor:
+                cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+
+    def bench_archive(self, size, repeat):
+        size = size or 200
+        host = self.make_host()
+        attendant = Attendant.objects.create(user=BaseUser.objects.create(username=f'benchmark-{time.time_ns()}'),
+                                             boss=host)
+        renter = BaseUser.objects.create(username=f'benchmark-{time.time_ns()}')
+        spots = self.make_spots(size, host=host)
+        now = timezone.now()
+        reservations = []
+        for spot in spots:
+            # two years of history, most of it confirmed, and the next few bookings
+            for i in range(100):
+                start = now - timedelta(days=730) + timedelta(hours=random.randrange(729 * 24))
+                reservations.append(Reservation(parking_spot=spot, user=renter, start_date=start,
+                                                end_date=start + timedelta(hours=2), confirmed=random.random() < 0.9,
+                                                canceled=random.random() < 0.05))
+            for i in range(3):
+                start = now + timedelta(days=i + 1)
+                reservations.append(Reservation(parking_spot=spot, user=renter, start_date=start,
+                                                end_date=start + timedelta(hours=2)))
+        Reservation.objects.bulk_create(reservations, batch_size=5000)
+        factory = APIRequestFactory()
+
+        def call(user, action):
+            request = factory.get('/', HTTP_HOST='localhost')
+            force_authenticate(request, user=user)
+            response = ReservationViewSet.as_view({'get': action})(request)
+            assert response.status_code == 200, response.data
+
+        calls = [('myreservations', host.user), ('needsconfirmation', attendant.user), ('list', renter)]
+        repeat = min(repeat, 5)
+        self.stdout.write(f'{size} spots, {len(reservations)} reservations')
+        for action, user in calls:
+            self.report(f'{action}, everything in one table', timed(lambda: call(user, action), repeat))
+        start = time.perf_counter()
+        moved = archive.move()
+        self.report(f'archiving {moved} reservations', (time.perf_counter() - start) * 1000)
+        self.stdout.write(f'{Reservation.objects.count()} left, {ArchivedReservation.objects.count()} archived')
+        for action, user in calls:
+            self.report(f'{action}, past ones archived', timed(lambda: call(user, action), repeat))
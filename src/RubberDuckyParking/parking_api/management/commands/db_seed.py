@@ -1,6 +1,15 @@
+import itertools
+import math
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
 from ...models import (
     BaseUser, 
     ParkingSize,
@@ -9,14 +18,385 @@ from ...models import (
     Vehicle, 
     Location, 
     ParkingSpot, 
-    LocationImage
+    LocationImage,
+    Reservation,
+    BaseProfile,
 )
+from ... import search, geo, caching
+
+CAR_MAKES = settings.BASE_DIR.parent / 'car_makes.txt'
+SEED_PASSWORD = 'duckyseed123'
+# stadium towns, locations are generated around these and reservations pile up on game days
+VENUES = [
+    ('Logan', 'UT'), ('Provo', 'UT'), ('Salt Lake City', 'UT'), ('Boise', 'ID'), ('Denver', 'CO'),
+    ('Seattle', 'WA'), ('Green Bay', 'WI'), ('Ann Arbor', 'MI'), ('Columbus', 'OH'), ('Tuscaloosa', 'AL'),
+    ('Austin', 'TX'), ('Kansas City', 'MO'), ('Phoenix', 'AZ'), ('Las Vegas', 'NV'), ('Nashville', 'TN'),
+    ('Baton Rouge', 'LA'), ('Lincoln', 'NE'), ('State College', 'PA'), ('Athens', 'GA'), ('Madison', 'WI'),
+    ('Eugene', 'OR'), ('Knoxville', 'TN'), ('Chicago', 'IL'), ('Dallas', 'TX'), ('Pittsburgh', 'PA'),
+]
+FIRST_NAMES = ['Ava', 'Ben', 'Cora', 'Dallin', 'Emma', 'Finn', 'Grace', 'Hyrum', 'Ivy', 'Jake', 'Kate', 'Liam',
+               'Mia', 'Noah', 'Olive', 'Parker', 'Quinn', 'Ruby', 'Sam', 'Tess', 'Wade', 'Zoe']
+LAST_NAMES = ['Allen', 'Baker', 'Christensen', 'Davis', 'Evans', 'Fisher', 'Garcia', 'Hansen', 'Jensen', 'Larsen',
+              'Miller', 'Nielsen', 'Olsen', 'Peterson', 'Smith', 'Taylor', 'Young']
+LOT_KINDS = ['driveway', 'front yard', 'church lot', 'business lot', 'school lot', 'field']
+STREETS = ['Main St', 'Center St', '100 N', '200 E', '400 N', '800 E', 'Canyon Rd', 'Stadium Way', 'College Ave',
+           'Park Ave', 'Oak St', 'Maple Dr', 'Highland Dr']
+COLORS = ['Black', 'White', 'Silver', 'Gray', 'Blue', 'Red', 'Green', 'Tan']
+# share of spots per size name, the rest get the first size
+SIZE_WEIGHTS = {'A standard size parking spot': 60, 'Compact Size': 20, 'Motorcycle Size': 4,
+                'Extra length Size': 6, 'Tailgate Size': 10}
+EVENT_SHARE = 0.8       # of reservations that are for an event near the spot, the rest are ordinary weekday parking
+DAYS = 180              # reservations fall within DAYS / 2 before and after today
+
+
+def load_car_makes(path=CAR_MAKES):
+    '''
+        The make names from car_makes.txt, which also has blank lines and slogans
+    '''
+    makes = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            name = line.strip().rstrip('-')
+            if name.endswith(' fb'):
+                name = name[:-3].strip()
+            if not name or len(name) > 20 or len(name.split()) > 3 or any(c in name for c in ':!–'):
+                continue
+            # keep the first properly capitalized spelling
+            key = name.lower()
+            if key not in makes or (makes[key].islower() and not name.islower()):
+                makes[key] = name if not name.islower() else name.title()
+    return sorted(makes.values())
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def skewed_weights(count, alpha=1.5, cap=50):
+    # a few big ones and a long tail of small ones, like hosts and lots are. cap keeps the biggest believable
+    return [min(random.paretovariate(alpha), cap) for i in range(count)]
+
+
+@contextmanager
+def indexes_deferred(model):
+    '''
+        Drops the indexes of a table while it is loaded and builds them again after, which is a lot faster
+        than updating them row by row. Only on sqlite, where the index definitions are easy to read back
+    '''
+    if connection.vendor != 'sqlite':
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL",
+                       [model._meta.db_table])
+        indexes = cursor.fetchall()
+        for name, sql in indexes:
+            cursor.execute('DROP INDEX ' + connection.ops.quote_name(name))
+        yield
+        for name, sql in indexes:
+            cursor.execute(sql)
+
+
+def nearest_zip(lat, lng):
+    return min(geo.zip_centroids().items(), key=lambda item: (item[1][0] - lat) ** 2 + (item[1][1] - lng) ** 2)[0]
+
 
 class Command(BaseCommand):
-    help = 'Seeds the database with helpful starter data'
+    help = ('Seeds the database with helpful starter data. '
+            'With --hosts/--locations/--spots/--reservations it also generates that much realistic looking data')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', type=int, default=0)
+        parser.add_argument('--locations', type=int, default=0)
+        parser.add_argument('--spots', type=int, default=0)
+        parser.add_argument('--reservations', type=int, default=0)
+        parser.add_argument('--renters', type=int, default=None,
+                            help='users that make the reservations, one per 20 reservations by default')
+        parser.add_argument('--seed', type=int, default=3450, help='the same seed generates the same data')
+        parser.add_argument('--chunk-size', type=int, default=20000, help='rows built and inserted at a time')
 
     @transaction.atomic # this decorator means that if anything fails, it won't save any of your progress to the db, preventing bad data
     def handle(self, *args, **options):
+        if BaseUser.objects.filter(username='ironman').exists():
+            print('starter data is already there')
+        else:
+            self.create_starter_data()
+
+        counts = [options[name] for name in ('hosts', 'locations', 'spots', 'reservations')]
+        if any(counts):
+            if min(counts) < 0:
+                raise CommandError('counts can not be negative')
+            if options['reservations'] and not options['spots']:
+                raise CommandError('reservations need --spots')
+            if options['spots'] and not options['locations']:
+                raise CommandError('spots need --locations')
+            if options['locations'] and not options['hosts']:
+                raise CommandError('locations need --hosts')
+            random.seed(options['seed'])
+            self.seed = options['seed']
+            self.chunk_size = options['chunk_size']
+            if connection.vendor == 'sqlite':
+                # keep the indexes being filled in memory instead of spilling to the journal (about 500MB)
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA cache_size = -500000')
+            started = time.perf_counter()
+            self.generate(options)
+            print(f'generated in {time.perf_counter() - started:.1f}s, every generated user has the password "{SEED_PASSWORD}"')
+
+    def generate(self, options):
+        host_pks = self.create_hosts(options['hosts'])
+        location_pks, venue_of = self.create_locations(options['locations'], host_pks)
+        spots = self.create_spots(options['spots'], location_pks)
+        if options['reservations']:
+            renters = options['renters'] or max(1, options['reservations'] // 20)
+            renter_pks = self.create_users('renter', renters)
+            self.create_vehicles(renter_pks)
+            self.create_reservations(options['reservations'], spots, venue_of, renter_pks)
+
+        # bulk_create sends no signals, so do what the signal receivers would have done
+        search.rebuild_index()
+        for model in caching.VERSIONED_MODELS:
+            caching.bump(model)
+
+    def bulk_create(self, model, rows):
+        count = 0
+        for chunk in chunked(rows, self.chunk_size):
+            model.objects.bulk_create(chunk)
+            count += len(chunk)
+        print(f'created {count} {model._meta.verbose_name_plural.lower()}')
+        return count
+
+    def insert_rows(self, model, columns, rows):
+        '''
+            executemany straight into the table, for the biggest tables. bulk_create spends most of its time
+            turning every field of every object into its database form, these rows already are
+        '''
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(column) for column in columns),
+            ', '.join(['%s'] * len(columns)),
+        )
+        count = 0
+        with connection.cursor() as cursor:
+            for chunk in chunked(rows, self.chunk_size):
+                cursor.executemany(sql, chunk)
+                count += len(chunk)
+        print(f'created {count} {model._meta.verbose_name_plural.lower()}')
+        return count
+
+    def created_pks(self, model, count):
+        # sqlite doesn't hand back the pks of bulk inserted rows, they are the newest ones
+        return sorted(model.objects.order_by('-pk').values_list('pk', flat=True)[:count])
+
+    def create_users(self, kind, count):
+        password = make_password(SEED_PASSWORD)     # hashing is slow on purpose, do it once
+        first_pk = (BaseUser.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+        self.bulk_create(BaseUser, (
+            BaseUser(
+                username=f'{kind}{first_pk + i}-{self.seed}',
+                first_name=random.choice(FIRST_NAMES),
+                last_name=random.choice(LAST_NAMES),
+                email=f'{kind}{first_pk + i}-{self.seed}@example.com',
+                phone_number=f'+1(801) {random.randint(200, 999)}-{random.randint(0, 9999):04d}',
+                password=password,
+            ) for i in range(count)
+        ))
+        return self.created_pks(BaseUser, count)
+
+    def create_profiles(self, model, user_pks, **columns):
+        '''
+            Hosts and attendants extend BaseProfile through a second table, which bulk_create can't fill,
+            so the profile rows are bulk created and the child rows inserted directly
+        '''
+        self.bulk_create(BaseProfile, (BaseProfile(user_id=pk) for pk in user_pks))
+        profile_pks = self.created_pks(BaseProfile, len(user_pks))
+        self.insert_rows(model, [model._meta.pk.column] + list(columns), zip(profile_pks, *columns.values()))
+        return profile_pks
+
+    def create_hosts(self, count):
+        if not count:
+            return list(Host.objects.values_list('pk', flat=True))
+        host_pks = self.create_profiles(Host, self.create_users('host', count))
+        # about a third of the hosts have attendants, the big ones more of them
+        bosses = [pk for pk in host_pks if random.random() < 0.35 for i in range(random.randint(1, 3))]
+        if bosses:
+            self.create_profiles(Attendant, self.create_users('attendant', len(bosses)), boss_id=bosses)
+        return host_pks
+
+    def create_locations(self, count, host_pks):
+        if not count:
+            return list(Location.objects.values_list('pk', flat=True)), {}
+        venues = []
+        for city, state in VENUES:
+            point = geo.locate(city=city, state=state)
+            if point:
+                venues.append((city, state, point, nearest_zip(*point)))
+        venue_weights = skewed_weights(len(venues))
+        chosen_venues = random.choices(range(len(venues)), weights=venue_weights, k=count)
+        chosen_hosts = random.choices(host_pks, weights=skewed_weights(len(host_pks)), k=count)
+
+        def rows():
+            for venue_index, host_pk in zip(chosen_venues, chosen_hosts):
+                city, state, (lat, lng), zip_code = venues[venue_index]
+                kind = random.choice(LOT_KINDS)
+                # within a few km of the stadium
+                lat += random.gauss(0, 1.5) / geo.KM_PER_DEGREE
+                lng += random.gauss(0, 1.5) / (geo.KM_PER_DEGREE * math.cos(math.radians(lat)))
+                yield Location(
+                    name=f"{random.choice(LAST_NAMES)}'s {kind}",
+                    description=f'{kind.capitalize()} a short walk from the stadium in {city}',
+                    address=f'{random.randint(1, 2999)} {random.choice(STREETS)}',
+                    city=city, state=state, zip_code=zip_code,
+                    latitude=round(lat, 6), longitude=round(lng, 6),
+                    geohash=geo.encode_geohash(lat, lng),
+                    host_id=host_pk,
+                )
+        self.bulk_create(Location, rows())
+        location_pks = self.created_pks(Location, count)
+        return location_pks, dict(zip(location_pks, chosen_venues))
+
+    def create_spots(self, count, location_pks):
+        if not count:
+            return []
+        sizes = list(ParkingSize.objects.all())
+        size_weights = [SIZE_WEIGHTS.get(size.name, 1) for size in sizes]
+        owners = dict(Location.objects.filter(pk__in=location_pks).values_list('pk', 'host_id'))
+        # every location gets a spot, the rest go mostly to the big lots
+        location_weights = skewed_weights(len(location_pks), alpha=1.2)
+        spot_locations = location_pks[:count] + random.choices(location_pks, weights=location_weights,
+                                                               k=max(0, count - len(location_pks)))
+
+        def rows():
+            numbers = {}
+            spot_sizes = random.choices(sizes, weights=size_weights, k=len(spot_locations))
+            for location_pk, size in zip(spot_locations, spot_sizes):
+                numbers[location_pk] = numbers.get(location_pk, 0) + 1
+                yield (
+                    numbers[location_pk],
+                    size.pk,
+                    round(size.min_width + random.random() * 2, 1),
+                    round(size.min_length + random.random() * 4, 1),
+                    round(random.uniform(3, 12) * (2 if 'Tailgate' in size.name else 1) * 2) / 2,
+                    location_pk,
+                    '',
+                    owners[location_pk],
+                    0,
+                )
+        columns = ['uid', 'parking_size_id', 'actual_width', 'actual_length', 'price', 'location_id', 'notes', 'owner_id',
+                   'bookings']
+        with indexes_deferred(ParkingSpot):
+            self.insert_rows(ParkingSpot, columns, rows())
+        return list(zip(self.created_pks(ParkingSpot, count), spot_locations))
+
+    def create_vehicles(self, user_pks):
+        makes = load_car_makes()
+
+        def rows():
+            for user_pk in user_pks:
+                for i in range(1 if random.random() < 0.8 else 2):
+                    yield (
+                        random.randint(1998, 2021),
+                        random.choice(makes),
+                        random.choice(['Sedan', 'Coupe', 'Wagon', 'SUV', 'Truck', 'Van', 'Hatchback']),
+                        random.choice(COLORS),
+                        ''.join(random.choices('ABCDEFGHJKLMNPRSTUVWXYZ0123456789', k=7)),
+                        '',
+                        user_pk,
+                    )
+        self.insert_rows(Vehicle, ['year', 'make', 'model', 'color', 'license', 'description', 'user_id'], rows())
+
+    def create_reservations(self, count, spots, venue_of, renter_pks):
+        '''
+            Most reservations are for events: on an event day at a venue a big share of the spots around it
+            are booked from a few hours before the game until after it. The rest are single daytime bookings.
+            Event bookings run 14:00 to 01:00 and daytime ones 06:00 to 14:00 UTC, and each spot has at most
+            one of each per day, so no two reservations of a spot overlap
+        '''
+        # times are whole minutes after first_day until they are written out
+        now = timezone.make_naive(timezone.now(), timezone.utc)     # naive utc, which is what the database stores
+        first_day = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=DAYS // 2)
+        now_minute = int((now - first_day).total_seconds() // 60)
+        today_minute = DAYS // 2 * 1440
+        db_datetime = connection.ops.adapt_datetimefield_value
+        updated_at = db_datetime(now)
+        stamps = {}
+
+        def stamp(minute):
+            # each distinct minute is formatted once
+            value = stamps.get(minute)
+            if value is None:
+                value = stamps[minute] = db_datetime(first_day + timedelta(minutes=minute))
+            return value
+
+        spots_near = {}
+        for spot_pk, location_pk in spots:
+            spots_near.setdefault(venue_of.get(location_pk), []).append(spot_pk)
+        spot_pks = [spot_pk for spot_pk, location_pk in spots]
+        renter_weights = list(itertools.accumulate(skewed_weights(len(renter_pks))))
+        rand = random.random
+        # users are drawn in blocks, random.choices with weights is slow one at a time
+        renters = iter(())
+
+        def renter():
+            nonlocal renters
+            pk = next(renters, None)
+            if pk is None:
+                renters = iter(random.choices(renter_pks, cum_weights=renter_weights, k=10000))
+                pk = next(renters)
+            return pk
+
+        def reservation(spot_pk, start, end):
+            created_at = min(start - 60 - int(rand() * 30000), now_minute)     # booked up to 3 weeks ahead
+            return (spot_pk, stamp(start), stamp(end), renter(), stamp(created_at), updated_at,
+                    rand() < 0.04, start < today_minute and rand() < 0.85)
+
+        def event_rows(target):
+            made = 0
+            venues = [venue for venue in spots_near if venue is not None]
+            event_days = {venue: random.sample(range(DAYS), DAYS) for venue in venues}
+            while made < target and any(event_days.values()):
+                venue = random.choice(venues)
+                if not event_days[venue]:
+                    continue
+                kickoff = event_days[venue].pop() * 1440 + (17 + int(rand() * 4)) * 60
+                game_end = kickoff + 150 + int(rand() * 60)
+                near = spots_near[venue]
+                turnout = random.uniform(0.3, 0.95)
+                for spot_pk in random.sample(near, min(len(near), max(1, int(len(near) * turnout)), target - made)):
+                    # arrive up to 3 hours early, leave up to an hour and a half after
+                    yield reservation(spot_pk, kickoff - 30 - int(rand() * 151), game_end + int(rand() * 91))
+                    made += 1
+
+        def daytime_rows(target):
+            taken = set()
+            tries = 0
+            made = 0
+            while made < target and tries < target * 3:
+                tries += 1
+                spot_pk = random.choice(spot_pks)
+                day = random.randrange(DAYS)
+                if (spot_pk, day) in taken:
+                    continue
+                taken.add((spot_pk, day))
+                start = day * 1440 + 360 + int(rand() * 16) * 15     # 6:00 to 9:45
+                yield reservation(spot_pk, start, start + 60 * (1 + int(rand() * 4)))
+                made += 1
+
+        columns = ['parking_spot_id', 'start_date', 'end_date', 'user_id', 'created_at', 'updated_at',
+                   'canceled', 'confirmed']
+        with indexes_deferred(Reservation):
+            made = self.insert_rows(Reservation, columns, event_rows(int(count * EVENT_SHARE))) if venue_of else 0
+            # venues with few spots run out of event days, daytime bookings make up the difference
+            self.insert_rows(Reservation, columns, daytime_rows(count - made))
+
+    def create_starter_data(self):
         print('creating dummy models')
         
         standard_spot = ParkingSize.objects.create(
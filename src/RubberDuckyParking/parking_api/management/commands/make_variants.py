@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import images
+
+
+class Command(BaseCommand):
+    help = 'Makes the sized variants of uploaded location pictures and avatars that have none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='make them again for every image')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        made = failed = 0
+        for model, (field, key_field, widths, square) in images.SOURCES.items():
+            queryset = model.objects.exclude(**{field: ''})
+            if not options['all']:
+                queryset = queryset.filter(**{key_field: ''})
+            for pk, name in queryset.values_list('pk', field).iterator():
+                try:
+                    images.make_variants(model, pk, name)
+                    made += 1
+                except Exception as error:
+                    # a missing or broken file, the rest still get theirs
+                    self.stderr.write(f'{model._meta.label} {pk} ({name}): {error}')
+                    failed += 1
+        self.stdout.write(f'made the variants of {made} images, {failed} failed, '
+                          f'in {time.perf_counter() - start:.1f}s')
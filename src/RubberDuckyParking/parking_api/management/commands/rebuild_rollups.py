@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import rollups
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the earnings rollups from the transactions table'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        count = rollups.rebuild()
+        self.stdout.write(f'wrote {count} rollup rows in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import occupancy
+
+
+class Command(BaseCommand):
+    help = 'Brings the hour of the week occupancy heatmaps of the locations up to date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='count every location again from scratch')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        counted, added = occupancy.refresh(full=options['full'])
+        self.stdout.write(f'counted {counted} locations from scratch, added new reservations to {added} '
+                          f'in {time.perf_counter() - start:.1f}s')
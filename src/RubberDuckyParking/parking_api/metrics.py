@@ -0,0 +1,282 @@
+'''
+    Per endpoint request metrics, served at /api/_metrics in the Prometheus text format.
+
+    MetricsMiddleware times every request and labels it with the url name it resolved to (the router names
+    routes "<basename>-<action>", i.e. parking-spot-list, reservations-needsconfirmation) and the method.
+    Next to the latency histogram it records the SQL queries and their time (through a database execute
+    wrapper), the time the serializers took to build the response data (serializing() around the
+    serializer.data and fast_serializers calls of the views), how long encoding that data to bytes took,
+    and the response size.
+
+    Counters are per process and the request path takes no lock: each thread only ever adds to its own
+    Stats, and a scrape adds up the Stats of all threads. A scrape racing a request can miss that one
+    request, the next scrape sees it. The Stats of threads that ended are folded into one retired Stats
+    when the next thread starts recording or the next scrape runs, so servers that start a thread per
+    request don't keep one Stats for each.
+'''
+import bisect
+import threading
+import time
+import weakref
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import passwords
+from .authentication import token_cache
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class Stats:
+    '''
+        What one thread has seen, per (view, method). Only the owning thread writes to it
+    '''
+
+    def __init__(self):
+        self.endpoints = {}     # (view, method) -> [bucket counts..., +Inf count]
+        self.totals = {}        # (view, method) -> {name: value}
+        self.statuses = {}      # (view, method, status) -> count
+
+    def add(self, view, method, status, duration, queries, query_time, serialize_time, render_time, size):
+        key = (view, method)
+        buckets = self.endpoints.get(key)
+        if buckets is None:
+            buckets = self.endpoints[key] = [0] * (len(BUCKETS) + 1)
+            self.totals[key] = dict.fromkeys(
+                ('count', 'seconds', 'db_queries', 'db_seconds', 'serializer_seconds', 'render_seconds',
+                 'response_bytes'), 0
+            )
+        buckets[bisect.bisect_left(BUCKETS, duration)] += 1
+        totals = self.totals[key]
+        totals['count'] += 1
+        totals['seconds'] += duration
+        totals['db_queries'] += queries
+        totals['db_seconds'] += query_time
+        totals['serializer_seconds'] += serialize_time
+        totals['render_seconds'] += render_time
+        totals['response_bytes'] += size
+        status_key = (view, method, status)
+        self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+
+    def merge(self, other):
+        for key, counts in list(other.endpoints.items()):
+            merged = self.endpoints.setdefault(key, [0] * (len(BUCKETS) + 1))
+            for i, count in enumerate(counts):
+                merged[i] += count
+        for key, values in list(other.totals.items()):
+            merged = self.totals.setdefault(key, dict.fromkeys(values, 0))
+            for name, value in list(values.items()):
+                merged[name] += value
+        for key, count in list(other.statuses.items()):
+            self.statuses[key] = self.statuses.get(key, 0) + count
+
+
+class Registry:
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()    # only taken when a thread records its first request
+        self.all_stats = []             # (weakref to the thread, its Stats)
+        self.retired = Stats()          # added up Stats of threads that ended
+
+    def stats(self):
+        stats = getattr(self.local, 'stats', None)
+        if stats is None:
+            stats = self.local.stats = Stats()
+            with self.lock:
+                self.prune()
+                self.all_stats.append((weakref.ref(threading.current_thread()), stats))
+        return stats
+
+    def prune(self):
+        # with the lock held. A thread that ended writes no more, so its Stats can be merged
+        live = []
+        for thread_ref, stats in self.all_stats:
+            thread = thread_ref()
+            if thread is not None and thread.is_alive():
+                live.append((thread_ref, stats))
+            else:
+                self.retired.merge(stats)
+        self.all_stats = live
+
+    def reset(self):
+        with self.lock:
+            self.retired = Stats()
+            for thread, stats in self.all_stats:
+                stats.__init__()
+
+    def collect(self):
+        '''
+            (buckets, totals, statuses) added up over every thread
+        '''
+        total = Stats()
+        with self.lock:
+            self.prune()
+            total.merge(self.retired)
+            all_stats = [stats for thread, stats in self.all_stats]
+        for stats in all_stats:
+            total.merge(stats)
+        return total.endpoints, total.totals, total.statuses
+
+
+registry = Registry()
+
+
+class QueryTimer:
+    '''
+        Database execute wrapper that counts queries and adds up their time
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+@contextmanager
+def serializing(request):
+    '''
+        Adds the time spent in the block to the serializer time of request
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        # a DRF Request reads the attribute from the HttpRequest it wraps
+        timing = getattr(request, '_metrics_serialize', None)
+        if timing is not None:
+            timing[0] += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        request._metrics_render = [None, 0.0]   # render start, render time
+        request._metrics_serialize = [0.0]
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match is not None else 'unmatched'
+        if view != 'metrics':
+            size = len(response.content) if not response.streaming else 0
+            registry.stats().add(view, request.method, response.status_code, duration, timer.queries, timer.seconds,
+                                 request._metrics_serialize[0], request._metrics_render[1], size)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses render after the view returns, between this hook and the post render callback
+        timing = request._metrics_render
+        timing[0] = time.perf_counter()
+
+        def rendered(response):
+            timing[1] = time.perf_counter() - timing[0]
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**values):
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in values.items()) + '}'
+
+
+def render():
+    buckets, totals, statuses = registry.collect()
+    lines = [
+        '# HELP parking_api_request_duration_seconds Time from the first middleware until the response is rendered.',
+        '# TYPE parking_api_request_duration_seconds histogram',
+    ]
+    for (view, method), counts in sorted(buckets.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'parking_api_request_duration_seconds_bucket{labels(view=view, method=method, le=bound)} {cumulative}')
+        lines.append(f'parking_api_request_duration_seconds_sum{labels(view=view, method=method)} {totals[view, method]["seconds"]}')
+        lines.append(f'parking_api_request_duration_seconds_count{labels(view=view, method=method)} {cumulative}')
+
+    counters = [
+        ('db_queries', 'parking_api_db_queries_total', 'SQL queries run.'),
+        ('db_seconds', 'parking_api_db_query_seconds_total', 'Time spent running SQL queries.'),
+        ('serializer_seconds', 'parking_api_serializer_seconds_total',
+         'Time spent in serializers building response data from rows, including queries they run.'),
+        ('render_seconds', 'parking_api_render_seconds_total',
+         'Time spent encoding the built response data to bytes (JSON or HTML).'),
+        ('response_bytes', 'parking_api_response_bytes_total', 'Size of the response bodies.'),
+    ]
+    for name, metric, help_text in counters:
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for (view, method), values in sorted(totals.items()):
+            lines.append(f'{metric}{labels(view=view, method=method)} {values[name]}')
+
+    lines.append('# HELP parking_api_responses_total Responses by status code.')
+    lines.append('# TYPE parking_api_responses_total counter')
+    for (view, method, status), count in sorted(statuses.items()):
+        lines.append(f'parking_api_responses_total{labels(view=view, method=method, status=status)} {count}')
+
+    cache = token_cache.stats()
+    for name in ('hits', 'misses', 'evictions', 'invalidations'):
+        lines.append(f'# TYPE parking_api_token_cache_{name}_total counter')
+        lines.append(f'parking_api_token_cache_{name}_total {cache[name]}')
+    lines.append('# TYPE parking_api_token_cache_size gauge')
+    lines.append(f'parking_api_token_cache_size {cache["size"]}')
+
+    hashing = passwords.pool.stats()
+    lines.append('# HELP parking_api_password_pool_in_flight Password hashes running or waiting for a worker.')
+    lines.append('# TYPE parking_api_password_pool_in_flight gauge')
+    lines.append(f'parking_api_password_pool_in_flight {hashing["in_flight"]}')
+    lines.append('# HELP parking_api_password_pool_queued Password hashes waiting for a worker.')
+    lines.append('# TYPE parking_api_password_pool_queued gauge')
+    lines.append(f'parking_api_password_pool_queued {max(0, hashing["in_flight"] - hashing["workers"])}')
+    lines.append('# TYPE parking_api_password_pool_capacity gauge')
+    lines.append(f'parking_api_password_pool_capacity {hashing["capacity"]}')
+    for name, help_text in (('done', 'Password hashes finished.'),
+                            ('rejected', 'Logins and signups turned away with 503 because the pool was full.'),
+                            ('seconds', 'Time from handing a hash to the pool until it finished.')):
+        lines.append(f'# HELP parking_api_password_pool_{name}_total {help_text}')
+        lines.append(f'# TYPE parking_api_password_pool_{name}_total counter')
+        lines.append(f'parking_api_password_pool_{name}_total {hashing[name]}')
+    return '\n'.join(lines) + '\n'
+
+
+def may_scrape(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        return request.META.get('HTTP_AUTHORIZATION') == f'Bearer {token}'
+    # without a token, staff and scrapers on this host. A proxy on this host connects from a local
+    # address too, but adds X-Forwarded-For
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    return request.META.get('REMOTE_ADDR') in LOCAL_ADDRESSES and 'HTTP_X_FORWARDED_FOR' not in request.META
+
+
+def metrics_view(request):
+    if not may_scrape(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
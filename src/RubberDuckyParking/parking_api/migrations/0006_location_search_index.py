@@ -0,0 +1,32 @@
+from django.db import migrations
+
+COLUMNS = 'name, description, address, city, state, zip_code'
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS parking_api_location_fts USING fts5('
+        f'{COLUMNS}, tokenize="unicode61 remove_diacritics 2")'
+    )
+    schema_editor.execute(
+        f'INSERT INTO parking_api_location_fts (rowid, {COLUMNS}) SELECT id, {COLUMNS} FROM parking_api_location'
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS parking_api_location_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0005_auto_20210412_1928'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
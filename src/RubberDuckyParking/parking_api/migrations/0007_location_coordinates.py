@@ -0,0 +1,42 @@
+# Generated by Django 3.1.5 on 2026-10-18 15:18
+
+from django.db import migrations, models
+from parking_api import geo
+
+
+def fill_coordinates(apps, schema_editor):
+    Location = apps.get_model('parking_api', 'Location')
+    locations = []
+    for location in Location.objects.filter(latitude__isnull=True):
+        point = geo.locate(location.zip_code, location.city, location.state)
+        if point:
+            location.latitude, location.longitude = point
+            location.geohash = geo.encode_geohash(*point)
+            locations.append(location)
+    Location.objects.bulk_update(locations, ['latitude', 'longitude', 'geohash'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0006_location_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_coordinates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.5 on 2026-10-18 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0009_modelversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reservation',
+            name='checkin_code',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True, unique=True),
+        ),
+    ]
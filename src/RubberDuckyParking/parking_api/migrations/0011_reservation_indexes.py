@@ -0,0 +1,29 @@
+# Generated by Django 3.1.5 on 2026-10-18 15:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0010_reservation_checkin_code'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(canceled=False), fields=['user', 'created_at'], name='reservation_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(canceled=False), fields=['parking_spot', 'start_date', 'end_date'], name='reservation_spot_window_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('canceled', False), ('confirmed', False)), fields=['parking_spot', 'start_date'], name='reservation_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(canceled=False), fields=['end_date'], name='reservation_active_end_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.5 on 2026-10-18 16:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0011_reservation_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EarningsRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('host', 'host'), ('location', 'location'), ('spot', 'spot')], max_length=8)),
+                ('scope_pk', models.IntegerField()),
+                ('period', models.CharField(choices=[('day', 'day'), ('month', 'month')], max_length=5)),
+                ('start', models.DateField()),
+                ('host_pk', models.IntegerField(db_index=True)),
+                ('transactions', models.IntegerField(default=0)),
+                ('user_charge', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('fee_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('host_income', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='earningsrollup',
+            constraint=models.UniqueConstraint(fields=('scope', 'scope_pk', 'period', 'start'), name='earnings_rollup_unique'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.5 on 2026-10-18 16:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0012_earningsrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OccupancyHeatmap',
+            fields=[
+                ('location', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='parking_api.location')),
+                ('spots', models.BinaryField()),
+                ('minutes', models.BinaryField()),
+                ('first_start', models.DateTimeField()),
+                ('last_end', models.DateTimeField()),
+                ('counted_until', models.DateTimeField()),
+                ('stale', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
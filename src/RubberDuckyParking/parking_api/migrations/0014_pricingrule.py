@@ -0,0 +1,32 @@
+# Generated by Django 3.1.5 on 2026-10-18 16:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0013_occupancyheatmap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PricingRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, default='', max_length=100)),
+                ('kind', models.CharField(choices=[('hours', 'hours'), ('day_cap', 'day cap'), ('event', 'event'), ('occupancy', 'occupancy')], max_length=10)),
+                ('multiplier', models.FloatField(default=1.0)),
+                ('amount', models.FloatField(default=0.0)),
+                ('days', models.IntegerField(default=127)),
+                ('start_hour', models.IntegerField(default=0)),
+                ('end_hour', models.IntegerField(default=24)),
+                ('starts_at', models.DateTimeField(blank=True, null=True)),
+                ('ends_at', models.DateTimeField(blank=True, null=True)),
+                ('threshold', models.FloatField(default=0.0)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='parking_api.location')),
+                ('spot', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='parking_api.parkingspot')),
+            ],
+        ),
+    ]
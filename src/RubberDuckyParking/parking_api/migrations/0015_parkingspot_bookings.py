@@ -0,0 +1,18 @@
+# Generated by Django 3.1.5 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0014_pricingrule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parkingspot',
+            name='bookings',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.5 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0015_parkingspot_bookings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='baseuser',
+            name='avatar_variants',
+            field=models.CharField(blank=True, editable=False, max_length=24),
+        ),
+        migrations.AddField(
+            model_name='locationimage',
+            name='variants',
+            field=models.CharField(blank=True, editable=False, max_length=24),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_api', '0016_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedReservation',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('start_date', models.DateTimeField()),
+                ('end_date', models.DateTimeField()),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(db_index=True)),
+                ('canceled', models.BooleanField(default=False)),
+                ('confirmed', models.BooleanField(default=False)),
+                ('checkin_code', models.CharField(blank=True, editable=False, max_length=32, null=True)),
+                ('archived_at', models.DateTimeField()),
+                ('parking_spot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='parking_api.parkingspot')),
+                ('user', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedreservation',
+            index=models.Index(condition=models.Q(canceled=False), fields=['user', 'created_at'], name='archived_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedreservation',
+            index=models.Index(fields=['parking_spot', 'start_date'], name='archived_spot_start_idx'),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django import forms
 from django.contrib.auth.models import AbstractUser
+from . import geo
 
 
 class ParkingSize(models.Model):
@@ -26,11 +27,13 @@ class BaseUser(AbstractUser):
         It is based off of django's default user model
     '''
     avatar = models.ImageField(blank=True)
+    avatar_variants = models.CharField(max_length=24, blank=True, editable=False)   # key of its sizes, see images.py
     phone_number = models.CharField(default='', max_length=17)
     class Meta:
         verbose_name_plural = "Base Users"
 
     def is_host(self):
+        # each call is a query, in views use roles.get_roles(request) instead
         return Host.objects.filter(user__pk=self.pk).exists()
 
     def is_attendant(self):
@@ -89,10 +92,24 @@ class Location(models.Model):
     zip_code = models.CharField(max_length=10, default="20500")          # i.e. 84093-3541
     state = models.CharField(max_length=3)
     host = models.ForeignKey(Host, on_delete=models.CASCADE)     # Host can have many parking locations
+    latitude = models.FloatField(null=True, blank=True)     # filled from the zip code if not given
+    longitude = models.FloatField(null=True, blank=True)
+    geohash = models.CharField(max_length=12, default="", blank=True, editable=False, db_index=True)
 
     def __str__(self):
         return f"{self.name} at {self.address}"
 
+    def save(self, *args, **kwargs):
+        if self.latitude is None or self.longitude is None:
+            point = geo.locate(self.zip_code, self.city, self.state)
+            if point:
+                self.latitude, self.longitude = point
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = geo.encode_geohash(self.latitude, self.longitude)
+        else:
+            self.geohash = ""
+        super().save(*args, **kwargs)
+
 
 class ParkingSpot(models.Model):
     """
@@ -108,6 +125,7 @@ class ParkingSpot(models.Model):
     location = models.ForeignKey(Location, on_delete=models.CASCADE)
     notes = models.CharField(max_length=100, default="")
     owner = models.ForeignKey(Host, on_delete=models.CASCADE)
+    bookings = models.IntegerField(default=0, editable=False)  # bumped by every booking to lock the row, see checkout.py
 
     def __str__(self):
         return f"Parking Spot {self.uid}"
@@ -146,6 +164,7 @@ class LocationImage(models.Model):
     """
     location = models.ForeignKey(Location, on_delete=models.CASCADE)
     image = models.ImageField(blank=True)
+    variants = models.CharField(max_length=24, blank=True, editable=False)  # key of its sizes, see images.py
 
     class Meta:
         verbose_name_plural = "Images"
@@ -161,8 +180,133 @@ class Reservation(models.Model):
     end_date = models.DateTimeField()
     user = models.ForeignKey(BaseUser, on_delete=models.CASCADE, null=True, default=None)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)     # lets availability.py find changed rows
     canceled = models.BooleanField(default=False)
     confirmed = models.BooleanField(default=False)
+    checkin_code = models.CharField(max_length=32, unique=True, null=True, blank=True, editable=False)  # see checkin.py
+
+    class Meta:
+        # the filters the api actually runs, checked by IndexUsageTests
+        indexes = [
+            # a user's reservations, oldest first (ReservationViewSet.list)
+            models.Index(fields=['user', 'created_at'], condition=models.Q(canceled=False),
+                         name='reservation_user_active_idx'),
+            # reservations of a host's spots and overlap checks (myreservations, availability.py)
+            models.Index(fields=['parking_spot', 'start_date', 'end_date'], condition=models.Q(canceled=False),
+                         name='reservation_spot_window_idx'),
+            # what attendants still have to confirm (needsconfirmation)
+            models.Index(fields=['parking_spot', 'start_date'], condition=models.Q(canceled=False, confirmed=False),
+                         name='reservation_pending_idx'),
+            # the availability index reload
+            models.Index(fields=['end_date'], condition=models.Q(canceled=False),
+                         name='reservation_active_end_idx'),
+        ]
+
+
+class ArchivedReservation(models.Model):
+    """
+    A reservation that ended, or was canceled, a while ago, moved out of the reservation table with
+    the pk and values it had, so that table only holds current bookings. See archive.py
+    """
+    id = models.IntegerField(primary_key=True)     # its pk as a Reservation
+    parking_spot = models.ForeignKey(ParkingSpot, on_delete=models.CASCADE)
+    start_date = models.DateTimeField()
+    end_date = models.DateTimeField()
+    user = models.ForeignKey(BaseUser, on_delete=models.CASCADE, null=True, default=None)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField(db_index=True)    # lets occupancy.py find rows it has not counted
+    canceled = models.BooleanField(default=False)
+    confirmed = models.BooleanField(default=False)
+    checkin_code = models.CharField(max_length=32, null=True, blank=True, editable=False)
+    archived_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # a user's reservations, oldest first (ReservationViewSet.list)
+            models.Index(fields=['user', 'created_at'], condition=models.Q(canceled=False),
+                         name='archived_user_active_idx'),
+            # the reservations of a host's spots (the reservations export)
+            models.Index(fields=['parking_spot', 'start_date'], name='archived_spot_start_idx'),
+        ]
+
+
+class ModelVersion(models.Model):
+    """
+    A counter per model that goes up on every save or delete, so cached API responses
+    can tell they are stale with one small query. See caching.py
+    """
+    name = models.CharField(max_length=100, primary_key=True)   # model label, i.e. "parking_api.parkingsize"
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
 
 
+class EarningsRollup(models.Model):
+    """
+    Transactions added up per day or month, for a host, one of their locations or one spot.
+    Kept up to date as transactions are written, see rollups.py
+    """
+    SCOPES = [('host', 'host'), ('location', 'location'), ('spot', 'spot')]
+    PERIODS = [('day', 'day'), ('month', 'month')]
+
+    scope = models.CharField(max_length=8, choices=SCOPES)
+    scope_pk = models.IntegerField()                    # pk of the host, location or spot
+    period = models.CharField(max_length=5, choices=PERIODS)
+    start = models.DateField()                          # the day, or the first day of the month
+    host_pk = models.IntegerField(db_index=True)        # not a foreign key, see rollups.py
+    transactions = models.IntegerField(default=0)
+    user_charge = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    fee_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    host_income = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'scope_pk', 'period', 'start'], name='earnings_rollup_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.scope_pk} {self.period} {self.start}"
+
+
+class OccupancyHeatmap(models.Model):
+    """
+    Minutes reserved in every hour of the week, for each spot of a location that has reservations.
+    Refreshed by the refresh_occupancy command, see occupancy.py
+    """
+    location = models.OneToOneField(Location, on_delete=models.CASCADE, primary_key=True)
+    spots = models.BinaryField()        # spot pks, int32, one per matrix row
+    minutes = models.BinaryField()      # zlib compressed (spots, 168) uint32 matrix, Monday 0:00 first
+    first_start = models.DateTimeField()
+    last_end = models.DateTimeField()
+    counted_until = models.DateTimeField()          # reservations updated up to here are counted
+    stale = models.BooleanField(default=False)      # a counted reservation was deleted, count again
+    updated_at = models.DateTimeField(auto_now=True)
 
+    def __str__(self):
+        return f"occupancy of location {self.location_id}"
+
+
+class PricingRule(models.Model):
+    """
+    Changes what the spots of a location, or one of its spots, cost on top of their hourly price.
+    Quotes apply every matching rule, see pricing.py
+    """
+    KINDS = [('hours', 'hours'), ('day_cap', 'day cap'), ('event', 'event'), ('occupancy', 'occupancy')]
+
+    location = models.ForeignKey(Location, on_delete=models.CASCADE)
+    spot = models.ForeignKey(ParkingSpot, on_delete=models.CASCADE, null=True, blank=True)  # none: every spot of the location
+    name = models.CharField(max_length=100, default="", blank=True)    # i.e. "Game day"
+    kind = models.CharField(max_length=10, choices=KINDS)
+    multiplier = models.FloatField(default=1.0)     # hours, event, occupancy: the hourly price is multiplied by this
+    amount = models.FloatField(default=0.0)         # day_cap: most charged per day, event: added once per reservation
+    days = models.IntegerField(default=127)         # hours: weekdays as bits, Monday = 1 ... Sunday = 64
+    start_hour = models.IntegerField(default=0)     # hours: local time, wraps past midnight when after end_hour
+    end_hour = models.IntegerField(default=24)
+    starts_at = models.DateTimeField(null=True, blank=True)     # event
+    ends_at = models.DateTimeField(null=True, blank=True)
+    threshold = models.FloatField(default=0.0)      # occupancy: applies in hours of the week the lot is this full
+
+    def __str__(self):
+        return f"{self.kind} rule {self.name} for location {self.location_id}"
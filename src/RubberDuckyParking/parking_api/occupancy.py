@@ -0,0 +1,233 @@
+'''
+    Hour of the week occupancy of every location and spot, for hosts pricing their lots.
+
+    For each location, OccupancyHeatmap keeps a (spots, 168) matrix of the minutes reserved in every
+    hour of the week (local time, Monday 0:00 first) over all non-canceled reservations. Dividing by how
+    often each hour of the week occurs between the first reservation start and the last end gives the share
+    of time a spot, or the whole lot, was taken.
+
+    The minutes come from interval arithmetic in numpy: with C(t) the minutes of each hour of the week
+    between a fixed Monday and t, a reservation [start, end) covers C(end) - C(start) of every hour.
+    C(t) is 60 per whole week plus the part of the current week, so a chunk of reservations is a few
+    vectorized operations on a (reservations, 168) array.
+
+    refresh() only reads reservations whose updated_at moved since the last refresh. New reservations
+    are added to their location's matrix. A location gets counted again from scratch when one of its
+    counted reservations changed or was deleted (signals.py sets stale). As with availability.py,
+    rows from transactions that commit out of order are only seen by a full refresh, and so is a
+    reservation moved to another lot leaving the lot it was counted for. queryset.update() does not
+    touch updated_at unless told to, code using it sets updated_at or runs refresh_occupancy --full.
+    Archived reservations (archive.py) still count: both tables are read, archived rows keep updated_at.
+'''
+import datetime
+import zlib
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .availability import EpochSeconds
+from .models import ArchivedReservation, OccupancyHeatmap, ParkingSpot, Reservation
+
+HOURS = 7 * 24
+WEEK = HOURS * 60                   # minutes
+MONDAY = 4 * 24 * 60                # 1970-01-01 was a Thursday, the first Monday starts 4 days later
+HOUR_STARTS = np.arange(HOURS, dtype=np.int64) * 60
+CHUNK_SIZE = 20000                  # reservations per (chunk, 168) array
+RESERVATION_COLUMNS = ('parking_spot__location', 'parking_spot', EpochSeconds('start_date'), EpochSeconds('end_date'))
+
+
+def utc_offsets(tz, first, last):
+    '''
+        (unix seconds, utc offset in seconds) of every offset change of tz from first to last.
+        Probes once a day and bisects the days the offset changes in
+    '''
+    def offset(seconds):
+        return int(datetime.datetime.fromtimestamp(seconds, tz).utcoffset().total_seconds())
+
+    times, offsets = [first], [offset(first)]
+    day = first
+    while day < last:
+        next_day = min(day + 24 * 60 * 60, last)
+        if offset(next_day) != offsets[-1]:
+            low, high = day, next_day
+            while high - low > 1:
+                middle = (low + high) // 2
+                if offset(middle) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            times.append(high)
+            offsets.append(offset(high))
+        day = next_day
+    return np.array(times, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+
+def local_minutes(seconds, tz):
+    # unix seconds -> local minutes since the first Monday of 1970
+    if not len(seconds):
+        return seconds
+    times, offsets = utc_offsets(tz, int(seconds.min()), int(seconds.max()))
+    local = seconds + offsets[np.searchsorted(times, seconds, side='right') - 1]
+    return local // 60 - MONDAY
+
+
+def cumulative(minutes):
+    # (n, 168) minutes of each hour of the week from the first Monday until every time
+    weeks, into_week = np.divmod(minutes, WEEK)
+    return weeks[:, None] * 60 + np.clip(into_week[:, None] - HOUR_STARTS, 0, 60)
+
+
+def reserved_minutes(rows, starts, ends, row_count):
+    '''
+        (row_count, 168) minutes reserved per hour of the week, adding up the reservation
+        [starts[i], ends[i]) (local minutes) into matrix row rows[i]
+    '''
+    matrix = np.zeros((row_count, HOURS), dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    rows, starts, ends = rows[order], starts[order], ends[order]
+    for i in range(0, len(rows), CHUNK_SIZE):
+        chunk = slice(i, i + CHUNK_SIZE)
+        # rows are sorted, so each matrix row sums one run of the chunk (np.add.at is far slower)
+        chunk_rows, firsts = np.unique(rows[chunk], return_index=True)
+        matrix[chunk_rows] += np.add.reduceat(cumulative(ends[chunk]) - cumulative(starts[chunk]), firsts, axis=0)
+    return matrix
+
+
+def hours_between(first, last):
+    # how many minutes of each hour of the week there are in [first, last), local minutes
+    return (cumulative(np.array([last])) - cumulative(np.array([first])))[0]
+
+
+def pack(matrix):
+    return zlib.compress(matrix.astype(np.uint32).tobytes())
+
+
+def unpack(heatmap):
+    spots = np.frombuffer(bytes(heatmap.spots), dtype=np.int32)
+    matrix = np.frombuffer(zlib.decompress(bytes(heatmap.minutes)), dtype=np.uint32)
+    return spots, matrix.reshape(len(spots), HOURS).astype(np.int64)
+
+
+def as_datetime(seconds):
+    return datetime.datetime.fromtimestamp(int(seconds), datetime.timezone.utc)
+
+
+def as_arrays(rows):
+    '''
+        (location pks, spot pks, start seconds, end seconds) arrays from rows of RESERVATION_COLUMNS
+    '''
+    if not rows:
+        return tuple(np.zeros(0, dtype=np.int64) for i in range(4))
+    locations, spots, starts, ends = (np.array(column) for column in zip(*rows))
+    return (locations.astype(np.int64), spots.astype(np.int64),
+            np.rint(starts).astype(np.int64), np.rint(ends).astype(np.int64))
+
+
+def read_reservations(**filters):
+    # current and archived ones
+    rows = []
+    for model in (Reservation, ArchivedReservation):
+        rows += model.objects.filter(canceled=False, **filters).values_list(*RESERVATION_COLUMNS).order_by()
+    return as_arrays(rows)
+
+
+def count(heatmaps, locations, spots, starts, ends, tz):
+    '''
+        Adds the reservations to the matrices of their locations, heatmaps maps location pk ->
+        [spot pks, matrix, first start, last end], missing locations start out empty
+    '''
+    local_starts, local_ends = local_minutes(starts, tz), local_minutes(ends, tz)
+    for location in np.unique(locations):
+        mine = locations == location
+        entry = heatmaps.setdefault(int(location), [np.zeros(0, dtype=np.int32),
+                                                    np.zeros((0, HOURS), dtype=np.int64), None, None])
+        new_spots = np.setdiff1d(spots[mine], entry[0])
+        if len(new_spots):
+            entry[0] = np.concatenate([entry[0], new_spots.astype(np.int32)])
+            entry[1] = np.vstack([entry[1], np.zeros((len(new_spots), HOURS), dtype=np.int64)])
+        order = np.argsort(entry[0])
+        rows = order[np.searchsorted(entry[0], spots[mine], sorter=order)]
+        entry[1] += reserved_minutes(rows, local_starts[mine], local_ends[mine], len(entry[0]))
+        first, last = int(starts[mine].min()), int(ends[mine].max())
+        entry[2] = first if entry[2] is None else min(entry[2], first)
+        entry[3] = last if entry[3] is None else max(entry[3], last)
+
+
+def refresh(full=False):
+    '''
+        Brings the heatmaps up to date, returns (locations counted from scratch, locations added to)
+    '''
+    tz = timezone.get_default_timezone()
+    with transaction.atomic():
+        since = None if full else OccupancyHeatmap.objects.aggregate(since=Min('counted_until'))['since']
+        counted_until = Reservation.objects.aggregate(newest=Max('updated_at'))['newest'] or timezone.now()
+        heatmaps = {}
+        if since is None:
+            OccupancyHeatmap.objects.all().delete()
+            count(heatmaps, *read_reservations(), tz)
+            recount, added_to = set(heatmaps), set()
+        else:
+            stored = {heatmap.location_id: heatmap
+                      for heatmap in OccupancyHeatmap.objects.defer('spots', 'minutes')}
+            recount = {location for location, heatmap in stored.items() if heatmap.stale}
+            new_rows = []
+            # archived before a refresh saw them, or while it ran
+            changed = [row for model in (Reservation, ArchivedReservation) for row in model.objects.filter(
+                updated_at__gt=since).values_list('created_at', 'updated_at', 'canceled', *RESERVATION_COLUMNS)]
+            for created_at, updated_at, canceled, *row in changed:
+                heatmap = stored.get(row[0])
+                if heatmap is not None and updated_at <= heatmap.counted_until:
+                    continue
+                if heatmap is None or created_at > heatmap.counted_until:
+                    if not canceled:
+                        new_rows.append(row)    # not counted anywhere yet
+                else:
+                    recount.add(row[0])
+            if recount:
+                count(heatmaps, *read_reservations(parking_spot__location__in=recount), tz)
+            new_rows = [row for row in new_rows if row[0] not in recount]
+            added_to = {row[0] for row in new_rows}
+            for location in added_to & set(stored):
+                heatmap = stored[location]
+                heatmaps[location] = [*unpack(heatmap), int(heatmap.first_start.timestamp()),
+                                      int(heatmap.last_end.timestamp())]
+            count(heatmaps, *as_arrays(new_rows), tz)
+
+        for location, (spots, matrix, first, last) in heatmaps.items():
+            OccupancyHeatmap.objects.update_or_create(location_id=location, defaults={
+                'spots': spots.astype(np.int32).tobytes(), 'minutes': pack(matrix),
+                'first_start': as_datetime(first), 'last_end': as_datetime(last),
+                'counted_until': counted_until, 'stale': False,
+            })
+        # lots whose reservations are all gone or canceled now
+        OccupancyHeatmap.objects.filter(location__in=recount - set(heatmaps)).delete()
+        OccupancyHeatmap.objects.filter(counted_until__lt=counted_until).update(counted_until=counted_until)
+    return len(recount), len(added_to)
+
+
+def hour_shares(heatmap, spot=None, spot_count=1):
+    '''
+        (168,) shares of time taken in every hour of the week, of one spot or of the whole
+        location when it has spot_count spots
+    '''
+    tz = timezone.get_default_timezone()
+    first, last = local_minutes(np.array([int(heatmap.first_start.timestamp()),
+                                          int(heatmap.last_end.timestamp())]), tz)
+    available = hours_between(first, last).astype(np.float64)
+    spots, matrix = unpack(heatmap)
+    if spot is not None:
+        taken = matrix[spots == spot].sum(axis=0)
+    else:
+        taken = matrix.sum(axis=0)
+        available *= spot_count
+    return np.minimum(np.divide(taken, available, out=np.zeros(HOURS), where=available > 0), 1.0)
+
+
+def shares(heatmap, spot=None):
+    '''
+        7 x 24 shares of time taken, Monday first, for the whole location or one of its spots
+    '''
+    spot_count = 1 if spot is not None else ParkingSpot.objects.filter(location_id=heatmap.location_id).count() or 1
+    return np.round(hour_shares(heatmap, spot, spot_count), 3).reshape(7, 24).tolist()
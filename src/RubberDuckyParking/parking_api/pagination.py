@@ -0,0 +1,192 @@
+import base64
+import binascii
+import datetime
+import functools
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import fast_serializers, metrics
+
+
+class CursorPagination(BasePagination):
+    '''
+        Keyset pagination. The cursor holds every ordering key of the last row on a page,
+        so the next page is "WHERE (created_at, pk) > (cursor) LIMIT n" and never an OFFSET scan,
+        even when the first key has ties. The ordering has to end in a unique column.
+        Responses look like DRF's CursorPagination: {"next", "previous", "results"}
+        The queryset can be a list of querysets over tables with the same columns (the current and
+        archived reservations, see archive.py), each gives its first rows past the cursor and those
+        are merged into one page.
+    '''
+    ordering = ('pk',)
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        reverse, position = self.decode_cursor(request)
+
+        ordering = self.ordering if not reverse else [self._flip(field) for field in self.ordering]
+        querysets = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+        results = []
+        for queryset in querysets:
+            queryset = queryset.order_by(*ordering)
+            if position is not None:
+                queryset = queryset.filter(self.keyset_filter(ordering, position))
+            results += queryset[:self.page_size + 1]
+        if len(querysets) > 1:
+            results = self.merge(results, ordering)[:self.page_size + 1]
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        # going backwards we know there is a next page because we came from it
+        self.has_next = (has_more and not reverse) or (reverse and position is not None)
+        self.has_previous = (position is not None and not reverse) or (has_more and reverse)
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size
+                )
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(False, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(True, self.page[0])
+
+    def merge(self, rows, ordering):
+        # in the order of ordering, a row that moved between tables while they were read counts once
+        def compare(a, b):
+            for field in ordering:
+                x, y = self._read(a, self._name(field)), self._read(b, self._name(field))
+                if x != y:
+                    return (-1 if x < y else 1) * (-1 if field.startswith('-') else 1)
+            return 0
+        rows = sorted(rows, key=functools.cmp_to_key(compare))
+        return [row for i, row in enumerate(rows) if i == 0 or compare(rows[i - 1], row)]
+
+    def keyset_filter(self, ordering, position):
+        # (a, b, c) > (x, y, z)  ==  a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        query = Q()
+        for i, field in enumerate(ordering):
+            equal = {self._name(prior): value for prior, value in zip(ordering[:i], position[:i])}
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            query |= Q(**equal, **{self._name(field) + lookup: position[i]})
+        return query
+
+    def encode_cursor(self, reverse, instance):
+        position = [self._json_value(self._read(instance, self._name(field))) for field in self.ordering]
+        data = json.dumps({'r': int(reverse), 'p': position}, separators=(',', ':'))
+        cursor = base64.urlsafe_b64encode(data.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii'))
+            reverse = bool(data['r'])
+            position = list(data['p'])
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return reverse, position
+
+    @staticmethod
+    def _read(instance, name):
+        # instance is a model instance, or a row dict on the fast_serializers path
+        return instance[name] if isinstance(instance, dict) else getattr(instance, name)
+
+    @staticmethod
+    def _name(field):
+        return field.lstrip('-')
+
+    @staticmethod
+    def _flip(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    @staticmethod
+    def _json_value(value):
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        return value
+
+
+class ReservationCursorPagination(CursorPagination):
+    ordering = ('created_at', 'pk')
+
+
+class PaginatedListMixin:
+    '''
+        For plain ViewSets, which don't get pagination from DRF the way GenericViewSets do
+    '''
+    pagination_class = CursorPagination
+    fast_read = False   # build list responses from .values() rows with fast_serializers
+
+    def paginated_response(self, queryset, serializer_class, ordering=None):
+        paginator = self.pagination_class()
+        if ordering:
+            paginator.ordering = ordering
+        if self.fast_read:
+            fast = fast_serializers.for_serializer(serializer_class)
+            keys = [paginator._name(field) for field in paginator.ordering]
+            if isinstance(queryset, (list, tuple)):
+                queryset = [fast.values(part, *keys) for part in queryset]
+            else:
+                queryset = fast.values(queryset, *keys)
+            page = paginator.paginate_queryset(queryset, self.request, view=self)
+            with metrics.serializing(self.request):
+                data = fast.many(page)
+            return paginator.get_paginated_response(data)
+        page = paginator.paginate_queryset(queryset, self.request, view=self)
+        with metrics.serializing(self.request):
+            data = serializer_class(page, many=True).data
+        return paginator.get_paginated_response(data)
+
+    def serialize_many(self, queryset, serializer_class):
+        # the rows are read first, so the serializer time leaves out the query
+        if self.fast_read:
+            fast = fast_serializers.for_serializer(serializer_class)
+            rows = list(fast.values(queryset))
+            with metrics.serializing(self.request):
+                return fast.many(rows)
+        rows = list(queryset)
+        with metrics.serializing(self.request):
+            return serializer_class(rows, many=True).data
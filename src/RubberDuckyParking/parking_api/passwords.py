@@ -0,0 +1,157 @@
+'''
+    Password hashing for logins and signups in a bounded pool of worker processes.
+
+    PBKDF2 runs for tens of milliseconds of CPU on purpose. Run by the request threads, a burst of logins
+    before an event takes every CPU of the server and cheap reads queue behind the key stretching. Here
+    /api/api-token-auth/ and signups hand hashing and checking to PASSWORD_WORKERS processes, so at most
+    that many CPUs stretch keys while the request threads wait without holding the GIL.
+
+    At most PASSWORD_QUEUE requests wait for a worker. More get 503 with a Retry-After worked out from
+    the queue and how long a hash takes, instead of piling up until they time out. Requests that can't
+    get a result in PASSWORD_TIMEOUT seconds get the same.
+
+    The pool is per server process and starts with the first login. Its depth, how many tasks it ran
+    and rejected and how long they took are in /api/_metrics. With PASSWORD_WORKERS = 0 hashing happens
+    in the request thread.
+'''
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from rest_framework.exceptions import APIException
+
+DEFAULT_SECONDS = 0.1   # what a task is assumed to take before any finished
+
+
+class PoolBusy(APIException):
+    status_code = 503
+    default_detail = 'Too many logins at once, try again in a moment.'
+    default_code = 'busy'
+
+    def __init__(self, wait):
+        super().__init__()
+        self.wait = wait    # DRF sends it as Retry-After
+
+
+def make(password):
+    return hashers.make_password(password)
+
+
+def verify(password, encoded):
+    '''
+        (whether password matches encoded, a new hash of it when encoded is from an outdated hasher)
+    '''
+    updated = []
+    valid = hashers.check_password(password, encoded, setter=lambda raw: updated.append(hashers.make_password(raw)))
+    return valid, updated[0] if updated else None
+
+
+class HashPool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.in_flight = 0      # submitted and not done, running or waiting for a worker
+        self.done = 0
+        self.rejected = 0
+        self.seconds = 0.0      # from submit until done, added up
+
+    def capacity(self):
+        return settings.PASSWORD_WORKERS + settings.PASSWORD_QUEUE
+
+    def retry_after(self):
+        # seconds until the queue has drained, at least 1
+        each = self.seconds / self.done if self.done else DEFAULT_SECONDS
+        return max(1, math.ceil(self.in_flight * each / settings.PASSWORD_WORKERS))
+
+    def finished(self, start):
+        def callback(future):
+            with self.lock:
+                self.in_flight -= 1
+                self.done += 1
+                self.seconds += time.perf_counter() - start
+        return callback
+
+    def run(self, function, *args):
+        if not settings.PASSWORD_WORKERS:
+            return function(*args)
+        with self.lock:
+            if self.in_flight >= self.capacity():
+                self.rejected += 1
+                raise PoolBusy(self.retry_after())
+            if self.executor is None:
+                # spawned, a fork of a server process with threads running can inherit held locks
+                self.executor = ProcessPoolExecutor(max_workers=settings.PASSWORD_WORKERS,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            executor = self.executor
+            self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            future = executor.submit(function, *args)
+        except BrokenProcessPool:
+            with self.lock:
+                self.in_flight -= 1
+            self.broken(executor)
+            raise PoolBusy(1)
+        future.add_done_callback(self.finished(start))
+        try:
+            return future.result(timeout=settings.PASSWORD_TIMEOUT)
+        except TimeoutError:
+            with self.lock:
+                self.rejected += 1
+                raise PoolBusy(self.retry_after())
+        except BrokenProcessPool:
+            # a worker died, the next request starts a new pool
+            self.broken(executor)
+            raise PoolBusy(1)
+
+    def broken(self, executor):
+        # its futures fail and still count themselves done
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': settings.PASSWORD_WORKERS, 'capacity': self.capacity(), 'in_flight': self.in_flight,
+                'done': self.done, 'rejected': self.rejected, 'seconds': self.seconds,
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.done = self.rejected = 0
+            self.seconds = 0.0
+
+
+pool = HashPool()
+
+
+def hash_password(password):
+    return pool.run(make, password)
+
+
+def authenticate(model, username, password):
+    '''
+        The active user with that username and password, else None. Like django's ModelBackend, with the
+        hashing in the pool
+    '''
+    try:
+        user = model._default_manager.get_by_natural_key(username)
+    except model.DoesNotExist:
+        # as slow as a wrong password, so response times don't tell which usernames exist
+        pool.run(make, password)
+        return None
+    valid, updated = pool.run(verify, password, user.password)
+    if not valid or not user.is_active:
+        return None
+    if updated:
+        # the hasher or its iterations changed since the password was set
+        user.password = updated
+        user.save(update_fields=['password'])
+    return user
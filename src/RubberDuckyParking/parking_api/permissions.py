@@ -1,5 +1,10 @@
 from rest_framework.exceptions import APIException
 from rest_framework.permissions import BasePermission
+from .roles import get_roles
+
+# viewset actions that only read, open to anyone on the catalog viewsets and served from read replicas
+# (databases.py)
+SAFE_METHODS = ['list', 'retrieve']
 
 class AuthenticatedPermission(BasePermission):
     # authenticated users
@@ -16,7 +21,7 @@ class HostPermission(AuthenticatedPermission):
     def has_permission(self, request, view):
         if not super().has_permission(request, view):
             return False
-        return request.user.is_host()
+        return get_roles(request).is_host
 
 class AttendantPermission(AuthenticatedPermission):
     message = "You must be an attendant or host"
@@ -24,5 +29,6 @@ class AttendantPermission(AuthenticatedPermission):
     def has_permission(self, request, view):
         if not super().has_permission(request, view):
             return False
-        return request.user.is_host() or request.user.is_attendant()
+        roles = get_roles(request)
+        return roles.is_host or roles.is_attendant
 
@@ -0,0 +1,191 @@
+'''
+    Quotes: what a time window costs at a parking spot, with the location's PricingRules applied.
+
+    The window is cut into segments at every local hour boundary and at the edges of the events
+    it overlaps, so each rule either applies to a whole segment or not at all:
+    - hours: the hourly price times multiplier in the given hours of the given weekdays
+    - event: the hourly price times multiplier while the event lasts, plus amount once
+    - occupancy: the hourly price times multiplier in hours of the week the location is at least
+      threshold full (the heatmaps of occupancy.py)
+    - day_cap: at most amount per local calendar day, after the multipliers, before event amounts
+    Multipliers of overlapping rules multiply. Rules of a location apply to all its spots,
+    rules with a spot only to that spot, on top of the location's.
+
+    Spots only differ in their price and in which rules they have, so quote() works out one row of
+    price factors per segment for each distinct set of rules (the spots without rules share row 0,
+    each location with rules gets a row, each spot with its own rules one more), adds them up per
+    day, and prices every candidate spot with one (spots, days) numpy operation.
+'''
+import datetime
+
+import numpy as np
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import occupancy
+from .models import OccupancyHeatmap, ParkingSpot, PricingRule
+
+MAX_DAYS = 31       # longest window the quote endpoint and spot lists price
+RULE_COLUMNS = ('kind', 'location_id', 'spot_id', 'multiplier', 'amount', 'days', 'start_hour', 'end_hour',
+                'starts_at', 'ends_at', 'threshold')
+
+
+def seconds(moment):
+    return int(moment.timestamp())
+
+
+def find(keys, values):
+    # (whether each value is in the sorted array keys, its position there)
+    i = np.searchsorted(keys, values)
+    found = i < len(keys)
+    found[found] = keys[i[found]] == values[found]
+    return found, i
+
+
+def segments(start, end, events, tz):
+    '''
+        (segment starts, segment lengths in hours, local hour of the week, local day number)
+        of [start, end) in unix seconds, cut at local hours and at the event edges
+    '''
+    times, offsets = occupancy.utc_offsets(tz, start, end)
+    shift = int(offsets[0]) % 3600      # offsets change by whole hours, so local hours start at this
+    first_hour = ((start + shift) // 3600 + 1) * 3600 - shift
+    bounds = np.concatenate([[start, end], np.arange(first_hour, end, 3600), np.ravel(events)])
+    bounds = np.unique(bounds[(bounds >= start) & (bounds <= end)])
+    starts = bounds[:-1]
+    local = occupancy.local_minutes(starts, tz)
+    return starts, np.diff(bounds) / 3600, (local // 60) % occupancy.HOURS, local // (24 * 60)
+
+
+def read_rules(queryset, start, end):
+    '''
+        Arrays of RULE_COLUMNS for the rules of queryset that can apply to [start, end)
+    '''
+    rules = list(queryset.filter(~Q(kind='event') | Q(starts_at__lt=end, ends_at__gt=start)).values_list(*RULE_COLUMNS))
+    columns = dict(zip(RULE_COLUMNS, zip(*rules))) if rules else dict.fromkeys(RULE_COLUMNS, ())
+    arrays = {name: np.array(columns[name], dtype=np.float64)
+              for name in ('multiplier', 'amount', 'threshold')}
+    arrays.update({name: np.array(columns[name], dtype=np.int64)
+                   for name in ('location_id', 'days', 'start_hour', 'end_hour')})
+    arrays['kind'] = np.array(columns['kind'], dtype=object)
+    arrays['spot_id'] = np.array([-1 if pk is None else pk for pk in columns['spot_id']], dtype=np.int64)
+    for name in ('starts_at', 'ends_at'):
+        arrays[name] = np.array([0 if moment is None else seconds(moment) for moment in columns[name]],
+                                dtype=np.int64)
+    return arrays
+
+
+def location_shares(locations):
+    # location pk -> (168,) shares of time taken, for the locations that have a heatmap
+    spot_counts = dict(ParkingSpot.objects.filter(location__in=locations).values('location')
+                       .annotate(count=Count('pk')).values_list('location', 'count'))
+    return {heatmap.location_id: occupancy.hour_shares(heatmap, spot_count=spot_counts.get(heatmap.location_id) or 1)
+            for heatmap in OccupancyHeatmap.objects.filter(location__in=locations)}
+
+
+def rule_factors(rules, starts, hour_of_week):
+    '''
+        (rules, segments) price factors: the rule's multiplier in the segments it applies to, else 1
+    '''
+    kind = rules['kind'][:, None]
+    weekday, hour = hour_of_week // 24, hour_of_week % 24
+    start_hour, end_hour = rules['start_hour'][:, None], rules['end_hour'][:, None]
+    in_hours = np.where(start_hour <= end_hour,
+                        (hour >= start_hour) & (hour < end_hour),
+                        (hour >= start_hour) | (hour < end_hour))
+    on_day = (rules['days'][:, None] >> weekday) & 1 == 1
+    applies = (kind == 'hours') & in_hours & on_day
+    applies |= (kind == 'event') & (starts >= rules['starts_at'][:, None]) & (starts < rules['ends_at'][:, None])
+
+    busy = np.flatnonzero(rules['kind'] == 'occupancy')
+    if len(busy):
+        shares = location_shares(set(rules['location_id'][busy].tolist()))
+        no_heatmap = np.zeros(occupancy.HOURS)
+        for i in busy:
+            share = shares.get(int(rules['location_id'][i]), no_heatmap)
+            applies[i] = share[hour_of_week] >= rules['threshold'][i]
+    return np.where(applies, rules['multiplier'][:, None], 1.0)
+
+
+def quotable(start, end):
+    # whether the api prices [start, end) for searches, a booking of any length still gets its price
+    return end - start <= datetime.timedelta(days=MAX_DAYS)
+
+
+def quote(spots, start, end):
+    '''
+        What [start, end) costs at every spot of the queryset spots.
+        Returns (spot pks, totals rounded to cents) as numpy arrays, in no particular order
+    '''
+    rows = list(spots.order_by().values_list('pk', 'location_id', 'price'))
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    pks, locations, prices = (np.array(column) for column in zip(*rows))
+    rules = read_rules(PricingRule.objects.filter(location__in=spots.order_by().values('location')), start, end)
+    return pks.astype(np.int64), price(locations.astype(np.int64), pks.astype(np.int64), prices.astype(np.float64),
+                                       rules, start, end)
+
+
+def quote_spot(spot, start, end):
+    '''
+        What [start, end) costs at one spot, a ParkingSpot instance
+    '''
+    rules = read_rules(PricingRule.objects.filter(location=spot.location_id), start, end)
+    return float(price(np.array([spot.location_id]), np.array([spot.pk]), np.array([spot.price], dtype=np.float64),
+                       rules, start, end)[0])
+
+
+def price(locations, pks, prices, rules, start, end):
+    '''
+        Totals of [start, end), rounded to cents, for the spots given as arrays, with the rules of their
+        locations from read_rules()
+    '''
+    tz = timezone.get_default_timezone()
+    # spot rules of spots that are not being quoted don't matter
+    keep = (rules['spot_id'] < 0) | np.isin(rules['spot_id'], pks)
+    rules = {name: column[keep] for name, column in rules.items()}
+    events = rules['kind'] == 'event'
+    starts, hours, hour_of_week, days = segments(seconds(start), seconds(end),
+                                                 [rules['starts_at'][events], rules['ends_at'][events]], tz)
+
+    # row 0 has no rules, then one row per location with rules, then one per spot with its own rules
+    for_spot = rules['spot_id'] >= 0
+    rule_locations = np.unique(rules['location_id'][~for_spot])
+    rule_spots = np.unique(rules['spot_id'][for_spot])
+    row_count = 1 + len(rule_locations) + len(rule_spots)
+    rule_rows = np.where(
+        for_spot,
+        1 + len(rule_locations) + np.searchsorted(rule_spots, rules['spot_id']),
+        1 + np.searchsorted(rule_locations, rules['location_id']),
+    )
+
+    has_rules, i = find(rule_locations, locations)
+    spot_rows = np.where(has_rules, 1 + i, 0)
+    has_own, i = find(rule_spots, pks)
+    own_rows = 1 + len(rule_locations) + i[has_own]
+    # spot rows build on the row of their location
+    parent = np.zeros(row_count, dtype=np.int64)
+    parent[own_rows] = spot_rows[has_own]
+    spot_rows[has_own] = own_rows
+
+    factors = np.ones((row_count, len(starts)))
+    order = np.argsort(rule_rows, kind='stable')
+    if len(order):
+        targets, firsts = np.unique(rule_rows[order], return_index=True)
+        factors[targets] = np.multiply.reduceat(rule_factors({name: column[order] for name, column in rules.items()},
+                                                              starts, hour_of_week), firsts, axis=0)
+    factors *= factors[parent]
+
+    caps = np.full(row_count, np.inf)
+    capped = rules['kind'] == 'day_cap'
+    np.minimum.at(caps, rule_rows[capped], rules['amount'][capped])
+    caps = np.minimum(caps, caps[parent])
+    surcharges = np.zeros(row_count)
+    np.add.at(surcharges, rule_rows[events], rules['amount'][events])
+    surcharges += surcharges[parent]
+
+    # hours each row is charged for per local day, then every spot at once
+    day_firsts = np.flatnonzero(np.diff(days, prepend=days[0] - 1))
+    per_day = np.add.reduceat(factors * hours, day_firsts, axis=1)
+    charges = np.minimum(prices[:, None] * per_day[spot_rows], caps[spot_rows][:, None])
+    return np.round(charges.sum(axis=1) + surcharges[spot_rows], 2)
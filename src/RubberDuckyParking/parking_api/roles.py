@@ -0,0 +1,73 @@
+from django.core.exceptions import ObjectDoesNotExist
+
+from .models import BaseProfile
+
+
+class Roles:
+    '''
+        What a user is allowed to act as. A user has at most one profile, which is either a Host or an
+        Attendant, so one query with left joins finds the host, the attendant and the attendant's boss
+    '''
+
+    def __init__(self, user, profile=None):
+        self.user = user
+        self.host = self._child(profile, 'host')
+        self.attendant = self._child(profile, 'attendant')
+        # the serializers read .user off these, and it is the user we already have
+        if self.host is not None:
+            self.host.user = user
+        if self.attendant is not None:
+            self.attendant.user = user
+
+    @staticmethod
+    def _child(profile, name):
+        if profile is None:
+            return None
+        try:
+            return getattr(profile, name)
+        except ObjectDoesNotExist:
+            return None
+
+    @property
+    def is_host(self):
+        return self.host is not None
+
+    @property
+    def is_attendant(self):
+        return self.attendant is not None
+
+    @property
+    def lot_host(self):
+        # the host whose lots this user manages: their own as a host, their boss's as an attendant
+        if self.host is not None:
+            return self.host
+        if self.attendant is not None:
+            return self.attendant.boss
+        return None
+
+    @classmethod
+    def load(cls, user):
+        if user is None or not user.is_authenticated:
+            return cls(user)
+        profile = (BaseProfile.objects
+                   .select_related('host', 'attendant__boss')
+                   .filter(user__pk=user.pk)
+                   .first())
+        return cls(user, profile)
+
+
+def get_roles(request):
+    '''
+        Roles of request.user, loaded once per request
+    '''
+    user = getattr(request, 'user', None)
+    roles = getattr(request, '_parking_roles', None)
+    if roles is None or roles.user is not user:
+        roles = Roles.load(user)
+        request._parking_roles = roles
+    return roles
+
+
+def forget_roles(request):
+    # after a request makes the user a host or attendant
+    request._parking_roles = None
@@ -0,0 +1,139 @@
+'''
+    Earnings rollups: Transactions added up per day and per month for every host, location and spot.
+
+    A saved transaction adds itself to its six rollup rows (three scopes, two periods) with one
+    INSERT ... ON CONFLICT DO UPDATE, and a changed or deleted one takes its old amounts back out
+    (signals.py). An earnings query then reads one row per period, however long the history is.
+    Days and months are those of settings.TIME_ZONE.
+
+    host_pk is a plain integer rather than a foreign key: when a host is deleted, the deletes of their
+    transactions cascade in after the rollups could have been, and would write rows for a host that is
+    gone. The rollups of a deleted host are dropped once the host is (signals.py).
+
+    bulk_create() and queryset.update() of transactions send no signals, code using them runs
+    the rebuild_rollups command afterwards.
+'''
+import datetime
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+
+from .models import EarningsRollup, ParkingSpot, Transactions
+
+AMOUNTS = ('user_charge', 'fee_amount', 'host_income')
+COLUMNS = ('scope', 'scope_pk', 'period', 'start', 'host_pk', 'transactions') + AMOUNTS
+BATCH_SIZE = 5000
+DEFAULT_SPAN = {'day': 30, 'month': 12}     # periods shown when no from is given
+MAX_SPAN = {'day': 366, 'month': 120}
+
+
+def local_day(moment):
+    return timezone.localtime(moment, timezone.get_default_timezone()).date()
+
+
+def rollup_keys(host_pk, location_pk, spot_pk, day):
+    # (scope, scope_pk, period, start) of every rollup row a transaction on that day counts in
+    month = day.replace(day=1)
+    for scope, scope_pk in (('host', host_pk), ('location', location_pk), ('spot', spot_pk)):
+        yield scope, scope_pk, 'day', day
+        yield scope, scope_pk, 'month', month
+
+
+def period_start(period, day):
+    return day.replace(day=1) if period == 'month' else day
+
+
+def default_from(period, to):
+    if period == 'month':
+        months = to.year * 12 + to.month - DEFAULT_SPAN['month']
+        return to.replace(year=months // 12, month=months % 12 + 1, day=1)
+    return to - datetime.timedelta(days=DEFAULT_SPAN['day'] - 1)
+
+
+def span(period, first, last):
+    # number of periods from first to last, both included
+    if period == 'month':
+        return (last.year - first.year) * 12 + last.month - first.month + 1
+    return (last - first).days + 1
+
+
+def contribution(instance):
+    '''
+        (host pk, location pk, spot pk, day, amounts) of a transaction,
+        None if its spot is gone and there is no host to count it for
+    '''
+    host_pk = ParkingSpot.objects.filter(pk=instance.spot_id).values_list('owner_id', flat=True).first()
+    if host_pk is None:
+        return None
+    amounts = tuple(getattr(instance, name) for name in AMOUNTS)
+    return host_pk, instance.location_id, instance.spot_id, local_day(instance.date), amounts
+
+
+def stored_contribution(pk):
+    # what the row of a transaction that is about to be saved counts for now
+    instance = Transactions.objects.filter(pk=pk).only('date', 'location', 'spot', *AMOUNTS).first()
+    return contribution(instance) if instance is not None else None
+
+
+def upsert_sql():
+    quote = connection.ops.quote_name
+    table = quote(EarningsRollup._meta.db_table)
+    added = ['transactions', *AMOUNTS]
+    return (
+        f'INSERT INTO {table} ({", ".join(quote(column) for column in COLUMNS)}) '
+        f'VALUES ({", ".join(["%s"] * len(COLUMNS))}) '
+        f'ON CONFLICT ({", ".join(quote(column) for column in ("scope", "scope_pk", "period", "start"))}) '
+        f'DO UPDATE SET {", ".join(f"{quote(c)} = {table}.{quote(c)} + excluded.{quote(c)}" for c in added)}'
+    )
+
+
+def apply(old, new):
+    '''
+        Moves a transaction's amounts in the rollups from its old contribution to its new one,
+        either can be None
+    '''
+    rows = []
+    for sign, counted in ((-1, old), (1, new)):
+        if counted is None:
+            continue
+        host_pk, location_pk, spot_pk, day, amounts = counted
+        for scope, scope_pk, period, start in rollup_keys(host_pk, location_pk, spot_pk, day):
+            rows.append([scope, scope_pk, period, connection.ops.adapt_datefield_value(start), host_pk, sign]
+                        + [sign * amount for amount in amounts])
+    if rows:
+        with connection.cursor() as cursor:
+            cursor.executemany(upsert_sql(), rows)
+
+
+def rebuild():
+    '''
+        Recomputes every rollup from the transactions table, returns the number of rows written
+    '''
+    tz = timezone.get_default_timezone()
+    per_spot_day = (Transactions.objects
+                    .annotate(day=TruncDay('date', tzinfo=tz))
+                    .values('spot__owner', 'location', 'spot', 'day')
+                    .annotate(count=Count('pk'), **{name: Sum(name) for name in AMOUNTS})
+                    .order_by())
+    totals = {}
+    with transaction.atomic():
+        for row in per_spot_day.iterator(chunk_size=BATCH_SIZE):
+            day = timezone.localtime(row['day'], tz).date()
+            for key in rollup_keys(row['spot__owner'], row['location'], row['spot'], day):
+                total = totals.get(key)
+                if total is None:
+                    total = totals[key] = [row['spot__owner'], 0] + [0] * len(AMOUNTS)
+                total[1] += row['count']
+                for i, name in enumerate(AMOUNTS, 2):
+                    total[i] += row[name]
+
+        EarningsRollup.objects.all().delete()
+        # the upsert inserts into the empty table, without building a model instance per row
+        rows = [[scope, scope_pk, period, connection.ops.adapt_datefield_value(start), *total]
+                for (scope, scope_pk, period, start), total in totals.items()]
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), BATCH_SIZE):
+                cursor.executemany(upsert_sql(), rows[i:i + BATCH_SIZE])
+    return len(totals)
@@ -0,0 +1,111 @@
+'''
+    Full text search over Locations.
+    On sqlite this is an FTS5 table keyed by the location id, kept in sync from signals.py.
+    Other database backends fall back to icontains filters in the views.
+'''
+import re
+
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'parking_api_location_fts'
+FTS_COLUMNS = ('name', 'description', 'address', 'city', 'state', 'zip_code')
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def is_enabled(conn=connection):
+    return conn.vendor == 'sqlite'
+
+
+def create_index(conn=connection):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5('
+            f'{", ".join(FTS_COLUMNS)}, tokenize="unicode61 remove_diacritics 2")'
+        )
+
+
+def drop_index(conn=connection):
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def rebuild_index(conn=connection):
+    '''
+        Re-fills the index from the location table, for rows written without signals (bulk_create, update())
+    '''
+    if not is_enabled(conn):
+        return
+    columns = ', '.join(FTS_COLUMNS)
+    with conn.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        cursor.execute(f'INSERT INTO {FTS_TABLE} (rowid, {columns}) SELECT id, {columns} FROM parking_api_location')
+
+
+def index_location(location):
+    if not is_enabled():
+        return
+    columns = ', '.join(FTS_COLUMNS)
+    placeholders = ', '.join(['%s'] * (len(FTS_COLUMNS) + 1))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [location.pk])
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, {columns}) VALUES ({placeholders})',
+            [location.pk] + [getattr(location, column) for column in FTS_COLUMNS]
+        )
+
+
+def unindex_location(location_pk):
+    if not is_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [location_pk])
+
+
+def search_terms(text):
+    # single letters match nearly everything as prefixes, so they are dropped
+    return [term for term in TERM_RE.findall(text or '') if len(term) > 1]
+
+
+def match_expression(terms):
+    # every term is quoted so user input can't inject FTS syntax, and * makes it a prefix match
+    return ' OR '.join('"{}"*'.format(term.replace('"', '')) for term in terms)
+
+
+def search_locations(text):
+    '''
+        Returns location ids, best match first (bm25 ranking)
+    '''
+    terms = search_terms(text)
+    if not terms:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank',
+            [match_expression(terms)]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def filter_matches(queryset, text, field='location'):
+    '''
+        The rows of queryset whose location (the foreign key field) matches text, every match,
+        annotated with search_rank, the bm25 rank of the location (lower is better)
+    '''
+    terms = search_terms(text)
+    if not terms:
+        return queryset.none()
+    expression = match_expression(terms)
+    quote = connection.ops.quote_name
+    meta = queryset.model._meta
+    location_id = f'{quote(meta.db_table)}.{quote(meta.get_field(field).column)}'
+    # filtered and ranked in the query itself, so no id list is passed around and keyset pages
+    # go on through the whole ranking
+    return queryset.filter(**{
+        f'{field}__in': RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [expression]),
+    }).annotate(search_rank=RawSQL(
+        f'SELECT rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid = {location_id}',
+        [expression], output_field=FloatField(),
+    ))
@@ -1,28 +1,82 @@
 from rest_framework import serializers
-from .models import BaseUser, Host, Attendant, ParkingSpot, ParkingSize, Location, Reservation
+from rest_framework.authtoken.serializers import AuthTokenSerializer
+from . import geo, availability, images, passwords
+from .models import (
+    BaseUser, Host, Attendant, ParkingSpot, ParkingSize, Location, LocationImage, Reservation, EarningsRollup,
+    PricingRule, Vehicle,
+)
+
+
+class EagerLoadingMixin:
+    '''
+        Serializers that nest other models list the relations they touch here,
+        so viewsets can load a whole page in a fixed number of queries
+    '''
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        return queryset
+
+
+class ImageVariantsField(serializers.Field):
+    '''
+        [{width, url}] of the sized variants of an image from the field keeping their key,
+        None while they are still being made (see images.py)
+    '''
+    column_representation = True    # fast_serializers can hand to_representation the column value
+
+    def __init__(self, model, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+        self.model = model
+
+    def to_representation(self, key):
+        return images.variant_urls(self.model, key)
 
 
 class BaseUserSerializer(serializers.ModelSerializer):
+    avatar_variants = ImageVariantsField(BaseUser)
+
     class Meta:
         model = BaseUser
-        fields = ['pk', 'username', 'email', 'first_name', 'last_name', 'password']
+        fields = ['pk', 'username', 'email', 'first_name', 'last_name', 'password', 'avatar_variants']
+
+
+class TokenLoginSerializer(AuthTokenSerializer):
+    '''
+        AuthTokenSerializer with the password checked in the hashing pool (see passwords.py)
+    '''
+    def validate(self, attrs):
+        user = passwords.authenticate(BaseUser, attrs['username'], attrs['password'])
+        if user is None:
+            raise serializers.ValidationError('Unable to log in with provided credentials.', code='authorization')
+        attrs['user'] = user
+        return attrs
 
 
 class BaseUserUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = BaseUser
-        fields = ['pk', 'username', 'email', 'first_name', 'last_name', 'password']
+        fields = ['pk', 'username', 'email', 'first_name', 'last_name', 'password', 'avatar']
         read_only_fields = ['password']
 
 
-class HostSerializer(serializers.ModelSerializer):
+class HostSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ('user',)
     user = BaseUserSerializer()
     class Meta:
         model = Host
         fields = ['pk', 'user']
 
 
-class AttendantSerializer(serializers.ModelSerializer):
+class AttendantSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ('user',)
     user = BaseUserSerializer()
     class Meta:
         model = Attendant
@@ -36,11 +90,22 @@ class ParkingSizeSerializer(serializers.ModelSerializer):
 
 
 
-class LocationSerializer(serializers.ModelSerializer):
+class LocationSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ('host__user',)
     host = HostSerializer()
     class Meta:
         model = Location
-        fields = ['pk','name', 'description', 'address', 'city', 'zip_code', 'state', 'host']
+        fields = ['pk','name', 'description', 'address', 'city', 'zip_code', 'state', 'latitude', 'longitude', 'host']
+
+
+class LocationImageSerializer(serializers.ModelSerializer):
+    variants = ImageVariantsField(LocationImage)
+
+    class Meta:
+        model = LocationImage
+        fields = ['pk', 'location', 'image', 'variants']
+        read_only_fields = ['location']
+        extra_kwargs = {'image': {'allow_empty_file': False, 'required': True}}
 
 
 class LocationCreateSerializer(serializers.ModelSerializer):
@@ -48,14 +113,34 @@ class LocationCreateSerializer(serializers.ModelSerializer):
         model = Location
         fields = '__all__'
 
+    def update(self, instance, validated_data):
+        # a new address without new coordinates gets them from the zip code again
+        address_changed = any(field in validated_data for field in ['zip_code', 'city', 'state'])
+        if address_changed and 'latitude' not in validated_data and 'longitude' not in validated_data:
+            instance.latitude = instance.longitude = None
+        return super().update(instance, validated_data)
+
 
-class ParkingSpotSerializer(serializers.ModelSerializer):
+def distance_km(distance_sq):
+    # km from the ?near= point, only set on proximity searches
+    if distance_sq is None:
+        return None
+    return round(geo.distance_sq_to_km(distance_sq), 2)
+
+
+class ParkingSpotSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ('parking_size', 'location__host__user', 'owner__user')
     parking_size = ParkingSizeSerializer(read_only=True)
     location = LocationSerializer(read_only=True)
     owner = HostSerializer(read_only=True)
+    distance = serializers.SerializerMethodField()
+    values_method_fields = {'distance': ('distance_sq', distance_km)}   # see fast_serializers.py
     class Meta:
         model = ParkingSpot
-        fields = ['pk', 'uid', 'parking_size', 'price', 'location', 'notes', 'actual_width', 'actual_length', 'owner']
+        fields = ['pk', 'uid', 'parking_size', 'price', 'location', 'notes', 'actual_width', 'actual_length', 'owner', 'distance']
+
+    def get_distance(self, spot):
+        return distance_km(getattr(spot, 'distance_sq', None))
 
 
 class ParkingSpotCreateSerializer(serializers.ModelSerializer):
@@ -64,7 +149,46 @@ class ParkingSpotCreateSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class ReservationSerializer(serializers.ModelSerializer):
+class ParkingSpotBulkItemSerializer(serializers.ModelSerializer):
+    '''
+        One spot of a bulk upload. Related objects are plain pks here and the view looks them all up
+        at once, instead of one query per item and field. Items with a pk edit that spot
+    '''
+    pk = serializers.IntegerField(required=False)
+    parking_size = serializers.IntegerField(source='parking_size_id')
+    location = serializers.IntegerField(source='location_id')
+
+    class Meta:
+        model = ParkingSpot
+        fields = ['pk', 'uid', 'parking_size', 'price', 'location', 'notes', 'actual_width', 'actual_length']
+
+
+class ReservationWindowMixin:
+    '''
+        Rejects reservations that end before they start or overlap another reservation of the spot.
+        This only reads: views lock the spot (checkout.lock_spot) before validating and save in the same
+        transaction, so no other booking gets in between
+    '''
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        instance = getattr(self, 'instance', None)
+        spot = attrs.get('parking_spot', getattr(instance, 'parking_spot', None))
+        start = attrs.get('start_date', getattr(instance, 'start_date', None))
+        end = attrs.get('end_date', getattr(instance, 'end_date', None))
+        if attrs.get('canceled', getattr(instance, 'canceled', False)) or None in (spot, start, end):
+            return attrs
+        if start >= end:
+            raise serializers.ValidationError({'end_date': 'must be after the start date'})
+        if not availability.is_spot_free(spot, start, end, exclude_pk=getattr(instance, 'pk', None)):
+            raise serializers.ValidationError({'parking_spot': 'this spot is already reserved for that time'})
+        return attrs
+
+
+class ReservationSerializer(EagerLoadingMixin, ReservationWindowMixin, serializers.ModelSerializer):
+    select_related_fields = ('user',) + tuple(
+        'parking_spot__' + field for field in ParkingSpotSerializer.select_related_fields
+    )
     parking_spot = ParkingSpotSerializer(read_only=True)
     user = BaseUserSerializer(read_only=True)
 
@@ -73,8 +197,69 @@ class ReservationSerializer(serializers.ModelSerializer):
         fields = ['pk', 'parking_spot', 'start_date', 'end_date', 'user', 'canceled', 'confirmed']
 
 
-class ReservationCreateSerialzier(serializers.ModelSerializer):
+class ReservationCreateSerialzier(ReservationWindowMixin, serializers.ModelSerializer):
     class Meta:
         model = Reservation
         fields = '__all__'
 
+
+class CheckoutSerializer(serializers.Serializer):
+    parking_spot = serializers.PrimaryKeyRelatedField(queryset=ParkingSpot.objects.all())
+    start_date = serializers.DateTimeField()
+    end_date = serializers.DateTimeField()
+    vehicle = serializers.PrimaryKeyRelatedField(queryset=Vehicle.objects.all())
+    expected_total = serializers.DecimalField(max_digits=8, decimal_places=2, required=False)
+
+    def validate_vehicle(self, vehicle):
+        if vehicle.user_id != self.context['request'].user.pk:
+            raise serializers.ValidationError('not one of your vehicles')
+        return vehicle
+
+
+class EarningsRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EarningsRollup
+        fields = ['start', 'transactions', 'user_charge', 'fee_amount', 'host_income']
+
+
+class PricingRuleSerializer(serializers.ModelSerializer):
+    '''
+        Checks that a rule has what its kind needs, see pricing.py for what each kind does
+    '''
+    class Meta:
+        model = PricingRule
+        fields = ['pk', 'location', 'spot', 'name', 'kind', 'multiplier', 'amount', 'days', 'start_hour', 'end_hour',
+                  'starts_at', 'ends_at', 'threshold']
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        instance = getattr(self, 'instance', None)
+
+        def value(name):
+            return attrs.get(name, getattr(instance, name, PricingRule._meta.get_field(name).get_default()))
+
+        kind = value('kind')
+        spot = value('spot')
+        if spot is not None and spot.location_id != value('location').pk:
+            raise serializers.ValidationError({'spot': 'must be at the location of the rule'})
+        if value('multiplier') < 0:
+            raise serializers.ValidationError({'multiplier': 'must not be negative'})
+        if kind == 'hours':
+            if not 0 <= value('start_hour') <= 23 or not 1 <= value('end_hour') <= 24:
+                raise serializers.ValidationError({'start_hour': 'hours go from 0 to 24'})
+            if value('start_hour') == value('end_hour'):
+                raise serializers.ValidationError({'end_hour': 'must differ from start_hour'})
+            if not 1 <= value('days') <= 127:
+                raise serializers.ValidationError({'days': 'weekdays as bits, Monday = 1 ... Sunday = 64'})
+        elif kind == 'day_cap':
+            if value('amount') <= 0:
+                raise serializers.ValidationError({'amount': 'the most charged per day, must be positive'})
+        elif kind == 'event':
+            if value('starts_at') is None or value('ends_at') is None or value('starts_at') >= value('ends_at'):
+                raise serializers.ValidationError({'ends_at': 'events need starts_at before ends_at'})
+            if value('amount') < 0:
+                raise serializers.ValidationError({'amount': 'must not be negative'})
+        elif kind == 'occupancy':
+            if not 0 < value('threshold') <= 1:
+                raise serializers.ValidationError({'threshold': 'a share of time taken, above 0 and at most 1'})
+        return attrs
@@ -1,6 +1,12 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from .models import BaseUser
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from .models import (
+    BaseUser, Host, Attendant, Location, LocationImage, Reservation, Transactions, EarningsRollup, OccupancyHeatmap,
+)
+from . import search, availability, caching, databases, images, rollups
+from .authentication import token_cache
 from rest_framework.authtoken.models import Token
 
 @receiver(post_save, sender=BaseUser, dispatch_uid="create_token_and_profile_pic")
@@ -8,3 +14,108 @@ def create_token_and_profile_pic(sender, instance=None, created=False, **kwargs)
     # assign a user a token, and if they don't have a profile pic, assign one
     if created:
         Token.objects.create(user=instance)
+
+
+@receiver(post_save, sender=Location, dispatch_uid="index_location")
+def index_location(sender, instance=None, **kwargs):
+    # keep the full text search index in step with the location table
+    search.index_location(instance)
+
+
+@receiver(post_delete, sender=Location, dispatch_uid="unindex_location")
+def unindex_location(sender, instance=None, **kwargs):
+    search.unindex_location(instance.pk)
+
+
+@receiver(post_save, sender=Reservation, dispatch_uid="sync_reservation")
+def sync_reservation(sender, instance=None, **kwargs):
+    # the next search reads it from updated_at without waiting for the sync interval
+    availability.index.note_save()
+
+
+@receiver(post_delete, sender=Reservation, dispatch_uid="unindex_reservation")
+def unindex_reservation(sender, instance=None, **kwargs):
+    # saves are picked up from updated_at, but a deleted row leaves nothing behind to find
+    pk = instance.pk
+    transaction.on_commit(lambda: availability.index.remove(pk))
+
+
+@receiver(post_delete, sender=Reservation, dispatch_uid="stale_occupancy")
+def stale_occupancy(sender, instance=None, **kwargs):
+    # the heatmap of the lot may count the reservation, the next refresh counts the lot again
+    OccupancyHeatmap.objects.filter(location__parkingspot__pk=instance.parking_spot_id).update(stale=True)
+
+
+@receiver(post_save, sender=Token, dispatch_uid="uncache_saved_token")
+@receiver(post_delete, sender=Token, dispatch_uid="uncache_deleted_token")
+def uncache_token(sender, instance=None, **kwargs):
+    token_cache.invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=BaseUser, dispatch_uid="uncache_saved_user")
+@receiver(post_delete, sender=BaseUser, dispatch_uid="uncache_deleted_user")
+def uncache_user(sender, instance=None, **kwargs):
+    token_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Host, dispatch_uid="uncache_saved_host")
+@receiver(post_save, sender=Attendant, dispatch_uid="uncache_saved_attendant")
+@receiver(post_delete, sender=Attendant, dispatch_uid="uncache_deleted_attendant")
+def uncache_profile(sender, instance=None, **kwargs):
+    # the cached roles of the profile's user are stale
+    token_cache.invalidate_user(instance.user_id)
+
+
+@receiver(post_delete, sender=Host, dispatch_uid="uncache_deleted_host")
+def uncache_host(sender, instance=None, **kwargs):
+    token_cache.invalidate_user(instance.user_id)
+    token_cache.invalidate_boss(instance.pk)
+
+
+@receiver(pre_save, sender=Transactions, dispatch_uid="remember_rolled_up_transaction")
+def remember_rolled_up_transaction(sender, instance=None, **kwargs):
+    # an edit moves the amounts the row counted for so far, not the ones it is being saved with
+    instance._rolled_up = rollups.stored_contribution(instance.pk) if instance.pk is not None else None
+
+
+@receiver(post_save, sender=Transactions, dispatch_uid="roll_up_saved_transaction")
+def roll_up_saved_transaction(sender, instance=None, **kwargs):
+    rollups.apply(instance._rolled_up, rollups.contribution(instance))
+
+
+@receiver(post_delete, sender=Transactions, dispatch_uid="roll_up_deleted_transaction")
+def roll_up_deleted_transaction(sender, instance=None, **kwargs):
+    rollups.apply(rollups.contribution(instance), None)
+
+
+@receiver(post_delete, sender=Host, dispatch_uid="drop_host_rollups")
+def drop_host_rollups(sender, instance=None, **kwargs):
+    EarningsRollup.objects.filter(host_pk=instance.pk).delete()
+
+
+@receiver(pre_save, sender=BaseUser, dispatch_uid="note_new_avatar")
+@receiver(pre_save, sender=LocationImage, dispatch_uid="note_new_location_image")
+def note_new_image(sender, instance=None, update_fields=None, **kwargs):
+    images.note_image(instance, update_fields)
+
+
+@receiver(post_save, sender=BaseUser, dispatch_uid="make_avatar_variants")
+@receiver(post_save, sender=LocationImage, dispatch_uid="make_location_image_variants")
+def make_image_variants(sender, instance=None, **kwargs):
+    # once the upload is committed, see images.py
+    images.after_save(instance)
+
+
+def bump_version(sender, **kwargs):
+    # cached catalog responses built from this model are stale now
+    caching.bump(sender)
+
+
+for model in caching.VERSIONED_MODELS:
+    post_save.connect(bump_version, sender=model, dispatch_uid=f"bump_version_on_save_{model.__name__}")
+    post_delete.connect(bump_version, sender=model, dispatch_uid=f"bump_version_on_delete_{model.__name__}")
+
+
+@receiver(connection_created, dispatch_uid="tune_sqlite")
+def tune_sqlite(sender, connection=None, **kwargs):
+    databases.tune(connection)
@@ -2,8 +2,8 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework import routers
-from rest_framework.authtoken import views as auth_views
 from . import views
+from .metrics import metrics_view
 from rest_framework.views import APIView
 from rest_framework.routers import DefaultRouter
 
@@ -15,7 +15,10 @@ router.register(r'parking-spots', views.ParkingSpotViewSet, basename='parking-sp
 router.register(r'parking-sizes', views.ParkingSizeViewSet, basename='parking-size')
 router.register(r'reservations', views.ReservationViewSet, basename='reservations')
 router.register(r'locations', views.LocationViewSet, basename='locations')
+router.register(r'transactions', views.TransactionViewSet, basename='transactions')
+router.register(r'pricing-rules', views.PricingRuleViewSet, basename='pricing-rule')
 urlpatterns = [
-    path('api-token-auth/', auth_views.obtain_auth_token),
-    path('users/signup/', views.RegisterUser.as_view(), name='register')
+    path('api-token-auth/', views.ObtainAuthToken.as_view()),
+    path('users/signup/', views.RegisterUser.as_view(), name='register'),
+    path('_metrics', metrics_view, name='metrics'),
 ] + router.urls + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,8 +1,17 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
-from .models import BaseUser, Attendant, Host, ParkingSpot, ParkingSize, Location, Reservation
+from .models import (
+    BaseUser, Attendant, Host, ParkingSpot, ParkingSize, Location, Reservation, Transactions, EarningsRollup,
+    OccupancyHeatmap, PricingRule, LocationImage, ArchivedReservation,
+)
+from django.db import connection, transaction
 from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+import datetime
+from decimal import Decimal
+import numpy as np
 from .serializers import (
     BaseUserSerializer,
     BaseUserUpdateSerializer,
@@ -11,21 +20,39 @@ from .serializers import (
     ParkingSizeSerializer,
     ParkingSpotSerializer,
     ParkingSpotCreateSerializer,
+    ParkingSpotBulkItemSerializer,
     ParkingSizeSerializer,
     ReservationSerializer,
     ReservationCreateSerialzier,
     LocationSerializer,
     LocationCreateSerializer,
+    LocationImageSerializer,
+    EarningsRollupSerializer,
+    PricingRuleSerializer,
+    CheckoutSerializer,
+    TokenLoginSerializer,
+)
+from .permissions import AuthenticatedPermission, HostPermission, AttendantPermission, SAFE_METHODS
+from .pagination import PaginatedListMixin, ReservationCursorPagination
+from .roles import get_roles, forget_roles
+from .caching import conditional
+from . import (
+    search, geo, availability, caching, checkin, checkout, exports, metrics, passwords, rollups, occupancy, pricing,
 )
-from .permissions import AuthenticatedPermission, HostPermission, AttendantPermission
 from rest_framework.response import Response
-from rest_framework import viewsets
+from rest_framework import viewsets, status
 from rest_framework.generics import CreateAPIView
+from rest_framework.authtoken import views as auth_views
 from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny
+from rest_framework.exceptions import ValidationError
 
 
-SAFE_METHODS = ['list', 'retrieve']
+MAX_BULK_SPOTS = 1000
+MAX_BATCH_CONFIRM = 1000
+BULK_BATCH_SIZE = 500
+QUOTE_LIMIT = 100          # spots returned by a quote unless ?limit= asks for more
+MAX_QUOTE_LIMIT = 1000
 
 
 class RegisterUser(CreateAPIView):
@@ -33,17 +60,20 @@ class RegisterUser(CreateAPIView):
     permission_classes=[AllowAny]
 
     def perform_create(self, serializer):
-        instance = serializer.save()
-        instance.set_password(instance.password)
-        instance.save()
+        # hashed in the pool (see passwords.py) before anything is written, and saved once
+        serializer.save(password=passwords.hash_password(serializer.validated_data['password']))
 
 
-class BaseUserViewSet(viewsets.ViewSet):
-    
+class ObtainAuthToken(auth_views.ObtainAuthToken):
+    serializer_class = TokenLoginSerializer
+
+
+class BaseUserViewSet(PaginatedListMixin, viewsets.ViewSet):
+    serializer_class = BaseUserSerializer
+
     def list(self, request):
         queryset = BaseUser.objects.all()
-        serializer = BaseUserSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.paginated_response(queryset, BaseUserSerializer)
 
     def retrieve(self, request, pk=None):
         queryset = BaseUser.objects.all()
@@ -63,31 +93,32 @@ class BaseUserViewSet(viewsets.ViewSet):
     def me(self, request):
         if request.user.is_authenticated:
             serializer = BaseUserSerializer(request.user)
-            is_host = self.request.user.is_host()
-            is_attendant = self.request.user.is_attendant()
+            roles = get_roles(request)
             response_dict = {
                 "user": serializer.data,
-                "host": is_host,
-                "attendant": is_attendant,       
+                "host": roles.is_host,
+                "attendant": roles.is_attendant,
             }
-            if is_host: 
-                response_dict['host_data'] = HostSerializer(Host.objects.get(user=request.user)).data
-            if is_attendant: 
-                response_dict['attendant_data'] = AttendantSerializer(Attendant.objects.get(user=request.user)).data
+            if roles.is_host:
+                response_dict['host_data'] = HostSerializer(roles.host).data
+            if roles.is_attendant:
+                response_dict['attendant_data'] = AttendantSerializer(roles.attendant).data
             return Response(response_dict)
         else:
             return Response({"error": "not found"}, status=404)
 
 
-class AttendantViewSet(viewsets.ViewSet):
+class AttendantViewSet(PaginatedListMixin, viewsets.ViewSet):
+    serializer_class = AttendantSerializer
+
+    def get_queryset(self):
+        return self.serializer_class.setup_eager_loading(Attendant.objects.all())
 
     def list(self, request):
-        queryset = Attendant.objects.all()
-        serializer = AttendantSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.paginated_response(self.get_queryset(), AttendantSerializer)
 
     def retrieve(self, request, pk=None):
-        queryset = Attendant.objects.all()
+        queryset = self.get_queryset()
         user = get_object_or_404(queryset, pk=pk)
         serializer = AttendantSerializer(user)
         return Response(serializer.data)
@@ -96,15 +127,17 @@ class AttendantViewSet(viewsets.ViewSet):
         host_pk = request.data.get('host_pk', None)
         if not host_pk: 
             return Response({'success': False, 'message': 'must provide host pk'})
-        if request.user.is_host(): 
+        roles = get_roles(request)
+        if roles.is_host:
             return Response({'success': False, 'message': 'you are already a host'})
 
-        if request.user.is_attendant():
+        if roles.is_attendant:
             return Response({'success': False, 'message': 'you are already an attendant'})
         else: 
             try: 
                 boss = Host.objects.get(pk=host_pk)
                 attendant = Attendant.objects.create(user=request.user, boss=boss)
+                forget_roles(request)
                 serialized_data = AttendantSerializer(attendant).data
                 return Response({'success': True, 'attendant': serialized_data})
             except Exception as e: 
@@ -112,36 +145,41 @@ class AttendantViewSet(viewsets.ViewSet):
     
     @action(detail=False, permission_classes=[HostPermission])
     def myattendants(self, request):
-        host = Host.objects.get(user=request.user)
-        attendants = Attendant.objects.filter(boss=host)
+        attendants = self.get_queryset().filter(boss=get_roles(request).host)
         serializer = AttendantSerializer(attendants, many=True)
         # serializer = ViewAttendantSerializer(attendants)
-        return Response(serializer.data)
+        with metrics.serializing(request):
+            data = serializer.data
+        return Response(data)
 
     
 
-class HostViewSet(viewsets.ViewSet):
-    
+class HostViewSet(PaginatedListMixin, viewsets.ViewSet):
+    serializer_class = HostSerializer
+
+    def get_queryset(self):
+        return self.serializer_class.setup_eager_loading(Host.objects.all())
+
     def list(self, request):
-        queryset = Host.objects.all()
-        serializer = HostSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.paginated_response(self.get_queryset(), HostSerializer)
 
     def retrieve(self, request, pk=None):
-        queryset = Host.objects.all()
+        queryset = self.get_queryset()
         user = get_object_or_404(queryset, pk=pk)
         serializer = HostSerializer(user)
         return Response(serializer.data)
 
     def post(self, request):
-        if request.user.is_attendant(): 
+        roles = get_roles(request)
+        if roles.is_attendant:
             return Response({'success': False, 'message': 'you are already an attendant'})
 
-        if request.user.is_host():
+        if roles.is_host:
             return Response({'success': False, 'message': 'you are already a host'})
         else: 
             try: 
                 host = Host.objects.create(user=request.user)
+                forget_roles(request)
                 serialized_data = HostSerializer(host).data
                 return Response({'success': True, 'host': serialized_data})
             except Exception as e: 
@@ -158,26 +196,59 @@ class HostViewSet(viewsets.ViewSet):
             return Response({'succcess': False, 'message': 'this is not your employee'})
 
 
-class ParkingSpotViewSet(viewsets.ViewSet):
-    
+class ParkingSpotViewSet(PaginatedListMixin, viewsets.ViewSet):
+    serializer_class = ParkingSpotSerializer
+    fast_read = True
+
     def get_permissions(self):
         self.permission_classes = (HostPermission,)
-        if self.action in SAFE_METHODS:
+        if self.action in SAFE_METHODS or self.action == 'quote':
             self.permission_classes = (AllowAny,)
         return super(ParkingSpotViewSet, self).get_permissions()
 
     def get_queryset(self):
         '''
         possible query parameters:
-        - location (string -> contains in spot location fields)
+        - location (string -> full text search on the spot location, best matches first)
         - size (int -> pk)
+        - near ("lat,lng", zip code or "City, ST" -> spots within radius, closest first)
+        - radius (float -> km around near, default 10)
+        - bbox ("south,west,north,east" -> spots inside the box, closest to its center first)
+        - available_from, available_to (datetimes -> spots with no reservation in that window)
+        - date (YYYY-MM-DD -> spots with no reservation that day)
+        with a window, list results also get the total price of the window (see pricing.py)
         '''
         user = self.request.user
-        queryset = ParkingSpot.objects.all()
+        queryset = self.serializer_class.setup_eager_loading(ParkingSpot.objects.all())
         params = self.request.query_params
         location = params.get('location')
         size = params.get('size')
-        if location:
+        near = params.get('near')
+        bbox = params.get('bbox')
+        if near:
+            point = geo.parse_point(near)
+            if point is None:
+                raise ValidationError({'near': 'expected "lat,lng", a zip code or "City, ST"'})
+            radius = self.get_radius()
+            queryset = queryset.filter(
+                geo.box_filter(*geo.bounding_box(*point, radius), prefix='location__')
+            ).annotate(
+                distance_sq=geo.distance_expression(*point, prefix='location__')
+            ).filter(distance_sq__lte=geo.km_to_distance_sq(radius))
+        elif bbox:
+            box = geo.parse_box(bbox)
+            if box is None:
+                raise ValidationError({'bbox': 'expected "south,west,north,east" in degrees, south below north '
+                                               'and west of east'})
+            south, west, north, east = box
+            queryset = queryset.filter(
+                geo.box_filter(south, west, north, east, prefix='location__')
+            ).annotate(
+                distance_sq=geo.distance_expression((south + north) / 2, (west + east) / 2, prefix='location__')
+            )
+        if location and search.is_enabled():
+            queryset = search.filter_matches(queryset, location)
+        elif location:
             locations = location.split(' ')
             contains_query = Q()
             for location in locations:
@@ -190,12 +261,74 @@ class ParkingSpotViewSet(viewsets.ViewSet):
             queryset = queryset.filter(contains_query)
         if size and str.isdigit(size):
             queryset = queryset.filter(parking_size__pk=size)
+        window = self.get_window()
+        if window:
+            queryset = availability.free_spots(queryset, *window)
         return queryset
 
-    def list(self, request):
-        serializer = ParkingSpotSerializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+    def get_window(self):
+        params = self.request.query_params
+        if params.get('available_from') or params.get('available_to'):
+            try:
+                start = parse_datetime(params.get('available_from', ''))
+                end = parse_datetime(params.get('available_to', ''))
+            except ValueError:
+                start = end = None
+            if start is None or end is None:
+                raise ValidationError({'available_from': 'give both available_from and available_to as datetimes'})
+        elif params.get('date'):
+            try:
+                day = parse_date(params['date'])
+            except ValueError:
+                day = None
+            if day is None:
+                raise ValidationError({'date': 'expected YYYY-MM-DD'})
+            start = datetime.datetime.combine(day, datetime.time.min)
+            end = start + datetime.timedelta(days=1)
+        else:
+            return None
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start)
+        if timezone.is_naive(end):
+            end = timezone.make_aware(end)
+        if start >= end:
+            raise ValidationError({'available_to': 'must be after available_from'})
+        return start, end
+
+    def get_radius(self):
+        try:
+            radius = float(self.request.query_params.get('radius', 10))
+        except ValueError:
+            raise ValidationError({'radius': 'expected a number of km'})
+        if not 0 < radius <= geo.MAX_RADIUS_KM:
+            raise ValidationError({'radius': f'must be between 0 and {geo.MAX_RADIUS_KM} km'})
+        return radius
+
+    def get_ordering(self):
+        params = self.request.query_params
+        if params.get('near') or params.get('bbox'):
+            return ('distance_sq', 'pk')
+        if params.get('location') and search.is_enabled():
+            return ('search_rank', 'pk')
+        return None
 
+    def list(self, request):
+        response = self.paginated_response(self.get_queryset(), ParkingSpotSerializer, self.get_ordering())
+        window = self.get_window()
+        results = response.data['results']
+        if window and results:
+            # windows longer than the quote endpoint prices still list the free spots, without totals
+            total_of = {}
+            if pricing.quotable(*window):
+                pks, totals = pricing.quote(ParkingSpot.objects.filter(pk__in=[spot['pk'] for spot in results]),
+                                            *window)
+                total_of = dict(zip(pks.tolist(), totals.tolist()))
+            for spot in results:
+                spot['total'] = total_of.get(spot['pk'])
+        return response
+
+    @conditional(ParkingSpot, ParkingSize, Location, Host, BaseUser,
+                 skip_params=('available_from', 'available_to', 'date'))
     def retrieve(self, request, pk=None):
         user = get_object_or_404(self.get_queryset(), pk=pk)
         serializer = ParkingSpotSerializer(user)
@@ -203,50 +336,155 @@ class ParkingSpotViewSet(viewsets.ViewSet):
         
     def post(self, request, pk=None, *args, **kwargs):
         if pk is None:
-            request.data['owner'] = Host.objects.get(user__pk=request.user.pk).pk
+            request.data['owner'] = get_roles(request).host.pk
             serializer = ParkingSpotCreateSerializer(data=request.data)
             serializer.is_valid(raise_exception=True)
             serializer.save()
         else: 
-            request.data['owner'] = request.user.pk
+            request.data['owner'] = get_roles(request).host.pk
             instance = self.get_queryset().get(pk=pk)
             serializer = ParkingSpotCreateSerializer(instance, data=request.data, partial=True)
             serializer.is_valid(raise_exception=True)
             serializer.save()
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'], permission_classes=[HostPermission])
+    def bulk(self, request):
+        '''
+        Creates or edits many spots of the host at once. The body is a list of spots, items with a pk
+        edit that spot. Either everything is saved or nothing is: on a 400 the body is a list with the
+        errors of each item, in the order they were sent ({} for items without errors)
+        '''
+        items = request.data
+        if not isinstance(items, list) or not items:
+            raise ValidationError({'non_field_errors': ['expected a list of parking spots']})
+        if len(items) > MAX_BULK_SPOTS:
+            raise ValidationError({'non_field_errors': [f'at most {MAX_BULK_SPOTS} parking spots per request']})
+
+        host = get_roles(request).host
+        checked = []
+        for item in items:
+            serializer = ParkingSpotBulkItemSerializer(data=item, partial=isinstance(item, dict) and 'pk' in item)
+            serializer.is_valid()
+            checked.append(serializer)
+        valid = [serializer.validated_data for serializer in checked if not serializer.errors]
+
+        # every related object, in one query per model
+        sizes = ParkingSize.objects.in_bulk({data['parking_size_id'] for data in valid if 'parking_size_id' in data})
+        locations = Location.objects.filter(host=host).in_bulk({data['location_id'] for data in valid if 'location_id' in data})
+        existing = ParkingSpot.objects.filter(owner=host).in_bulk({data['pk'] for data in valid if 'pk' in data})
+
+        errors = []
+        spots = []
+        updated_fields = set()
+        for serializer in checked:
+            item_errors = dict(serializer.errors)
+            data = dict(getattr(serializer, 'validated_data', {}))
+            if not item_errors:
+                if 'pk' in data and data['pk'] not in existing:
+                    item_errors['pk'] = ['not one of your parking spots']
+                if 'parking_size_id' in data and data['parking_size_id'] not in sizes:
+                    item_errors['parking_size'] = ['no parking size with this pk']
+                if 'location_id' in data and data['location_id'] not in locations:
+                    item_errors['location'] = ['not one of your locations']
+            errors.append(item_errors)
+            if item_errors:
+                continue
+            spot = existing[data.pop('pk')] if 'pk' in data else ParkingSpot(owner=host)
+            if 'parking_size_id' in data:
+                spot.parking_size = sizes[data.pop('parking_size_id')]
+                data['parking_size'] = spot.parking_size
+            if 'location_id' in data:
+                spot.location = locations[data.pop('location_id')]
+                data['location'] = spot.location
+            for field, value in data.items():
+                setattr(spot, field, value)
+            if spot.pk is not None:
+                updated_fields.update(data)
+            spots.append(spot)
+        if any(errors):
+            raise ValidationError(errors)
+        if len({id(spot) for spot in spots}) != len(spots):
+            raise ValidationError({'non_field_errors': ['a parking spot is listed more than once']})
+
+        new_spots = [spot for spot in spots if spot.pk is None]
+        changed_spots = [spot for spot in spots if spot.pk is not None]
+        with transaction.atomic():
+            ParkingSpot.objects.bulk_create(new_spots, batch_size=BULK_BATCH_SIZE)
+            if new_spots and not connection.features.can_return_rows_from_bulk_insert:
+                # the insert holds the write lock until commit, so the newest spots of this host are ours
+                pks = ParkingSpot.objects.filter(owner=host).order_by('-pk').values_list('pk', flat=True)
+                for spot, pk in zip(new_spots, reversed(list(pks[:len(new_spots)]))):
+                    spot.pk = pk
+            if changed_spots and updated_fields:
+                ParkingSpot.objects.bulk_update(changed_spots, sorted(updated_fields), batch_size=BULK_BATCH_SIZE)
+            # neither bulk call sends signals
+            caching.bump(ParkingSpot)
+        with metrics.serializing(request):
+            data = ParkingSpotBulkItemSerializer(spots, many=True).data
+        return Response(data, status=status.HTTP_201_CREATED if new_spots else status.HTTP_200_OK)
+
+    @action(detail=False)
+    def quote(self, request):
+        '''
+        the total price of a window at every spot the same query parameters would list, cheapest first,
+        priced all at once (see pricing.py). A window (available_from and available_to, or date) is required
+        possible query parameters, next to those of list:
+        - limit (int -> number of spots returned, default 100, at most 1000)
+        '''
+        window = self.get_window()
+        if window is None:
+            raise ValidationError({'available_from': 'give available_from and available_to, or date'})
+        if not pricing.quotable(*window):
+            raise ValidationError({'available_to': f'quotes cover at most {pricing.MAX_DAYS} days'})
+        limit = request.query_params.get('limit', str(QUOTE_LIMIT))
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_QUOTE_LIMIT:
+            raise ValidationError({'limit': f'expected a number from 1 to {MAX_QUOTE_LIMIT}'})
+        queryset = self.get_queryset()
+        pks, totals = pricing.quote(queryset, *window)
+        cheapest = np.argsort(totals, kind='stable')[:int(limit)]
+        locations = dict(queryset.filter(pk__in=pks[cheapest].tolist()).values_list('pk', 'location'))
+        return Response({
+            'from': window[0], 'to': window[1], 'count': len(pks),
+            'results': [{'spot': pk, 'location': locations[pk], 'total': total}
+                        for pk, total in zip(pks[cheapest].tolist(), totals[cheapest].tolist())],
+        })
+
     @action(detail=False, permission_classes=[HostPermission])   
     def myspots(self, request): 
-        queryset = ParkingSpot.objects.filter(owner__user__pk=request.user.pk)
-        serializer = ParkingSpotSerializer(queryset, many=True)
-        return Response(serializer.data)
+        queryset = self.serializer_class.setup_eager_loading(
+            ParkingSpot.objects.filter(owner=get_roles(request).host)
+        )
+        return Response(self.serialize_many(queryset, ParkingSpotSerializer))
 
 
-class LocationViewSet(viewsets.ViewSet):
+class LocationViewSet(PaginatedListMixin, viewsets.ViewSet):
+    serializer_class = LocationSerializer
 
     def get_permissions(self):
         self.permission_classes = (HostPermission,)
-        if self.action in SAFE_METHODS:
+        if self.action in SAFE_METHODS or (self.action == 'images' and self.request.method == 'GET'):
             self.permission_classes = (AllowAny,)
         return super(LocationViewSet, self).get_permissions()
 
     def get_queryset(self):
-        queryset = Location.objects.all()
+        queryset = self.serializer_class.setup_eager_loading(Location.objects.all())
         if self.action not in SAFE_METHODS:
             queryset = queryset.filter(host__user__pk=self.request.user.pk)
         return queryset
 
+    @conditional(Location, Host, BaseUser)
     def list(self, request):
-        serializer = LocationSerializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        return self.paginated_response(self.get_queryset(), LocationSerializer)
 
+    @conditional(Location, Host, BaseUser)
     def retrieve(self, request, pk=None):
         user = get_object_or_404(self.get_queryset(), pk=pk)
         serializer = LocationSerializer(user)
         return Response(serializer.data)
         
     def post(self, request, pk=None, *args, **kwargs):
-        request.data['host'] = Host.objects.get(user__pk=request.user.pk).pk
+        request.data['host'] = get_roles(request).host.pk
         if pk is None:
             serializer = LocationCreateSerializer(data=request.data)
             serializer.is_valid(raise_exception=True)
@@ -260,13 +498,57 @@ class LocationViewSet(viewsets.ViewSet):
 
     @action(detail=False, permission_classes=[])   
     def mylocations(self, request): 
-        queryset = Location.objects.filter(host__user__pk=request.user.pk)
+        queryset = self.get_queryset().filter(host__user__pk=request.user.pk)
         serializer = LocationSerializer(queryset, many=True)
-        return Response(serializer.data)
+        with metrics.serializing(request):
+            data = serializer.data
+        return Response(data)
+
+    @action(detail=True, permission_classes=[HostPermission])
+    def occupancy(self, request, pk=None):
+        '''
+        share of time the lot, or one spot (?spot=pk), was taken in every hour of the week:
+        7 lists of 24 starting Monday 0:00 local time, from the heatmaps the refresh_occupancy
+        command keeps (see occupancy.py)
+        '''
+        location = get_object_or_404(Location, pk=pk, host=get_roles(request).host)
+        spot = request.query_params.get('spot')
+        if spot is not None:
+            if not spot.isdigit():
+                raise ValidationError({'spot': 'expected a spot pk'})
+            spot = int(spot)
+        heatmap = OccupancyHeatmap.objects.filter(location=location).first()
+        if heatmap is None:
+            # nothing counted for this lot yet
+            return Response({'location': location.pk, 'spot': spot, 'from': None, 'to': None,
+                             'counted_until': None, 'occupancy': [[0.0] * 24 for day in range(7)]})
+        return Response({
+            'location': location.pk, 'spot': spot, 'from': heatmap.first_start, 'to': heatmap.last_end,
+            'counted_until': heatmap.counted_until, 'occupancy': occupancy.shares(heatmap, spot),
+        })
+
+    @action(detail=True, methods=['get', 'post'])
+    def images(self, request, pk=None):
+        '''
+        GET: pictures of the lot with the urls of their sized variants, which are made in the background
+        after an upload (see images.py), POST: adds one, multipart body: image
+        '''
+        if request.method == 'GET':
+            location = get_object_or_404(Location, pk=pk)
+            queryset = LocationImage.objects.filter(location=location).order_by('pk')
+            with metrics.serializing(request):
+                data = LocationImageSerializer(queryset, many=True).data
+            return Response(data)
+        location = get_object_or_404(Location, pk=pk, host=get_roles(request).host)
+        serializer = LocationImageSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save(location=location)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 class ParkingSizeViewSet(viewsets.ViewSet):
-    
+    serializer_class = ParkingSizeSerializer
+
     def get_queryset(self):
         return ParkingSize.objects.all()
 
@@ -276,10 +558,14 @@ class ParkingSizeViewSet(viewsets.ViewSet):
             self.permission_classes = (AllowAny,)
         return super(ParkingSizeViewSet, self).get_permissions()
 
+    @conditional(ParkingSize)
     def list(self, request):
         serializer = ParkingSizeSerializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        with metrics.serializing(request):
+            data = serializer.data
+        return Response(data)
 
+    @conditional(ParkingSize)
     def retrieve(self, request, pk=None):
         user = get_object_or_404(self.get_queryset(), pk=pk)
         serializer = ParkingSizeSerializer(user)
@@ -298,57 +584,102 @@ class ParkingSizeViewSet(viewsets.ViewSet):
         return Response(serializer.data)
 
 
-class ReservationViewSet(viewsets.ViewSet):
+class ReservationViewSet(PaginatedListMixin, viewsets.ViewSet):
+    serializer_class = ReservationSerializer
+    pagination_class = ReservationCursorPagination
+    fast_read = True
 
-    def get_queryset(self):
-        queryset = Reservation.objects.all()
+    def get_queryset(self, model=Reservation):
+        # model=ArchivedReservation for the past ones, see archive.py
+        queryset = self.serializer_class.setup_eager_loading(model.objects.all())
         user = self.request.user
+        roles = get_roles(self.request)
         if self.action != 'retrieve':
             queryset = queryset.filter(canceled=False)
-        if self.action in ['myreservations', 'confirm', 'cancel'] and user.is_host():
-            queryset = queryset.filter(parking_spot__owner=Host.objects.get(user=user))
-        elif self.action in ['bossreservations', 'confirm', 'cancel'] and user.is_attendant():
-            attendant = Attendant.objects.get(user=user)
-            if attendant.boss:
-                queryset = queryset.filter(parking_spot__owner=Attendant.objects.get(user=user).boss)
+        if self.action in ['myreservations', 'confirm', 'cancel'] and roles.is_host:
+            queryset = queryset.filter(parking_spot__owner=roles.host)
+        elif self.action in ['bossreservations', 'confirm', 'cancel'] and roles.is_attendant:
+            if roles.lot_host:
+                queryset = queryset.filter(parking_spot__owner=roles.lot_host)
             else:
-                queryset = []
+                queryset = queryset.none()
         else:
             queryset = queryset.filter(user=user)
         return queryset
 
 
     def list(self, request):
-        serializer = ReservationSerializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        return self.paginated_response([self.get_queryset(), self.get_queryset(ArchivedReservation)],
+                                       ReservationSerializer)
 
     def retrieve(self, request, pk=None):
-        user = get_object_or_404(self.get_queryset(), pk=pk)
+        user = self.get_queryset().filter(pk=pk).first()
+        if user is None:
+            user = get_object_or_404(self.get_queryset(ArchivedReservation), pk=pk)
         serializer = ReservationSerializer(user)
         return Response(serializer.data)
         
     def post(self, request, pk=None, *args, **kwargs):
         request.data['user'] = request.user.pk
-        if pk is None:
-            serializer = ReservationCreateSerialzier(data=request.data)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
-        else:
-            instance = self.get_queryset().get(pk=pk)
-            serializer = ReservationSerializer(instance, data=request.data, partial=True)
+        instance = None if pk is None else self.get_queryset().get(pk=pk)
+        spot = str(request.data.get('parking_spot', getattr(instance, 'parking_spot_id', '')))
+        # the spot stays locked from before validation checks for overlaps until the save commits,
+        # locking before the lookups of validation lets sqlite wait for other bookings (see checkout.py)
+        with transaction.atomic():
+            if spot.isdigit():
+                checkout.lock_spot(spot)
+            if instance is None:
+                serializer = ReservationCreateSerialzier(data=request.data)
+            else:
+                serializer = ReservationSerializer(instance, data=request.data, partial=True)
             serializer.is_valid(raise_exception=True)
             serializer.save()
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'], permission_classes=[AuthenticatedPermission])
+    def checkout(self, request):
+        '''
+        books a spot: the reservation, the transaction charging its quoted price and a check-in token,
+        all or nothing, and never overlapping another reservation (see checkout.py)
+        body: parking_spot, start_date, end_date, vehicle, expected_total (optional, the price the user
+        was shown, the checkout fails if the quote changed since)
+        '''
+        serializer = CheckoutSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        reservation, record, token = checkout.checkout(
+            request.user, data['parking_spot'], data['start_date'], data['end_date'], data['vehicle'],
+            data.get('expected_total'),
+        )
+        return Response({
+            'reservation': self.serialize_many(Reservation.objects.filter(pk=reservation.pk), ReservationSerializer)[0],
+            'transaction': {
+                'pk': record.pk, 'user_charge': str(record.user_charge), 'fee_amount': str(record.fee_amount),
+                'host_income': str(record.host_income),
+            },
+            'checkin_token': token,
+        }, status=status.HTTP_201_CREATED)
+
     @action(detail=False, permission_classes=[HostPermission])
     def myreservations(self, request):
-        serializer = ReservationSerializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        return Response(self.serialize_many(self.get_queryset(), ReservationSerializer))
 
     @action(detail=False, permission_classes=[AttendantPermission])
     def bossreservations(self, request):
-        serializer = ReservationSerializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        return Response(self.serialize_many(self.get_queryset(), ReservationSerializer))
+
+    @action(detail=False, permission_classes=[HostPermission], renderer_classes=exports.RENDERERS)
+    def export(self, request):
+        '''
+        the host's reservations, canceled and archived ones included, as csv or ndjson (?format=), see exports.py
+        '''
+        host = get_roles(request).host
+        querysets = [
+            exports.filter_queryset(request, model.objects.filter(parking_spot__owner=host), 'start_date',
+                                    'parking_spot__location').order_by('start_date', 'pk')
+            for model in (Reservation, ArchivedReservation)
+        ]
+        return exports.stream(request, 'reservations', exports.RESERVATION_COLUMNS, querysets)
 
     @action(detail=True, methods=['post'], permission_classes=[AuthenticatedPermission])
     def cancel(self, request, pk=None):
@@ -364,18 +695,13 @@ class ReservationViewSet(viewsets.ViewSet):
 
     @action(detail=False, methods=['get'], permission_classes=[AttendantPermission])
     def needsconfirmation(self, request):
-        is_attendant = request.user.is_attendant()
-        is_host = request.user.is_host()
-        queryset = []
-        if is_host: 
-            host = Host.objects.get(user__pk=request.user.pk)
-            queryset = Reservation.objects.filter(parking_spot__owner__pk=host.pk, confirmed=False, canceled=False)
-        if is_attendant:
-            host = Attendant.objects.get(user__pk=request.user.pk).boss
-            queryset = Reservation.objects.filter(parking_spot__owner__pk=host.pk, confirmed=False, canceled=False)
-        serializer = ReservationSerializer(queryset, many=True)
-
-        return Response(serializer.data)
+        host = get_roles(request).lot_host
+        queryset = Reservation.objects.none()
+        if host is not None:
+            queryset = self.serializer_class.setup_eager_loading(
+                Reservation.objects.filter(parking_spot__owner__pk=host.pk, confirmed=False, canceled=False)
+            )
+        return Response(self.serialize_many(queryset, ReservationSerializer))
         
 
     @action(detail=True, methods=['post'], permission_classes=[AttendantPermission])
@@ -390,3 +716,244 @@ class ReservationViewSet(viewsets.ViewSet):
             return Response({'success': True, 'message': 'you have confirmed reservation number: {}'.format(pk)})
         return Response({'success': False, 'message': 'you must specify a pk'})
 
+    @action(detail=False, methods=['post'], permission_classes=[AttendantPermission])
+    def batchconfirm(self, request):
+        '''
+        Confirms many reservations of the boss's lots at once, by pk and/or by scanned check-in token,
+        i.e. {"pks": [1, 2, 3], "tokens": ["AQAAA..."]}. Reservations that are already confirmed, canceled,
+        or not at the boss's lots are left alone and listed in the response, as are invalid tokens
+        '''
+        pks = request.data.get('pks', [])
+        tokens = request.data.get('tokens', [])
+        if not isinstance(pks, list) or not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in pks):
+            raise ValidationError({'pks': 'expected a list of reservation pks'})
+        if not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens):
+            raise ValidationError({'tokens': 'expected a list of check-in tokens'})
+        if not pks and not tokens:
+            raise ValidationError({'pks': 'give pks or tokens to confirm'})
+        if len(pks) + len(tokens) > MAX_BATCH_CONFIRM:
+            raise ValidationError({'pks': f'at most {MAX_BATCH_CONFIRM} reservations per request'})
+        pks = list(pks)
+        host = get_roles(request).lot_host
+        result = {'confirmed': [], 'already_confirmed': [], 'canceled': [], 'foreign': [], 'invalid': []}
+
+        # tokens are checked with the boss's key before touching the database
+        scanned = {}    # reservation pk -> [(token fields, token)]
+        key = checkin.host_key(host.pk) if host is not None else None
+        for token in tokens:
+            try:
+                fields = checkin.read_token(token, key=key)
+            except checkin.InvalidToken:
+                result['invalid'].append(token)
+                continue
+            scanned.setdefault(fields['reservation'], []).append((fields, token))
+        requested = set(pks)
+        pks = list(dict.fromkeys(pks + list(scanned)))
+
+        rows = Reservation.objects.filter(pk__in=pks).values_list(
+            'pk', 'parking_spot__owner_id', 'canceled', 'confirmed', 'checkin_code', 'parking_spot', 'start_date',
+            'end_date'
+        )
+        state = {pk: rest for pk, *rest in rows}
+        to_confirm = []
+        for pk in pks:
+            owner_id, canceled, confirmed, code, *window = state.get(pk, (None, False, False) + (None,) * 4)
+            # signed by the boss, but issued for an older version of the reservation
+            stale = [token for fields, token in scanned.get(pk, ())
+                     if fields['code'] != code or not checkin.matches(fields, *window)]
+            result['invalid'].extend(stale)
+            if pk not in requested and len(stale) == len(scanned[pk]):
+                continue
+            if host is None or owner_id != host.pk:
+                # reservations that don't exist are reported the same way, so pks of other hosts can't be probed
+                result['foreign'].append(pk)
+            elif canceled:
+                result['canceled'].append(pk)
+            elif confirmed:
+                result['already_confirmed'].append(pk)
+            else:
+                to_confirm.append(pk)
+
+        if to_confirm:
+            # update() skips auto_now, availability.py reads updated_at to find changed rows
+            stamp = timezone.now()
+            with transaction.atomic():
+                pending = Reservation.objects.filter(pk__in=to_confirm, canceled=False, confirmed=False)
+                updated = pending.update(confirmed=True, updated_at=stamp)
+                if updated != len(to_confirm):
+                    # some were confirmed, canceled or deleted between the read and the update. Until the
+                    # commit the rows read as the update left them, and the ones it confirmed carry its stamp
+                    rows = Reservation.objects.filter(pk__in=to_confirm).values_list(
+                        'pk', 'canceled', 'confirmed', 'updated_at'
+                    )
+                    state = {pk: rest for pk, *rest in rows}
+                    confirmed = []
+                    for pk in to_confirm:
+                        if pk not in state:
+                            result['foreign'].append(pk)
+                        elif state[pk][0]:
+                            result['canceled'].append(pk)
+                        elif state[pk][2] == stamp:
+                            confirmed.append(pk)
+                        else:
+                            result['already_confirmed'].append(pk)
+                    to_confirm = confirmed
+            result['confirmed'] = to_confirm
+        return Response({'success': True, **result})
+
+    @action(detail=True, methods=['get'], permission_classes=[AuthenticatedPermission])
+    def checkintoken(self, request, pk=None):
+        '''
+        The signed token to show as a QR code at the gate, for the user who made the reservation
+        '''
+        reservation = get_object_or_404(
+            Reservation.objects.select_related('parking_spot'), pk=pk, user=request.user, canceled=False
+        )
+        token, code = checkin.make_token(reservation)
+        if reservation.checkin_code != code:
+            # a first token, or the reservation moved and old tokens must stop working
+            Reservation.objects.filter(pk=reservation.pk).update(checkin_code=code)
+        return Response({'token': token, 'expires': reservation.end_date})
+
+    @action(detail=False, methods=['get'], permission_classes=[AttendantPermission])
+    def checkinkey(self, request):
+        '''
+        The key attendant devices use to check tokens offline, see checkin.py
+        '''
+        host = get_roles(request).lot_host
+        if host is None:
+            return Response({'success': False, 'message': 'you are not working for a host'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'host': host.pk, 'key': checkin.checkin_key(host.pk), 'mac_size': checkin.MAC_SIZE})
+
+    @action(detail=False, methods=['post'], permission_classes=[AttendantPermission])
+    def checkin(self, request):
+        '''
+        Checks a scanned token and confirms its reservation. One indexed lookup after the signature check
+        '''
+        host = get_roles(request).lot_host
+        token = request.data.get('token')
+        if host is None or not isinstance(token, str):
+            raise ValidationError({'token': 'expected a check-in token'})
+        try:
+            fields = checkin.read_token(token, key=checkin.host_key(host.pk))
+        except checkin.InvalidToken as e:
+            raise ValidationError({'token': str(e)})
+        row = Reservation.objects.filter(checkin_code=fields['code']).values_list(
+            'pk', 'canceled', 'confirmed', 'parking_spot', 'start_date', 'end_date').first()
+        if row is None or not checkin.matches(fields, *row[3:]):
+            raise ValidationError({'token': 'replaced by a newer token'})
+        pk, canceled, confirmed = row[:3]
+        if canceled:
+            raise ValidationError({'token': 'this reservation was canceled'})
+        if not confirmed:
+            Reservation.objects.filter(pk=pk, confirmed=False).update(confirmed=True, updated_at=timezone.now())
+        return Response({
+            'success': True,
+            'reservation': pk,
+            'parking_spot': fields['spot'],
+            'start_date': datetime.datetime.fromtimestamp(fields['start'], datetime.timezone.utc),
+            'end_date': datetime.datetime.fromtimestamp(fields['end'], datetime.timezone.utc),
+            'already_confirmed': confirmed,
+        })
+
+
+class TransactionViewSet(viewsets.ViewSet):
+
+    @action(detail=False, permission_classes=[HostPermission], renderer_classes=exports.RENDERERS)
+    def export(self, request):
+        '''
+        the transactions on the host's spots as csv or ndjson (?format=), see exports.py
+        '''
+        queryset = Transactions.objects.filter(spot__owner=get_roles(request).host)
+        queryset = exports.filter_queryset(request, queryset, 'date', 'location')
+        return exports.stream(request, 'transactions', exports.TRANSACTION_COLUMNS, queryset.order_by('date', 'pk'))
+
+    @action(detail=False, permission_classes=[HostPermission])
+    def earnings(self, request):
+        '''
+        the host's earnings per day or month, read from the rollups (see rollups.py), so the cost
+        depends on the number of periods shown and not on the number of transactions
+        possible query parameters:
+        - period (day or month, default day)
+        - from, to (YYYY-MM-DD -> periods from the one holding from to the one holding to,
+          default the last 30 days or 12 months)
+        - location or spot (int -> pk, the earnings of that one location or spot, not both)
+        '''
+        params = request.query_params
+        period = params.get('period', 'day')
+        if period not in rollups.MAX_SPAN:
+            raise ValidationError({'period': 'expected day or month'})
+        bounds = {}
+        for name in ('from', 'to'):
+            try:
+                bounds[name] = parse_date(params[name]) if params.get(name) else None
+            except ValueError:
+                bounds[name] = None
+            if params.get(name) and bounds[name] is None:
+                raise ValidationError({name: 'expected YYYY-MM-DD'})
+        last = rollups.period_start(period, bounds['to'] or timezone.localdate())
+        first = rollups.period_start(period, bounds['from'] or rollups.default_from(period, last))
+        if not 0 < rollups.span(period, first, last) <= rollups.MAX_SPAN[period]:
+            raise ValidationError({'from': f'must be before to and at most {rollups.MAX_SPAN[period]} {period}s back'})
+
+        host = get_roles(request).host
+        scope, scope_pk = 'host', host.pk
+        if params.get('spot') and params.get('location'):
+            raise ValidationError({'spot': 'give a spot or a location, not both'})
+        for name in ('spot', 'location'):
+            if params.get(name):
+                if not params[name].isdigit():
+                    raise ValidationError({name: f'expected a {name} pk'})
+                scope, scope_pk = name, int(params[name])
+        queryset = EarningsRollup.objects.filter(
+            host_pk=host.pk, scope=scope, scope_pk=scope_pk, period=period, start__gte=first, start__lte=last,
+        ).order_by('start')
+        with metrics.serializing(request):
+            results = EarningsRollupSerializer(queryset, many=True).data
+        total = {'transactions': sum(row['transactions'] for row in results)}
+        for name in rollups.AMOUNTS:
+            total[name] = str(sum((Decimal(row[name]) for row in results), Decimal('0.00')))
+        return Response({
+            'period': period, 'scope': scope, 'from': first, 'to': last, 'total': total, 'results': results,
+        })
+
+
+class PricingRuleViewSet(PaginatedListMixin, viewsets.ViewSet):
+    '''
+    the pricing rules of the host's locations, see pricing.py
+    '''
+    serializer_class = PricingRuleSerializer
+    permission_classes = [HostPermission]
+
+    def get_queryset(self):
+        '''
+        possible query parameters:
+        - location (int -> pk)
+        '''
+        queryset = PricingRule.objects.filter(location__host=get_roles(self.request).host)
+        location = self.request.query_params.get('location')
+        if location:
+            if not location.isdigit():
+                raise ValidationError({'location': 'expected a location pk'})
+            queryset = queryset.filter(location=location)
+        return queryset
+
+    def list(self, request):
+        return self.paginated_response(self.get_queryset(), PricingRuleSerializer)
+
+    def retrieve(self, request, pk=None):
+        rule = get_object_or_404(self.get_queryset(), pk=pk)
+        return Response(PricingRuleSerializer(rule).data)
+
+    def post(self, request, pk=None, *args, **kwargs):
+        instance = None if pk is None else get_object_or_404(self.get_queryset(), pk=pk)
+        serializer = PricingRuleSerializer(instance, data=request.data, partial=instance is not None)
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data.get('location', getattr(instance, 'location', None)).host_id != get_roles(request).host.pk:
+            raise ValidationError({'location': 'not one of your locations'})
+        serializer.save()
+        return Response(serializer.data)
+
+    def destroy(self, request, pk=None):
+        get_object_or_404(self.get_queryset(), pk=pk).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
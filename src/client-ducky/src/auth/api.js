@@ -14,4 +14,13 @@ api.interceptors.request.use(conf => {
     return conf
 })
 
+// list endpoints are cursor paginated: {next, previous, results}
+// follows the next links until the whole list is loaded, for small lists like dropdowns
+export const getAllPages = (url, results = []) => {
+    return api.get(url).then(res => {
+        const all = results.concat(res.data.results)
+        return res.data.next ? getAllPages(res.data.next, all) : all
+    })
+}
+
 export default api
\ No newline at end of file
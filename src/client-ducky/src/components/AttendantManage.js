@@ -37,6 +37,14 @@ const AttendantManage = ({isAuthenticated}) => {
     }
 
 
+    const confirmAll = () => {
+        api.post('reservations/batchconfirm/', {pks: reservations.map(r => r.pk)}).then(res => {
+            if(res.status === 200) {
+                window.location.reload()
+            }
+        })
+    }
+
     const renderRows = () => {
         return reservations.map(r => {
             console.log(r)
@@ -96,7 +104,9 @@ const AttendantManage = ({isAuthenticated}) => {
                     </table>
                     {reservations.length === 0 ? (
                         <p>no reservations under this host</p>
-                    ): ''}
+                    ): (
+                        <button className='btn btn-primary' onClick={confirmAll}>Confirm All</button>
+                    )}
                     <CancelReservationModal reservation={currentRes} showModal={showModal} toggleModal={toggleModal}/>
                 </div>) :
                 (<Redirect to={"/login/"}/>))}
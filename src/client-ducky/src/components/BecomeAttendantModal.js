@@ -1,6 +1,6 @@
 import React, {useState, useEffect} from 'react';
 import {useHistory} from "react-router-dom";
-import api from '../auth/api'
+import api, { getAllPages } from '../auth/api'
 import "../css/styles.css"
 
 const BecomeAttendantModal = ({user, showModal, toggleModal}) => {
@@ -10,9 +10,9 @@ const BecomeAttendantModal = ({user, showModal, toggleModal}) => {
     const [hosts, setHosts] = useState([])
 
     useEffect(() => {
-        api.get('hosts/')
-            .then(r => {
-                setHosts(r.data)
+        getAllPages('hosts/')
+            .then(hosts => {
+                setHosts(hosts)
             })
     }, [])
 
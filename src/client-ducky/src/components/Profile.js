@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from "react"
-import api from "../auth/api";
+import api, { getAllPages } from "../auth/api";
 import { Redirect, useHistory } from "react-router-dom";
 import ProfileReservationCard from "./ProfileReservationCard";
 import BecomeHostModal from './BecomeHostModal';
@@ -51,10 +51,10 @@ const Profile = ({ isAuthenticated }) => {
     }, [])
 
     useEffect(() => {
-        api.get("reservations/")
-            .then(r => {
-                if (r.data) {
-                    setPersonalRes(r.data)
+        getAllPages("reservations/")
+            .then(reservations => {
+                if (reservations) {
+                    setPersonalRes(reservations)
                 } else {
                     console.log("No data from server!")
                 }
@@ -10,6 +10,7 @@ const Search = () => {
     const [searchLocation, setSearchLocation] = useState([]);
     const [date, setDate] = useState([]);
     const [spotType, setSpotType] = useState([]);
+    const [nextPage, setNextPage] = useState(null);
 
 
     function getParkingSpots() {
@@ -19,10 +20,12 @@ const Search = () => {
         let date = params.get('date');
         let spotType = isNaN(params.get('size-type')) ? params.get('size-type') : null
         setSpotType(spotType)
-        api.get(`parking-spots/?location=${location}&size=${spotType}&data=${date}`)
+        const dateParam = date ? `&date=${date}` : ''
+        api.get(`parking-spots/?location=${location}&size=${spotType}${dateParam}`)
             .then(res => {
             if(res.data) {
-                setParkingSpots(res.data)
+                setParkingSpots(res.data.results)
+                setNextPage(res.data.next)
                 console.log("Setting data")
             } else {
                 console.log("No data from server!")
@@ -32,6 +35,15 @@ const Search = () => {
         })
     }
 
+    function loadMore() {
+        api.get(nextPage).then(res => {
+            setParkingSpots(parkingSpots.concat(res.data.results))
+            setNextPage(res.data.next)
+        }).catch( () => {
+            console.log("Error fetching the next page of spots!")
+        })
+    }
+
     useEffect(() => {
         getParkingSpots();
     }, []);
@@ -60,6 +72,9 @@ const Search = () => {
                         <p>Please try searching for something different</p>
                     </div>
                 }
+                {nextPage ?
+                    <button className="btn btn-primary m-3" onClick={loadMore}>Load more</button> : ''
+                }
             </div>
         </div>
     )